@@ -7,7 +7,7 @@ import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import paypalrestsdk
-from functools import wraps
+from functools import wraps, lru_cache
 import base64
 from flask_sqlalchemy import SQLAlchemy
 import subprocess
@@ -15,16 +15,41 @@ import time
 import re
 from pytz import timezone
 import threading
-from sqlalchemy import and_
+import queue
+from sqlalchemy import and_, or_, bindparam, func
 import atexit
 import random
 import jwt
+import smtplib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait as wait_futures
+import gzip
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import asyncio
+import email as email_parser
+from email.utils import parseaddr
+import hashlib
+import imaplib
+import mailbox
+from urllib.parse import urlparse, unquote
+from sqlalchemy.exc import IntegrityError
+try:
+    import aiosmtplib  # Optional: async SMTP engine (EMAIL_ASYNC_ENGINE=true)
+except ImportError:
+    aiosmtplib = None
+try:
+    import httpx  # Optional: direct APNs/FCM push over HTTP/2 (pip install 'httpx[http2]')
+    import h2  # noqa: F401 - httpx's HTTP/2 support
+except ImportError:
+    httpx = None
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
-app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
+DEFAULT_SECRET_KEY = 'your-secret-key-here'  # Public placeholder; nothing security-relevant is signed with it
+app.secret_key = os.getenv('SECRET_KEY', DEFAULT_SECRET_KEY)
 
 # Configure PayPal
 paypal_mode = os.getenv('PAYPAL_MODE', 'sandbox')  # sandbox for local dev, live for production
@@ -45,9 +70,9 @@ else:
     print("   For production, use live mode with Google Cloud Secret Manager.")
 
 # Configure Flask-Mail
-app.config['MAIL_SERVER'] = 'mail.spacemail.com'
-app.config['MAIL_PORT'] = 465
-app.config['MAIL_USE_SSL'] = True
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'mail.spacemail.com')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '465'))
+app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL', 'true').lower() == 'true'
 app.config['MAIL_USE_TLS'] = False  # SSL only
 app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
@@ -90,26 +115,48 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
 class Subscriber(db.Model):
+    __table_args__ = (db.Index('ix_subscriber_suppressed_location', 'suppressed', 'location'),)
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(256), unique=True, nullable=False)
     location = db.Column(db.String(128), default='auto')
     subscribed_at = db.Column(db.String(64), nullable=False)
+    delivery_mode = db.Column(db.String(16), default='instant')  # 'instant' or 'digest'
+    suppressed = db.Column(db.Boolean, default=False)  # Hard-bounced or complained: never emailed
+    suppressed_at = db.Column(db.DateTime, nullable=True)
+    suppression_reason = db.Column(db.String(255), nullable=True)
+    hard_bounces = db.Column(db.Integer, default=0)
+    soft_bounces = db.Column(db.Integer, default=0)  # Within BOUNCE_SOFT_WINDOW_DAYS of the last bounce
+    last_bounce_at = db.Column(db.DateTime, nullable=True)
 
     def as_dict(self):
         return {
             'email': self.email,
             'location': self.location,
-            'subscribed_at': self.subscribed_at
+            'subscribed_at': self.subscribed_at,
+            'delivery_mode': self.delivery_mode or 'instant',
+            'suppressed': bool(self.suppressed),
+            'suppression_reason': self.suppression_reason
         }
 
 class Device(db.Model):
+    # Targeted fan-out (active + location + platform, keyset by id) is an index range scan
+    __table_args__ = (
+        db.Index('ix_device_active_location_platform', 'is_active', 'location_key', 'platform', 'id'),
+        db.Index('ix_device_active_platform', 'is_active', 'platform', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     push_token = db.Column(db.String(512), unique=True, nullable=False)
     platform = db.Column(db.String(32), nullable=False)  # 'expo', 'fcm', etc.
     device_type = db.Column(db.String(32), nullable=False)  # 'ios', 'android'
     location = db.Column(db.String(128), default='auto')  # Location for this device
+    location_key = db.Column(db.String(128), nullable=True)  # normalize_location_key(location)
     registered_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    push_failures = db.Column(db.Integer, default=0)  # Consecutive transient push errors
+    last_push_error = db.Column(db.String(64), nullable=True)  # Expo error code, e.g. DeviceNotRegistered
+    deactivated_at = db.Column(db.DateTime, nullable=True)  # Set when pruned for a dead token
+    deactivation_reason = db.Column(db.String(128), nullable=True)
+    last_alert_sent_at = db.Column(db.DateTime, nullable=True)  # Claimed by the last capped alert fan-out
 
     def as_dict(self):
         return {
@@ -119,12 +166,25 @@ class Device(db.Model):
             'device_type': self.device_type,
             'location': self.location,
             'registered_at': self.registered_at.isoformat(),
-            'is_active': self.is_active
+            'is_active': self.is_active,
+            'push_failures': self.push_failures or 0,
+            'last_push_error': self.last_push_error,
+            'deactivation_reason': self.deactivation_reason,
+            'last_alert_sent_at': self.last_alert_sent_at.isoformat() if self.last_alert_sent_at else None
         }
 
 # --- New Models for Logging ---
 class PushNotificationLog(db.Model):
+    # Fan-out rows only carry campaign_id/device_id/ticket_id/status; the content lives on NotificationCampaign
+    __table_args__ = (
+        db.Index('ix_push_notification_log_campaign', 'campaign_id'),
+        db.Index('ix_push_notification_log_ticket', 'ticket_id'),
+        db.Index('ix_push_notification_log_receipt_pending', 'receipt_checked_at', 'status', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, nullable=True)
+    ticket_id = db.Column(db.String(64), nullable=True)  # Expo push ticket, used to fetch the receipt
+    receipt_checked_at = db.Column(db.DateTime, nullable=True)  # Set once the receipt is recorded (or given up on)
     device_id = db.Column(db.Integer, nullable=True)
     push_token = db.Column(db.String(512), nullable=True)
     platform = db.Column(db.String(32), nullable=True)
@@ -139,6 +199,9 @@ class PushNotificationLog(db.Model):
     def as_dict(self):
         return {
             'id': self.id,
+            'campaign_id': self.campaign_id,
+            'ticket_id': self.ticket_id,
+            'receipt_checked_at': self.receipt_checked_at.isoformat() if self.receipt_checked_at else None,
             'device_id': self.device_id,
             'push_token': self.push_token,
             'platform': self.platform,
@@ -221,12 +284,382 @@ class CommitInfo(db.Model):
             'last_updated': self.last_updated.isoformat()
         }
 
+class ProviderQuota(db.Model):
+    """Shared call budget for an upstream provider (one row per provider, used by every worker)"""
+    id = db.Column(db.Integer, primary_key=True)
+    provider = db.Column(db.String(32), unique=True, nullable=False)  # 'weatherapi', 'weatherkit', 'expo'
+    minute_tokens = db.Column(db.Float, nullable=False, default=0)  # Token bucket for the per-minute limit
+    minute_refilled_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    day_window = db.Column(db.String(10), nullable=False)  # UTC date (YYYY-MM-DD) the day counter belongs to
+    day_calls = db.Column(db.Integer, nullable=False, default=0)
+    denied_calls = db.Column(db.Integer, nullable=False, default=0)  # Calls refused today
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'provider': self.provider,
+            'minute_tokens': self.minute_tokens,
+            'minute_refilled_at': self.minute_refilled_at.isoformat(),
+            'day_window': self.day_window,
+            'day_calls': self.day_calls,
+            'denied_calls': self.denied_calls,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class ForecastCache(db.Model):
+    """Forecasted daily high for one location/day, kept so later checks can skip the upstream call"""
+    id = db.Column(db.Integer, primary_key=True)
+    location_key = db.Column(db.String(128), nullable=False)  # normalize_location_key(location)
+    source = db.Column(db.String(32), nullable=False)  # 'WeatherKit', 'WeatherAPI.com'
+    forecast_date = db.Column(db.String(10), nullable=False)  # Local date (YYYY-MM-DD) of the forecast day
+    high_temp_f = db.Column(db.Float, nullable=False)
+    issued_at = db.Column(db.DateTime, nullable=True)  # When the provider produced the forecast
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow)
+    timezone_name = db.Column(db.String(64), nullable=True)  # Location's tz, used to work out its local "today"
+    lookahead_checked_at = db.Column(db.DateTime, nullable=True)  # Last early-alert evaluation of this day
+    early_alert_sent_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        db.UniqueConstraint('location_key', 'source', 'forecast_date', name='uq_forecast_cache_day'),
+    )
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'location_key': self.location_key,
+            'source': self.source,
+            'forecast_date': self.forecast_date,
+            'high_temp_f': self.high_temp_f,
+            'issued_at': self.issued_at.isoformat() if self.issued_at else None,
+            'fetched_at': self.fetched_at.isoformat(),
+            'timezone_name': self.timezone_name,
+            'lookahead_checked_at': self.lookahead_checked_at.isoformat() if self.lookahead_checked_at else None,
+            'early_alert_sent_at': self.early_alert_sent_at.isoformat() if self.early_alert_sent_at else None
+        }
+
+class LocationCheckState(db.Model):
+    """Delta-run record: the forecast fingerprint each location was last evaluated against"""
+    id = db.Column(db.Integer, primary_key=True)
+    location_key = db.Column(db.String(128), unique=True, nullable=False)  # normalize_location_key(location)
+    location = db.Column(db.String(128), nullable=False)
+    forecast_date = db.Column(db.String(10), nullable=True)
+    forecast_fingerprint = db.Column(db.String(40), nullable=True)  # sha1 of source/date/high/threshold (+ WeatherKit readTime)
+    high_temp_f = db.Column(db.Float, nullable=True)
+    avg_temp_f = db.Column(db.Float, nullable=True)
+    alerted = db.Column(db.Boolean, default=False)
+    evaluated_at = db.Column(db.DateTime, nullable=True)  # Last run that evaluated (and possibly notified)
+    last_run_at = db.Column(db.DateTime, nullable=True)  # Last run that looked at this location
+    skipped_runs = db.Column(db.Integer, default=0)  # Runs skipped since the last evaluation
+    check_interval_minutes = db.Column(db.Integer, nullable=True)  # Adaptive cadence (hourly near the threshold, daily far below)
+    next_check_at = db.Column(db.DateTime, nullable=True)  # Runs before this leave the location alone
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'location_key': self.location_key,
+            'location': self.location,
+            'forecast_date': self.forecast_date,
+            'forecast_fingerprint': self.forecast_fingerprint,
+            'high_temp_f': self.high_temp_f,
+            'avg_temp_f': self.avg_temp_f,
+            'alerted': self.alerted,
+            'evaluated_at': self.evaluated_at.isoformat() if self.evaluated_at else None,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'skipped_runs': self.skipped_runs,
+            'check_interval_minutes': self.check_interval_minutes,
+            'next_check_at': self.next_check_at.isoformat() if self.next_check_at else None
+        }
+
+class EmailOutbox(db.Model):
+    """Outbound email queued by request paths and delivered by the background dispatcher"""
+    __table_args__ = (db.Index('ix_email_outbox_due', 'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), default='alert')  # 'alert', 'welcome', 'order', ...
+    sender = db.Column(db.String(120), nullable=True)  # Defaults to MAIL_DEFAULT_SENDER
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=True)  # Plain text part
+    html = db.Column(db.Text, nullable=True)  # HTML part
+    unsubscribe_url = db.Column(db.String(512), nullable=True)  # Sent as List-Unsubscribe (RFC 8058 one-click)
+    status = db.Column(db.String(16), default='pending')  # 'pending', 'sending', 'sent', 'failed'
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claim_token = db.Column(db.String(32), nullable=True)  # Set by the dispatcher that claimed the row
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'recipient': self.recipient,
+            'subject': self.subject,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None
+        }
+
+class BounceEvent(db.Model):
+    """A processed bounce or complaint; the unique key makes re-reading a mailbox idempotent"""
+    __table_args__ = (db.UniqueConstraint('message_key', 'email', name='uq_bounce_event'),)
+    id = db.Column(db.Integer, primary_key=True)
+    message_key = db.Column(db.String(255), nullable=False)  # Message-ID of the DSN, or outbox row
+    email = db.Column(db.String(256), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # 'hard', 'soft' or 'complaint'
+    status = db.Column(db.String(16), nullable=True)  # Enhanced status code, e.g. 5.1.1
+    reason = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'email': self.email,
+            'kind': self.kind,
+            'status': self.status,
+            'reason': self.reason,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class DigestEntry(db.Model):
+    """An alert held back for a digest-mode subscriber until their digest window closes"""
+    __table_args__ = (db.Index('ix_digest_entry_pending', 'digest_sent_at', 'email'),)
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(256), nullable=False)
+    location = db.Column(db.String(128), nullable=False)
+    current_temp = db.Column(db.Float, nullable=False)
+    avg_temp = db.Column(db.Float, nullable=False)
+    years = db.Column(db.Integer, default=30)
+    day_label = db.Column(db.String(16), default='Today')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    digest_sent_at = db.Column(db.DateTime, nullable=True)  # Set when claimed into a digest email
+    digest_token = db.Column(db.String(32), nullable=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'email': self.email,
+            'location': self.location,
+            'current_temp': self.current_temp,
+            'avg_temp': self.avg_temp,
+            'years': self.years,
+            'day_label': self.day_label,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'digest_sent_at': self.digest_sent_at.isoformat() if self.digest_sent_at else None
+        }
+
+class ServiceLease(db.Model):
+    """A named leader lease, so a background job runs in exactly one process across workers and instances"""
+    name = db.Column(db.String(64), primary_key=True)  # e.g. 'receipt_fetcher'
+    holder = db.Column(db.String(128), nullable=True)  # host:pid:nonce of the current leader
+    expires_at = db.Column(db.DateTime, nullable=False)
+    last_run_started_at = db.Column(db.DateTime, nullable=True)
+    last_run_finished_at = db.Column(db.DateTime, nullable=True)
+    last_run_summary = db.Column(db.Text, nullable=True)  # JSON returned by the job
+    last_error = db.Column(db.Text, nullable=True)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'holder': self.holder,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'last_run_started_at': self.last_run_started_at.isoformat() if self.last_run_started_at else None,
+            'last_run_finished_at': self.last_run_finished_at.isoformat() if self.last_run_finished_at else None,
+            'last_run_summary': json.loads(self.last_run_summary) if self.last_run_summary else None,
+            'last_error': self.last_error
+        }
+
+class NotificationCampaign(db.Model):
+    """One push send (alert or manual): the content once, plus aggregate delivery counters"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), default='alert')  # 'alert', 'early_alert', 'test' or 'manual'
+    location = db.Column(db.String(128), nullable=True)  # None for sends to every device
+    title = db.Column(db.String(256), nullable=True)
+    body = db.Column(db.String(1024), nullable=True)
+    data = db.Column(db.Text, nullable=True)  # JSON payload sent with every message
+    total = db.Column(db.Integer, default=0)
+    successful = db.Column(db.Integer, default=0)  # Accepted by Expo (ok ticket)
+    failed = db.Column(db.Integer, default=0)
+    delivered = db.Column(db.Integer, default=0)  # Confirmed by receipt
+    delivery_errors = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'location': self.location,
+            'title': self.title,
+            'body': self.body,
+            'data': self.data,
+            'total': self.total,
+            'successful': self.successful,
+            'failed': self.failed,
+            'delivered': self.delivered,
+            'delivery_errors': self.delivery_errors,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+class PushRetry(db.Model):
+    """Devices a push send failed to reach, waiting to be re-sent with exponential backoff"""
+    __table_args__ = (db.Index('ix_push_retry_due', 'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, nullable=False)  # Content comes from the NotificationCampaign
+    platform = db.Column(db.String(32), nullable=False)  # 'expo', 'apns' or 'fcm'
+    device_ids = db.Column(db.Text, nullable=False)  # JSON list of Device ids still to reach
+    priority = db.Column(db.Integer, default=0)  # Lane priority: 0 = alert, claimed before bulk (1)
+    status = db.Column(db.String(16), default='pending')  # 'pending' or 'sending'
+    attempts = db.Column(db.Integer, default=0)  # Retries made so far
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claim_token = db.Column(db.String(32), nullable=True)  # Set by the dispatcher that claimed the row
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'campaign_id': self.campaign_id,
+            'platform': self.platform,
+            'devices': len(json.loads(self.device_ids or '[]')),
+            'priority': self.priority,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class PushDeadLetter(db.Model):
+    """A push retry that ran out of attempts, kept for inspection and manual requeue"""
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, nullable=False)
+    platform = db.Column(db.String(32), nullable=False)
+    device_ids = db.Column(db.Text, nullable=False)  # JSON list of Device ids never reached
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    first_failed_at = db.Column(db.DateTime, nullable=True)  # When the original send failed
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'campaign_id': self.campaign_id,
+            'platform': self.platform,
+            'devices': len(json.loads(self.device_ids or '[]')),
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'first_failed_at': self.first_failed_at.isoformat() if self.first_failed_at else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+def normalize_location_key(location):
+    """Canonical form of a free-text location used as a lookup key ('  New  york ' -> 'new york')"""
+    return ' '.join((location or '').strip().lower().split())
+
 # --- Initialize DB ---
 # Remove the @app.before_first_request decorator and function
 # Instead, use app.app_context() at startup
 with app.app_context():
     db.create_all()
 
+# Columns added to tables after they were first created: (table, column, SQL type).
+# db.create_all() only creates missing tables, so these are applied at startup and by /api/migrate-db.
+SCHEMA_COLUMN_MIGRATIONS = [
+    ('forecast_cache', 'timezone_name', 'VARCHAR(64)'),
+    ('forecast_cache', 'lookahead_checked_at', 'TIMESTAMP'),
+    ('forecast_cache', 'early_alert_sent_at', 'TIMESTAMP'),
+    ('location_check_state', 'check_interval_minutes', 'INTEGER'),
+    ('location_check_state', 'next_check_at', 'TIMESTAMP'),
+    ('subscriber', 'delivery_mode', "VARCHAR(16) DEFAULT 'instant'"),
+    ('subscriber', 'suppressed', 'BOOLEAN DEFAULT FALSE'),
+    ('subscriber', 'suppressed_at', 'TIMESTAMP'),
+    ('subscriber', 'suppression_reason', 'VARCHAR(255)'),
+    ('subscriber', 'hard_bounces', 'INTEGER DEFAULT 0'),
+    ('subscriber', 'soft_bounces', 'INTEGER DEFAULT 0'),
+    ('subscriber', 'last_bounce_at', 'TIMESTAMP'),
+    ('device', 'location_key', 'VARCHAR(128)'),
+    ('device', 'push_failures', 'INTEGER DEFAULT 0'),
+    ('device', 'last_push_error', 'VARCHAR(64)'),
+    ('device', 'deactivated_at', 'TIMESTAMP'),
+    ('device', 'deactivation_reason', 'VARCHAR(128)'),
+    ('device', 'last_alert_sent_at', 'TIMESTAMP'),
+    ('push_notification_log', 'campaign_id', 'INTEGER'),
+    ('push_notification_log', 'ticket_id', 'VARCHAR(64)'),
+    ('push_notification_log', 'receipt_checked_at', 'TIMESTAMP'),
+    ('push_retry', 'priority', 'INTEGER DEFAULT 0'),
+    ('email_outbox', 'unsubscribe_url', 'VARCHAR(512)'),
+]
+
+# Indexes declared on models after their table already existed: (index name, table, columns)
+SCHEMA_INDEX_MIGRATIONS = [
+    ('ix_subscriber_suppressed_location', 'subscriber', ('suppressed', 'location')),
+    ('ix_device_active_location_platform', 'device', ('is_active', 'location_key', 'platform', 'id')),
+    ('ix_device_active_platform', 'device', ('is_active', 'platform', 'id')),
+    ('ix_push_notification_log_campaign', 'push_notification_log', ('campaign_id',)),
+    ('ix_push_notification_log_ticket', 'push_notification_log', ('ticket_id',)),
+    ('ix_push_notification_log_receipt_pending', 'push_notification_log', ('receipt_checked_at', 'status', 'id')),
+]
+
+def add_missing_columns():
+    """Apply SCHEMA_COLUMN_MIGRATIONS to existing tables, returning the columns added"""
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    added = []
+    for table, column, column_type in SCHEMA_COLUMN_MIGRATIONS:
+        if not inspector.has_table(table):
+            continue  # db.create_all() builds it with every column
+        if column in [c['name'] for c in inspector.get_columns(table)]:
+            continue
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+        db.session.commit()
+        added.append(f"{table}.{column}")
+        print(f"✅ Successfully added '{column}' column to {table} table")
+    return added
+
+def add_missing_indexes():
+    """Apply SCHEMA_INDEX_MIGRATIONS to existing tables, returning the indexes added"""
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    added = []
+    for name, table, columns in SCHEMA_INDEX_MIGRATIONS:
+        if not inspector.has_table(table):
+            continue
+        if name in [index['name'] for index in inspector.get_indexes(table)]:
+            continue
+        db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+        db.session.commit()
+        added.append(name)
+        print(f"✅ Successfully added index {name} on {table}")
+    return added
+
+def backfill_device_location_keys():
+    """Fill Device.location_key for devices registered before the column existed, returning rows updated"""
+    updated = 0
+    for (location,) in db.session.query(Device.location).filter(Device.location_key == None).distinct().all():
+        updated += Device.query.filter(Device.location_key == None, Device.location == location).update(
+            {Device.location_key: normalize_location_key(location)}, synchronize_session=False)
+    db.session.commit()
+    if updated:
+        print(f"✅ Backfilled location_key on {updated} devices")
+    return updated
+
+with app.app_context():
+    try:
+        add_missing_columns()
+        add_missing_indexes()
+        backfill_device_location_keys()
+    except Exception as e:
+        # Another worker may be applying the same migration; /api/migrate-db can be re-run
+        db.session.rollback()
+        print(f"⚠️ Startup schema migration failed: {e}")
+
 # Weather API configuration
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 WEATHER_BASE_URL = "http://api.weatherapi.com/v1"
@@ -239,6 +672,276 @@ WEATHERKIT_ENABLED = os.getenv('WEATHERKIT_ENABLED', 'false').lower() == 'true'
 TEMP_THRESHOLD = int(os.getenv('TEMP_THRESHOLD', '1'))  # degrees Fahrenheit above average
 CHECK_FREQUENCY = os.getenv('CHECK_FREQUENCY', 'hourly')  # 'hourly' or 'daily'
 
+# Adaptive per-location cadence: locations whose forecast high sits at least CADENCE_FAR_MARGIN_F
+# below the alert line (average + threshold) are rechecked daily, everything else hourly.
+CADENCE_FAR_MARGIN_F = float(os.getenv('CADENCE_FAR_MARGIN_F', '10'))
+CADENCE_NEAR_MINUTES = int(os.getenv('CADENCE_NEAR_MINUTES', '60'))
+CADENCE_FAR_MINUTES = int(os.getenv('CADENCE_FAR_MINUTES', '1440'))
+CADENCE_SLACK_MINUTES = 5  # So a scheduler firing a few seconds early doesn't miss a due location
+
+# --- Provider Quota Budgeter ---
+# Per-provider call budgets shared by all gunicorn workers and Cloud Run instances through
+# the ProviderQuota table. The per-minute limit is a token bucket; the per-day limit is a
+# counter that resets at UTC midnight. A limit of 0 means "unlimited".
+PROVIDER_QUOTAS = {
+    'weatherapi': {
+        'per_minute': int(os.getenv('WEATHERAPI_CALLS_PER_MINUTE', '600')),
+        'per_day': int(os.getenv('WEATHERAPI_CALLS_PER_DAY', '30000'))
+    },
+    'weatherkit': {
+        'per_minute': int(os.getenv('WEATHERKIT_CALLS_PER_MINUTE', '300')),
+        'per_day': int(os.getenv('WEATHERKIT_CALLS_PER_DAY', '16000'))
+    },
+    'expo': {
+        'per_minute': int(os.getenv('EXPO_CALLS_PER_MINUTE', '360')),  # 100-message batches, ~600 msgs/sec
+        'per_day': int(os.getenv('EXPO_CALLS_PER_DAY', '100000'))
+    }
+}
+QUOTA_MAX_WAIT_SECONDS = float(os.getenv('QUOTA_MAX_WAIT_SECONDS', '10'))  # How long to wait for minute tokens
+HISTORY_YEARS = 30
+LOCATION_CHECK_COST = 1 + HISTORY_YEARS  # One forecast call plus one history call per year
+
+class ProviderQuotaExceeded(Exception):
+    """Raised when an upstream provider's shared call budget is exhausted"""
+    def __init__(self, provider, message=None):
+        self.provider = provider
+        super().__init__(message or f'{provider} call budget exhausted')
+
+def _refill_provider_quota(row, limits, now):
+    """Return (minute_tokens, day_window, day_calls) for a quota row refilled up to now"""
+    per_minute = limits['per_minute']
+    tokens = row['minute_tokens']
+    if per_minute:
+        elapsed = max((now - row['minute_refilled_at']).total_seconds(), 0)
+        tokens = min(float(per_minute), tokens + elapsed * per_minute / 60.0)
+    today = now.strftime('%Y-%m-%d')
+    day_calls = row['day_calls'] if row['day_window'] == today else 0
+    return tokens, today, day_calls
+
+def _take_provider_tokens(provider, calls, limits, reserve=0.0):
+    """Atomically take tokens from the shared bucket. Returns (granted, seconds_until_retry)
+
+    `reserve` is the fraction of the minute and day budgets the caller must leave untouched.
+    """
+    from sqlalchemy import select, insert, update
+    table = ProviderQuota.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        row = conn.execute(
+            select(table).where(table.c.provider == provider).with_for_update()
+        ).mappings().first()
+        if row is None:
+            conn.execute(insert(table).values(
+                provider=provider,
+                minute_tokens=float(limits['per_minute']),
+                minute_refilled_at=now,
+                day_window=now.strftime('%Y-%m-%d'),
+                day_calls=0,
+                denied_calls=0,
+                updated_at=now
+            ))
+            row = conn.execute(
+                select(table).where(table.c.provider == provider).with_for_update()
+            ).mappings().first()
+        tokens, today, day_calls = _refill_provider_quota(row, limits, now)
+        denied_calls = row['denied_calls'] if row['day_window'] == today else 0
+        per_minute, per_day = limits['per_minute'], limits['per_day']
+        minute_reserve, day_reserve = per_minute * reserve, int(per_day * reserve)
+
+        retry_after = None
+        if per_day and day_calls + calls > per_day - day_reserve:
+            granted = False  # Nothing refills until tomorrow
+        elif per_minute and tokens - minute_reserve < calls:
+            granted = False
+            retry_after = (calls + minute_reserve - tokens) * 60.0 / per_minute
+        else:
+            granted = True
+            if per_minute:
+                tokens -= calls
+            day_calls += calls
+
+        conn.execute(update(table).where(table.c.provider == provider).values(
+            minute_tokens=tokens,
+            minute_refilled_at=now,
+            day_window=today,
+            day_calls=day_calls,
+            denied_calls=denied_calls if granted else denied_calls + calls,
+            updated_at=now
+        ))
+    return granted, retry_after
+
+def acquire_provider_quota(provider, calls=1, max_wait=None, reserve=0.0):
+    """Reserve calls against a provider's shared budget, waiting briefly for minute tokens.
+
+    Returns False when the daily budget is spent or minute tokens don't free up within
+    max_wait seconds. Accounting failures fail open so a DB hiccup never blocks alerts.
+    Low-priority callers pass `reserve` to leave that fraction of the budget for everyone else.
+    """
+    limits = PROVIDER_QUOTAS.get(provider)
+    if not limits or (not limits['per_minute'] and not limits['per_day']):
+        return True
+    if max_wait is None:
+        max_wait = QUOTA_MAX_WAIT_SECONDS
+    deadline = time.time() + max_wait
+    while True:
+        try:
+            granted, retry_after = _take_provider_tokens(provider, calls, limits, reserve)
+        except Exception as e:
+            print(f"⚠️ Quota accounting failed for {provider}, allowing call: {e}")
+            return True
+        if granted:
+            return True
+        if retry_after is None or time.time() + retry_after > deadline:
+            print(f"⏳ {provider} quota exhausted ({calls} call(s) refused)")
+            return False
+        time.sleep(retry_after)
+
+def get_provider_quota_status(provider):
+    """Remaining budget for a provider without consuming anything"""
+    limits = PROVIDER_QUOTAS.get(provider, {'per_minute': 0, 'per_day': 0})
+    now = datetime.utcnow()
+    status = {
+        'provider': provider,
+        'per_minute_limit': limits['per_minute'],
+        'per_day_limit': limits['per_day'],
+        'minute_remaining': limits['per_minute'] or None,
+        'day_remaining': limits['per_day'] or None,
+        'day_calls': 0,
+        'denied_calls': 0,
+        'updated_at': None
+    }
+    try:
+        quota = ProviderQuota.query.filter_by(provider=provider).first()
+    except Exception as e:
+        print(f"⚠️ Could not read quota for {provider}: {e}")
+        return status
+    if quota:
+        row = {
+            'minute_tokens': quota.minute_tokens,
+            'minute_refilled_at': quota.minute_refilled_at,
+            'day_window': quota.day_window,
+            'day_calls': quota.day_calls
+        }
+        tokens, today, day_calls = _refill_provider_quota(row, limits, now)
+        status['day_calls'] = day_calls
+        status['denied_calls'] = quota.denied_calls if quota.day_window == today else 0
+        status['updated_at'] = quota.updated_at.isoformat() if quota.updated_at else None
+        if limits['per_minute']:
+            status['minute_remaining'] = int(tokens)
+        if limits['per_day']:
+            status['day_remaining'] = max(limits['per_day'] - day_calls, 0)
+    return status
+
+def provider_has_budget(provider, calls):
+    """True if the provider's daily budget can still cover the given number of calls"""
+    remaining = get_provider_quota_status(provider)['day_remaining']
+    return remaining is None or remaining >= calls
+
+def provider_request(provider, method, url, **kwargs):
+    """requests.request() guarded by the provider's shared quota"""
+    if not acquire_provider_quota(provider):
+        raise ProviderQuotaExceeded(provider)
+    return requests.request(method, url, **kwargs)
+
+def weather_api_get(endpoint, params, **kwargs):
+    """GET a WeatherAPI.com endpoint (e.g. 'forecast.json') through the quota budgeter"""
+    return provider_request('weatherapi', 'GET', f"{WEATHER_BASE_URL}/{endpoint}", params=params, **kwargs)
+
+# --- Forecast Cache ---
+FORECAST_LOOKAHEAD_DAYS = int(os.getenv('FORECAST_LOOKAHEAD_DAYS', '3'))  # Days requested per WeatherAPI forecast call
+FORECAST_CACHE_MAX_AGE_HOURS = float(os.getenv('FORECAST_CACHE_MAX_AGE_HOURS', '6'))  # Cached WeatherAPI days older than this are refetched
+FORECAST_LOOKAHEAD_MAX_AGE_HOURS = float(os.getenv('FORECAST_LOOKAHEAD_MAX_AGE_HOURS', '25'))  # Days cached ahead of time serve the next daily run
+EARLY_ALERTS_ENABLED = os.getenv('EARLY_ALERTS_ENABLED', 'false').lower() == 'true'  # "Tomorrow will be too hot" alerts
+WEATHERKIT_CACHE_MAX_AGE_HOURS = float(os.getenv('WEATHERKIT_CACHE_MAX_AGE_HOURS', '25'))  # Reuse yesterday's look-ahead at the daily check
+WEATHERKIT_DEFAULT_COORDINATES = (40.7128, -74.0060)  # New York
+WEATHERKIT_DEFAULT_TIMEZONE = os.getenv('WEATHERKIT_DEFAULT_TIMEZONE', 'America/New_York')
+
+def store_forecast_days(location, source, days, issued_at=None, timezone_name=None):
+    """Upsert forecasted daily highs, given as [(YYYY-MM-DD, high_f), ...], into the forecast cache"""
+    location_key = normalize_location_key(location)
+    now = datetime.utcnow()
+    try:
+        existing = {
+            row.forecast_date: row
+            for row in ForecastCache.query.filter(
+                ForecastCache.location_key == location_key,
+                ForecastCache.source == source,
+                ForecastCache.forecast_date.in_([day for day, _ in days])
+            ).all()
+        }
+        for forecast_date, high_temp_f in days:
+            row = existing.get(forecast_date)
+            if row is None:
+                row = ForecastCache(location_key=location_key, source=source, forecast_date=forecast_date)
+                db.session.add(row)
+            if row.high_temp_f != high_temp_f:
+                row.lookahead_checked_at = None  # Forecast moved, early alert needs a fresh look
+            row.high_temp_f = high_temp_f
+            row.issued_at = issued_at
+            row.fetched_at = now
+            row.timezone_name = timezone_name or row.timezone_name
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Could not cache {source} forecast for {location}: {e}")
+
+def get_cached_forecast(location, forecast_date, source, max_age_hours, lookahead_max_age_hours=None):
+    """Cached forecast row for a location/day if it is still fresh, else None.
+
+    A row is fresh if it was fetched within max_age_hours. A row fetched before its day had
+    started at the location (a look-ahead day) is also fresh within lookahead_max_age_hours,
+    so the days cached by one daily run serve the next one.
+    """
+    cutoff = datetime.utcnow() - timedelta(hours=max(max_age_hours, lookahead_max_age_hours or 0))
+    try:
+        row = ForecastCache.query.filter(
+            ForecastCache.location_key == normalize_location_key(location),
+            ForecastCache.source == source,
+            ForecastCache.forecast_date == forecast_date,
+            ForecastCache.fetched_at >= cutoff
+        ).first()
+    except Exception as e:
+        print(f"⚠️ Could not read forecast cache for {location}: {e}")
+        return None
+    if row is None or row.fetched_at >= datetime.utcnow() - timedelta(hours=max_age_hours):
+        return row
+    return row if forecast_fetched_ahead(row) else None
+
+def forecast_fetched_ahead(row):
+    """True if the row was fetched before its forecast day began in the location's timezone"""
+    fetched = timezone('UTC').localize(row.fetched_at)
+    if row.timezone_name:
+        fetched = fetched.astimezone(timezone(row.timezone_name))
+    return fetched.strftime('%Y-%m-%d') < row.forecast_date
+
+def get_location_today(location, source):
+    """Local date at a location, using the timezone remembered from its latest cached forecast"""
+    try:
+        row = ForecastCache.query.filter(
+            ForecastCache.location_key == normalize_location_key(location),
+            ForecastCache.source == source,
+            ForecastCache.timezone_name != None
+        ).order_by(ForecastCache.fetched_at.desc()).first()
+        if row:
+            return datetime.now(timezone(row.timezone_name)).date()
+    except Exception as e:
+        print(f"⚠️ Could not determine local date for {location}: {e}")
+    return datetime.now().date()
+
+def parse_provider_timestamp(value):
+    """Naive UTC datetime from an ISO 8601 string ('2024-07-01T12:00:00Z') or epoch seconds"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.utcfromtimestamp(value)
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone('UTC')).replace(tzinfo=None)
+        return parsed
+    except ValueError:
+        return None
+
 # Printful API configuration
 PRINTFUL_API_KEY = os.getenv('PRINTFUL_API_KEY')
 PRINTFUL_BASE_URL = 'https://api.printful.com'
@@ -739,6 +1442,423 @@ def create_printful_order(order_data):
     except requests.exceptions.RequestException as e:
         raise Exception(f'Network error connecting to Printful: {str(e)}')
 
+# --- Email Outbox ---
+# Request paths only enqueue; a dispatcher thread in each worker drains the table. Rows are claimed
+# with a conditional UPDATE so concurrent workers never deliver the same message twice.
+EMAIL_DISPATCHER_ENABLED = os.getenv('EMAIL_DISPATCHER_ENABLED', 'true').lower() == 'true'
+EMAIL_OUTBOX_POLL_SECONDS = float(os.getenv('EMAIL_OUTBOX_POLL_SECONDS', '5'))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '200'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_BASE_SECONDS = 60  # Backoff doubles per attempt: 1m, 2m, 4m, ...
+EMAIL_RETRY_MAX_SECONDS = 3600
+EMAIL_CLAIM_TIMEOUT_SECONDS = 300  # Claims older than this (crashed worker) are picked up again
+EMAIL_OUTBOX_RETENTION_DAYS = 7  # Sent rows older than this are pruned
+
+# Bulk SMTP: each dispatcher pass logs in once per connection and pushes the whole batch through it
+EMAIL_SMTP_CONNECTIONS = int(os.getenv('EMAIL_SMTP_CONNECTIONS', '2'))
+EMAIL_MAX_PER_CONNECTION = int(os.getenv('EMAIL_MAX_PER_CONNECTION', '100'))  # Reconnect before server limits
+SMTP_RECONNECT_CODES = {421, 451, 452, 454}  # Transient server-side limits worth a fresh connection
+
+smtp_connection_stats = deque(maxlen=50)  # Recently closed connections (throughput per connection)
+smtp_send_latencies = deque(maxlen=10000)  # Milliseconds per accepted message, SMTP send call only (both engines)
+smtp_stats_lock = threading.Lock()
+
+email_outbox_wakeup = threading.Event()
+
+def enqueue_email(recipient, subject, html=None, body=None, kind='alert', sender=None, commit=True,
+                  unsubscribe_url=None):
+    """Queue an email for the background dispatcher (no SMTP on the calling path)"""
+    row = EmailOutbox(
+        kind=kind,
+        sender=sender,
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        html=html,
+        unsubscribe_url=unsubscribe_url,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(row)
+    if commit:
+        db.session.commit()
+        email_outbox_wakeup.set()
+    return row
+
+def claim_outbox_batch(limit=None):
+    """Claim up to `limit` due outbox rows for this dispatcher and return them"""
+    limit = limit or EMAIL_OUTBOX_BATCH_SIZE
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=EMAIL_CLAIM_TIMEOUT_SECONDS)
+    due = db.or_(
+        and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+        and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < stale)
+    )
+    ids = [row_id for (row_id,) in db.session.query(EmailOutbox.id).filter(due)
+           .order_by(EmailOutbox.next_attempt_at).limit(limit).all()]
+    if not ids:
+        return []
+    token = os.urandom(16).hex()
+    # Only rows still due when the UPDATE runs are taken; another worker may have claimed the rest
+    EmailOutbox.query.filter(EmailOutbox.id.in_(ids), due).update(
+        {'status': 'sending', 'claim_token': token, 'claimed_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claim_token=token, status='sending').all()
+
+def build_outbox_message(row):
+    extra_headers = None
+    if row.unsubscribe_url:
+        # RFC 8058: mail clients POST "List-Unsubscribe=One-Click" to the URL without opening it
+        extra_headers = {
+            'List-Unsubscribe': f'<{row.unsubscribe_url}>',
+            'List-Unsubscribe-Post': 'List-Unsubscribe=One-Click'
+        }
+    return Message(
+        subject=row.subject,
+        sender=row.sender or app.config['MAIL_DEFAULT_SENDER'],
+        recipients=[row.recipient],
+        body=row.body,
+        html=row.html,
+        extra_headers=extra_headers
+    )
+
+def smtp_error_code(error):
+    """SMTP reply code from a smtplib or aiosmtplib exception, if it carries one"""
+    code = getattr(error, 'smtp_code', None) or getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+def recipient_refusal_codes(error):
+    """Per-RCPT reply codes from a recipients-refused exception (smtplib or aiosmtplib), else []"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return [code for code, _ in error.recipients.values()]
+    if aiosmtplib and isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return [refusal.code for refusal in error.recipients]
+    if aiosmtplib and isinstance(error, aiosmtplib.SMTPRecipientRefused):
+        return [error.code]
+    return []
+
+def is_permanent_smtp_error(error):
+    codes = recipient_refusal_codes(error)
+    if codes:
+        return all(code >= 500 for code in codes)  # 450/451 at RCPT (greylisting, full mailbox) is worth a retry
+    code = smtp_error_code(error)
+    return code is not None and code >= 500
+
+def is_recipient_refusal(error):
+    """True when the server refused the address itself at RCPT TO (a synchronous hard bounce).
+
+    Only the per-recipient codes count. A rejected MAIL FROM (SMTPSenderRefused) or a rejection
+    at DATA (content/spam filtering) says nothing about the recipient, so those never do.
+    """
+    return any(code in (550, 551, 553) for code in recipient_refusal_codes(error))
+
+def record_outbox_result(row, error=None):
+    """Mark a claimed row sent, or schedule a retry with exponential backoff"""
+    now = datetime.utcnow()
+    row.attempts = (row.attempts or 0) + 1
+    row.claim_token = None
+    row.claimed_at = None
+    if error is None:
+        row.status = 'sent'
+        row.sent_at = now
+        row.last_error = None
+    elif row.attempts >= EMAIL_MAX_ATTEMPTS or is_permanent_smtp_error(error):
+        row.status = 'failed'
+        row.last_error = str(error)[:1000]
+        print(f"❌ Giving up on email {row.id} to {row.recipient} after {row.attempts} attempts: {error}")
+    else:
+        delay = min(EMAIL_RETRY_BASE_SECONDS * (2 ** (row.attempts - 1)), EMAIL_RETRY_MAX_SECONDS)
+        row.status = 'pending'
+        row.next_attempt_at = now + timedelta(seconds=delay)
+        row.last_error = str(error)[:1000]
+        print(f"⚠️ Email {row.id} to {row.recipient} failed (attempt {row.attempts}), retrying in {delay}s: {error}")
+
+def _open_smtp_connection():
+    conn = mail.connect()
+    conn.__enter__()
+    return conn
+
+def _close_smtp_connection(conn, stats, reason):
+    try:
+        conn.__exit__(None, None, None)
+    except Exception:
+        pass  # Server already dropped us
+    elapsed = time.time() - stats['started']
+    stats['seconds'] = round(elapsed, 3)
+    stats['per_second'] = round(stats['messages'] / elapsed, 2) if elapsed > 0 else None
+    stats['closed_reason'] = reason
+    with smtp_stats_lock:
+        smtp_connection_stats.append(stats)
+
+def send_email_batch(messages):
+    """Send (key, Message) pairs over one reused SMTP connection.
+
+    Reconnects after EMAIL_MAX_PER_CONNECTION messages, or when the server drops us or answers
+    with a transient limit code (the message is retried once on the fresh connection).
+    Returns {key: None on success, exception on failure}.
+    """
+    results = {}
+    with app.app_context():
+        conn = stats = None
+        for index, (key, msg) in enumerate(messages):
+            for attempt in range(2):
+                try:
+                    if conn is None:
+                        stats = {'opened_at': datetime.utcnow().isoformat(), 'started': time.time(),
+                                 'messages': 0, 'errors': 0}
+                        conn = _open_smtp_connection()
+                except Exception as e:
+                    # Can't connect or log in: everything left in this batch waits for the retry backoff
+                    print(f"❌ SMTP connection failed: {e}")
+                    for remaining_key, _ in messages[index:]:
+                        results[remaining_key] = e
+                    return results
+                try:
+                    send_started = time.perf_counter()
+                    conn.send(msg)
+                    smtp_send_latencies.append((time.perf_counter() - send_started) * 1000)
+                    stats['messages'] += 1
+                    results[key] = None
+                    if stats['messages'] >= EMAIL_MAX_PER_CONNECTION:
+                        _close_smtp_connection(conn, stats, 'max_messages')
+                        conn = None
+                    break
+                except smtplib.SMTPRecipientsRefused as e:
+                    stats['errors'] += 1
+                    results[key] = e
+                    break
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError) as e:
+                    code = getattr(e, 'smtp_code', None)
+                    if code is not None and code not in SMTP_RECONNECT_CODES:
+                        stats['errors'] += 1
+                        results[key] = e  # Permanent rejection of this message
+                        break
+                    _close_smtp_connection(conn, stats, f'server: {code or type(e).__name__}')
+                    conn = None
+                    if attempt == 1:
+                        results[key] = e
+                except Exception as e:
+                    stats['errors'] += 1
+                    results[key] = e
+                    break
+        if conn is not None:
+            _close_smtp_connection(conn, stats, 'batch_done')
+    return results
+
+def send_email_bulk(messages, connections=None):
+    """Spread (key, Message) pairs over a small pool of SMTP connections"""
+    connections = max(1, min(connections or EMAIL_SMTP_CONNECTIONS, len(messages)))
+    if connections == 1:
+        return send_email_batch(messages)
+    chunks = [messages[i::connections] for i in range(connections)]
+    results = {}
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        for chunk_results in pool.map(send_email_batch, chunks):
+            results.update(chunk_results)
+    return results
+
+# --- Async SMTP Engine ---
+# Holds EMAIL_ASYNC_CONNECTIONS authenticated aiosmtplib connections open at once, each paced to
+# EMAIL_PER_CONNECTION_RATE messages/sec, and drains a batch through them in parallel.
+EMAIL_ASYNC_ENGINE = os.getenv('EMAIL_ASYNC_ENGINE', 'false').lower() == 'true'
+EMAIL_ASYNC_CONNECTIONS = int(os.getenv('EMAIL_ASYNC_CONNECTIONS', '8'))
+EMAIL_PER_CONNECTION_RATE = float(os.getenv('EMAIL_PER_CONNECTION_RATE', '0'))  # 0 = unpaced
+
+def smtp_settings():
+    """Connection settings for the async engine, taken from the Flask-Mail config"""
+    return {
+        'hostname': app.config['MAIL_SERVER'],
+        'port': app.config['MAIL_PORT'],
+        'use_tls': bool(app.config.get('MAIL_USE_SSL')),
+        'start_tls': bool(app.config.get('MAIL_USE_TLS')),
+        'username': app.config.get('MAIL_USERNAME'),
+        'password': app.config.get('MAIL_PASSWORD')
+    }
+
+def serialize_message(key, msg):
+    """(key, sender, recipients, bytes) for the async engine; needs an app context"""
+    return key, msg.sender, list(msg.send_to), msg.as_bytes()
+
+async def _async_smtp_worker(queue, results, settings, rate):
+    interval = 1.0 / rate if rate else 0
+    smtp = stats = None
+    next_send = 0.0
+    loop = asyncio.get_running_loop()
+
+    async def close(reason):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+        elapsed = time.time() - stats['started']
+        stats['seconds'] = round(elapsed, 3)
+        stats['per_second'] = round(stats['messages'] / elapsed, 2) if elapsed > 0 else None
+        stats['closed_reason'] = reason
+        stats['engine'] = 'async'
+        with smtp_stats_lock:
+            smtp_connection_stats.append(stats)
+
+    while True:
+        try:
+            key, sender, recipients, data = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        for attempt in range(2):
+            if smtp is None:
+                stats = {'opened_at': datetime.utcnow().isoformat(), 'started': time.time(),
+                         'messages': 0, 'errors': 0}
+                smtp = aiosmtplib.SMTP(**settings)
+                try:
+                    await smtp.connect()
+                except Exception as e:
+                    # Can't connect or log in: fail this message and retire the worker; the others keep draining
+                    print(f"❌ Async SMTP connection failed: {e}")
+                    smtp = None
+                    results[key] = e
+                    return
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_send = loop.time() + interval
+            try:
+                send_started = time.perf_counter()
+                await smtp.sendmail(sender, recipients, data)
+                smtp_send_latencies.append((time.perf_counter() - send_started) * 1000)
+                stats['messages'] += 1
+                results[key] = None
+                if stats['messages'] >= EMAIL_MAX_PER_CONNECTION:
+                    await close('max_messages')
+                    smtp = None
+                break
+            except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPRecipientRefused) as e:
+                stats['errors'] += 1
+                results[key] = e
+                break
+            except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPTimeoutError,
+                    aiosmtplib.SMTPResponseException, OSError) as e:
+                code = smtp_error_code(e)
+                if code is not None and code not in SMTP_RECONNECT_CODES:
+                    stats['errors'] += 1
+                    results[key] = e
+                    break
+                await close(f'server: {code or type(e).__name__}')
+                smtp = None
+                if attempt == 1:
+                    results[key] = e
+            except Exception as e:
+                stats['errors'] += 1
+                results[key] = e
+                break
+    if smtp is not None:
+        await close('batch_done')
+
+async def _send_email_async(messages, connections, rate, settings):
+    queue = asyncio.Queue()
+    for item in messages:
+        queue.put_nowait(item)
+    results = {}
+    await asyncio.gather(*[
+        _async_smtp_worker(queue, results, settings, rate)
+        for _ in range(max(1, min(connections, len(messages))))
+    ])
+    # Anything still queued means every connection failed; it goes back for a later retry
+    while not queue.empty():
+        key = queue.get_nowait()[0]
+        results.setdefault(key, Exception('no SMTP connection available'))
+    return results
+
+def send_email_async(messages, connections=None, rate=None, settings=None):
+    """Send serialized (key, sender, recipients, bytes) tuples over parallel async connections.
+
+    Returns {key: None on success, exception on failure}, like send_email_bulk().
+    """
+    if aiosmtplib is None:
+        raise RuntimeError('aiosmtplib is not installed')
+    if not messages:
+        return {}
+    return asyncio.run(_send_email_async(
+        messages,
+        connections or EMAIL_ASYNC_CONNECTIONS,
+        EMAIL_PER_CONNECTION_RATE if rate is None else rate,
+        settings or smtp_settings()
+    ))
+
+def dispatch_email_outbox():
+    """Deliver one claimed batch from the outbox. Returns the number of rows processed."""
+    with app.app_context():
+        rows = claim_outbox_batch()
+        if not rows:
+            return 0
+        if EMAIL_ASYNC_ENGINE and aiosmtplib is not None:
+            results = send_email_async([serialize_message(row.id, build_outbox_message(row)) for row in rows])
+        else:
+            results = send_email_bulk([(row.id, build_outbox_message(row)) for row in rows])
+        refused = []
+        for row in rows:
+            error = results.get(row.id, Exception('not attempted'))
+            record_outbox_result(row, error)
+            if error is not None and is_recipient_refusal(error):
+                refused.append((row.id, row.recipient, str(error)[:500]))
+        db.session.commit()
+        for row_id, recipient, reason in refused:
+            record_bounce(recipient, 'hard', reason, message_key=f'outbox:{row_id}')
+        sent = sum(1 for error in results.values() if error is None)
+        print(f"📧 Email dispatcher sent {sent}/{len(rows)} messages")
+        return len(rows)
+
+def prune_email_outbox():
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)
+        EmailOutbox.query.filter(EmailOutbox.status == 'sent', EmailOutbox.sent_at < cutoff).delete(
+            synchronize_session=False
+        )
+        DigestEntry.query.filter(DigestEntry.digest_sent_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+def get_email_outbox_status():
+    counts = dict(db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id))
+                  .group_by(EmailOutbox.status).all())
+    oldest = db.session.query(db.func.min(EmailOutbox.created_at)).filter(
+        EmailOutbox.status.in_(['pending', 'sending'])
+    ).scalar()
+    return {
+        'pending': counts.get('pending', 0),
+        'sending': counts.get('sending', 0),
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'oldest_pending': oldest.isoformat() if oldest else None
+    }
+
+def start_email_dispatcher():
+    def run():
+        last_prune = 0
+        last_digest_flush = time.time()
+        last_bounce_check = time.time()
+        while True:
+            try:
+                # Keep draining while there is a backlog; otherwise sleep until woken or the poll interval
+                if dispatch_email_outbox() >= EMAIL_OUTBOX_BATCH_SIZE:
+                    continue
+                if time.time() - last_digest_flush > DIGEST_FLUSH_INTERVAL_SECONDS:
+                    flush_due_digests()
+                    last_digest_flush = time.time()
+                if BOUNCE_MAILBOX and time.time() - last_bounce_check > BOUNCE_POLL_SECONDS:
+                    ingest_bounces()
+                    last_bounce_check = time.time()
+                if time.time() - last_prune > 3600:
+                    prune_email_outbox()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"[ERROR] in email dispatcher: {e}")
+            email_outbox_wakeup.wait(EMAIL_OUTBOX_POLL_SECONDS)
+            email_outbox_wakeup.clear()
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    atexit.register(lambda: t.join(timeout=1))
+
 def send_order_confirmation(order_data):
     """Send order confirmation email"""
     try:
@@ -766,9 +1886,9 @@ def send_order_confirmation(order_data):
         Thank you for supporting climate awareness!
         """
         
-        mail.send(msg)
+        enqueue_email(order_data['email'], msg.subject, body=msg.body, kind='order', sender=msg.sender)
     except Exception as e:
-        print(f"Failed to send confirmation email: {e}")
+        print(f"Failed to queue confirmation email: {e}")
 
 def send_welcome_email(email, location):
     """Send welcome email to new subscriber (HTML + plain text fallback)"""
@@ -804,17 +1924,10 @@ def send_welcome_email(email, location):
         """
         # HTML body using new template
         html_body = render_template('welcome_email.html', location=location)
-        msg = Message(
-            subject=subject,
-            sender=app.config['MAIL_USERNAME'],
-            recipients=[email],
-            body=body,
-            html=html_body
-        )
-        mail.send(msg)
-        print(f"Welcome email sent to {email}")
+        enqueue_email(email, subject, html=html_body, body=body, kind='welcome', sender=app.config['MAIL_USERNAME'])
+        print(f"Welcome email queued for {email}")
     except Exception as e:
-        print(f"Failed to send welcome email to {email}: {e}")
+        print(f"Failed to queue welcome email to {email}: {e}")
 
 # --- Update /api/subscribe to use DB ---
 @app.route('/api/subscribe', methods=['POST'])
@@ -828,10 +1941,14 @@ def subscribe():
     if Subscriber.query.filter_by(email=email).first():
         return jsonify({'error': 'Email already subscribed'}), 409
     location = data.get('location', 'auto')
+    delivery_mode = data.get('delivery_mode', 'instant')
+    if delivery_mode not in ('instant', 'digest'):
+        return jsonify({'error': "delivery_mode must be 'instant' or 'digest'"}), 400
     subscriber = Subscriber(
         email=email,
         location=location,
-        subscribed_at=datetime.now().isoformat()
+        subscribed_at=datetime.now().isoformat(),
+        delivery_mode=delivery_mode
     )
     db.session.add(subscriber)
     db.session.commit()
@@ -844,6 +1961,60 @@ def subscribe():
         'email': email
     }), 201
 
+# --- Switch a subscriber between instant alerts and a daily digest ---
+@app.route('/api/delivery-mode', methods=['POST'])
+def set_delivery_mode():
+    data = request.get_json()
+    if not data or 'email' not in data:
+        return jsonify({'error': 'Email is required'}), 400
+    delivery_mode = data.get('delivery_mode')
+    if delivery_mode not in ('instant', 'digest'):
+        return jsonify({'error': "delivery_mode must be 'instant' or 'digest'"}), 400
+    subscriber = Subscriber.query.filter_by(email=data['email'].strip()).first()
+    if not subscriber:
+        return jsonify({'error': 'Subscriber not found'}), 404
+    subscriber.delivery_mode = delivery_mode
+    db.session.commit()
+    return jsonify({
+        'message': f'Delivery mode set to {delivery_mode}',
+        'email': subscriber.email,
+        'delivery_mode': delivery_mode
+    }), 200
+
+# --- Unsubscribe link from alert emails ---
+# GET only shows a confirmation form, so link prefetchers and mail scanners can't unsubscribe anyone.
+# The form, and mail clients using the RFC 8058 List-Unsubscribe-Post header, POST to the same URL.
+@app.route('/unsubscribe/<token>', methods=['GET', 'POST'])
+def unsubscribe_link(token):
+    if not unsubscribe_tokens_enabled():
+        return render_template_string('<p>Unsubscribe links are disabled on this server.</p>'), 400
+    try:
+        email = unsubscribe_serializer.loads(token, max_age=UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS * 86400)
+    except SignatureExpired:
+        return render_template_string(
+            '<p>This unsubscribe link has expired. Use the unsubscribe link on '
+            '<a href="{{ url }}">{{ url }}</a> instead.</p>', url=PUBLIC_BASE_URL
+        ), 400
+    except BadSignature:
+        return render_template_string('<p>This unsubscribe link is invalid.</p>'), 400
+    if request.method == 'GET':
+        return render_template_string(
+            '<form method="post">'
+            '<p>Stop sending IT\'S TOO HOT! alerts to {{ email }}?</p>'
+            '<button type="submit">Unsubscribe</button>'
+            '</form>', email=email
+        )
+    subscriber = Subscriber.query.filter_by(email=email).first()
+    if subscriber:
+        db.session.delete(subscriber)
+        db.session.commit()
+        print(f"📭 Unsubscribed {email} via email link")
+    if request.form.get('List-Unsubscribe') == 'One-Click':
+        return '', 200  # RFC 8058 one-click: the mail client only looks at the status
+    return render_template_string(
+        '<p>{{ email }} has been unsubscribed from IT\'S TOO HOT! alerts.</p>', email=email
+    )
+
 # --- Update /api/unsubscribe to use DB ---
 @app.route('/api/unsubscribe', methods=['POST'])
 def unsubscribe():
@@ -880,15 +2051,21 @@ def register_device():
             existing_device.platform = platform
             existing_device.device_type = device_type
             existing_device.location = location  # Update location
+            existing_device.location_key = normalize_location_key(location)
             existing_device.is_active = True
             existing_device.registered_at = datetime.utcnow()
+            # A fresh registration means the token works again
+            existing_device.push_failures = 0
+            existing_device.deactivated_at = None
+            existing_device.deactivation_reason = None
         else:
             # Create new device
             new_device = Device(
                 push_token=push_token,
                 platform=platform,
                 device_type=device_type,
-                location=location  # Set location
+                location=location,  # Set location
+                location_key=normalize_location_key(location)
             )
             db.session.add(new_device)
         
@@ -975,102 +2152,316 @@ def unregister_device():
     else:
         return jsonify({'error': 'Either push_token or platform/device_type is required'}), 400
 
-@app.route('/api/check-temperatures', methods=['GET'])
-def check_temperatures():
-    """Check forecasted high temperatures and send notifications if conditions are met"""
-    if not WEATHER_API_KEY:
-        return jsonify({'error': 'Weather API key not configured'}), 500
+def get_alert_locations():
+    """Group subscribers by alert location, busiest locations first.
+
+    The order doubles as the run priority: when a provider budget runs out, the
+    locations at the tail of this list are the ones that get deferred.
+    """
+    locations = {}
+    for subscriber in Subscriber.query.filter(Subscriber.suppressed == False).all():
+        location = subscriber.location
+        if location == 'auto':
+            location = 'New York'
+        locations.setdefault(location, []).append(subscriber)
+    return sorted(locations.items(), key=lambda item: len(item[1]), reverse=True)
+
+def get_weatherapi_forecast(location):
+    """Today's forecasted high from WeatherAPI.com, served from the forecast cache when fresh.
+
+    A single call fetches FORECAST_LOOKAHEAD_DAYS days; days 2..N are cached so later
+    runs (including tomorrow's, via FORECAST_LOOKAHEAD_MAX_AGE_HOURS) can skip the upstream
+    call. Returns None on failure.
+    """
+    today = get_location_today(location, 'WeatherAPI.com')
+    cached = get_cached_forecast(location, today.strftime('%Y-%m-%d'), 'WeatherAPI.com',
+                                 FORECAST_CACHE_MAX_AGE_HOURS, FORECAST_LOOKAHEAD_MAX_AGE_HOURS)
+    if cached:
+        return {
+            'location': location,
+            'high_temp_f': cached.high_temp_f,
+            'source': 'WeatherAPI.com',
+            'forecast_date': cached.forecast_date,
+            'issued_at': cached.issued_at.isoformat() if cached.issued_at else None,
+            'cached': True
+        }
+
+    forecast_params = {
+        'key': WEATHER_API_KEY,
+        'q': location,
+        'days': FORECAST_LOOKAHEAD_DAYS,
+        'aqi': 'no',
+        'alerts': 'no'
+    }
+    forecast_response = weather_api_get('forecast.json', forecast_params)
+    if forecast_response.status_code != 200:
+        print(f"Failed to get forecast for {location}: {forecast_response.status_code}")
+        return None
+    forecast_data = forecast_response.json()
+    forecast_days = forecast_data['forecast']['forecastday']
+    days = [(day['date'], day['day']['maxtemp_f']) for day in forecast_days]
+    issued_at = parse_provider_timestamp((forecast_data.get('current') or {}).get('last_updated_epoch'))
+    timezone_name = (forecast_data.get('location') or {}).get('tz_id')
+    store_forecast_days(location, 'WeatherAPI.com', days, issued_at=issued_at, timezone_name=timezone_name)
+    return {
+        'location': location,
+        'high_temp_f': forecast_days[0]['day']['maxtemp_f'],
+        'source': 'WeatherAPI.com',
+        'forecast_date': forecast_days[0]['date'],
+        'issued_at': issued_at.isoformat() if issued_at else None,
+        'cached': False
+    }
+
+def get_historical_average(location, day=None):
+    """Average high (°F) for this calendar day over the last HISTORY_YEARS years, or None"""
+    day = day or datetime.now()
+    historical_temps = []
+    for year in range(1, HISTORY_YEARS + 1):
+        try:
+            historical_date = day.replace(year=day.year - year)
+            historical_params = {
+                'key': WEATHER_API_KEY,
+                'q': location,
+                'dt': historical_date.strftime('%Y-%m-%d')
+            }
+            historical_response = weather_api_get('history.json', historical_params)
+
+            if historical_response.status_code == 200:
+                historical_data = historical_response.json()
+                if 'forecast' in historical_data and historical_data['forecast']['forecastday']:
+                    historical_temp = historical_data['forecast']['forecastday'][0]['day']['maxtemp_f']
+                    historical_temps.append(historical_temp)
+        except ProviderQuotaExceeded:
+            raise
+        except Exception as e:
+            print(f"Error fetching historical data for {location} year {year}: {e}")
+            continue
+    if historical_temps:
+        return sum(historical_temps) / len(historical_temps)
+    return None
+
+def queue_alert_emails(location, subscribers, current_temp, avg_temp, years=30, day_label='Today'):
+    """Queue the alert email for every subscriber of a location in one commit.
+
+    Digest-mode subscribers get a DigestEntry instead, delivered later by flush_due_digests().
+    """
+    for subscriber in subscribers:
+        if subscriber.delivery_mode == 'digest':
+            db.session.add(DigestEntry(
+                email=subscriber.email,
+                location=location,
+                current_temp=current_temp,
+                avg_temp=avg_temp,
+                years=years,
+                day_label=day_label
+            ))
+        else:
+            send_notification(subscriber.email, location, current_temp, avg_temp, years, day_label, commit=False)
+    try:
+        db.session.commit()
+        email_outbox_wakeup.set()
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Could not queue alert emails for {location}: {e}")
+        return 0
+    return len(subscribers)
+
+def send_early_alerts(location, subscribers, source):
+    """Send "tomorrow will be too hot" alerts from the cached look-ahead day (no forecast call).
+
+    Each cached day is evaluated once per forecast value and alerted at most once.
+    """
+    tomorrow = get_location_today(location, source) + timedelta(days=1)
+    max_age = WEATHERKIT_CACHE_MAX_AGE_HOURS if source == 'WeatherKit' else FORECAST_CACHE_MAX_AGE_HOURS
+    cached = get_cached_forecast(location, tomorrow.strftime('%Y-%m-%d'), source, max_age, FORECAST_LOOKAHEAD_MAX_AGE_HOURS)
+    if not cached or cached.early_alert_sent_at or cached.lookahead_checked_at:
+        return []
+    if not provider_has_budget('weatherapi', HISTORY_YEARS):
+        return []
+
+    notifications_sent = []
+    avg_temp = get_historical_average(location, datetime.combine(tomorrow, datetime.min.time()))
+    forecast_temp = cached.high_temp_f
+    if avg_temp is not None and forecast_temp >= avg_temp + TEMP_THRESHOLD:
+        print(f"🌡️ EARLY ALERT: {location} will be {forecast_temp - avg_temp:.1f}°F hotter than average tomorrow!")
+        queue_alert_emails(location, subscribers, forecast_temp, avg_temp, day_label='Tomorrow')
+        for subscriber in subscribers:
+            notifications_sent.append({
+                'email': subscriber.email,
+                'location': location,
+                'current_temp': forecast_temp,
+                'avg_temp': avg_temp,
+                'threshold': TEMP_THRESHOLD,
+                'forecast_date': cached.forecast_date,
+                'early_alert': True
+            })
+        send_push_notification(location, forecast_temp, avg_temp, day_label='Tomorrow', kind='early_alert')
+        cached.early_alert_sent_at = datetime.utcnow()
+    cached.lookahead_checked_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Could not record early alert check for {location}: {e}")
+    return notifications_sent
+
+def evaluate_location_alert(location, subscribers, current_temp, source=None):
+    """Compare a location's forecast high with its historical average and notify if too hot.
+
+    Returns (notifications_sent, avg_temp).
+    """
+    notifications_sent = []
+    avg_temp = get_historical_average(location)
+    if avg_temp is not None:
+        print(f"{location}: Current temp {current_temp}°F, Avg temp {avg_temp:.1f}°F, Diff {current_temp - avg_temp:.1f}°F")
+    else:
+        # Fallback to hardcoded average if historical data fails
+        avg_temp = 85
+        print(f"{location}: Using fallback avg temp {avg_temp}°F")
+
+    # Check if temperature exceeds threshold
+    if current_temp >= avg_temp + TEMP_THRESHOLD:
+        print(f"🌡️ TEMPERATURE ALERT: {location} is {current_temp - avg_temp:.1f}°F hotter than average!")
+
+        queue_alert_emails(location, subscribers, current_temp, avg_temp)
+        for subscriber in subscribers:
+            detail = {
+                'email': subscriber.email,
+                'location': location,
+                'current_temp': current_temp,
+                'avg_temp': avg_temp,
+                'threshold': TEMP_THRESHOLD
+            }
+            if source:
+                detail['source'] = source
+            notifications_sent.append(detail)
+
+        # Send push notification (only once per location)
+        send_push_notification(location, current_temp, avg_temp)
+    else:
+        print(f"No alert for {location}: {current_temp}°F vs {avg_temp:.1f}°F avg (threshold: {TEMP_THRESHOLD}°F)")
+    return notifications_sent, avg_temp
+
+def forecast_fingerprint(forecast):
+    """Identity of a forecast for delta runs: value plus issuance time (and the threshold it's judged by).
+
+    WeatherAPI has no forecast issuance time (its last_updated_epoch is when the current conditions
+    were observed, which moves on every refetch), so its forecasts are identified by value alone.
+    """
+    parts = [
+        forecast.get('source'),
+        forecast.get('forecast_date'),
+        round(float(forecast['high_temp_f']), 1),  # Cached values come back as floats
+        forecast.get('issued_at') if forecast.get('source') == 'WeatherKit' else None,
+        TEMP_THRESHOLD
+    ]
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def compute_check_interval(high_temp_f, avg_temp_f, alerted):
+    """Minutes until a location should be checked again, based on how close it is to alerting"""
+    if alerted:
+        return CADENCE_NEAR_MINUTES
+    margin = (avg_temp_f + TEMP_THRESHOLD) - high_temp_f
+    return CADENCE_FAR_MINUTES if margin >= CADENCE_FAR_MARGIN_F else CADENCE_NEAR_MINUTES
+
+def location_check_due(location, now=None):
+    """True unless the location's adaptive cadence says it was checked recently enough"""
+    now = now or datetime.utcnow()
+    state = LocationCheckState.query.filter_by(location_key=normalize_location_key(location)).first()
+    return state is None or state.next_check_at is None or state.next_check_at <= now
+
+def process_location_forecast(location, subscribers, forecast, source=None):
+    """Evaluate and notify for one location unless its forecast is unchanged since the last evaluation.
+
+    Returns (notifications_sent, skipped).
+    """
+    now = datetime.utcnow()
+    location_key = normalize_location_key(location)
+    fingerprint = forecast_fingerprint(forecast)
+    state = LocationCheckState.query.filter_by(location_key=location_key).first()
+    if state and state.forecast_fingerprint == fingerprint:
+        state.last_run_at = now
+        state.skipped_runs = (state.skipped_runs or 0) + 1
+        if state.check_interval_minutes:
+            state.next_check_at = now + timedelta(minutes=state.check_interval_minutes - CADENCE_SLACK_MINUTES)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ Could not record delta-run state for {location}: {e}")
+        print(f"⏭️ {location}: forecast unchanged since {state.evaluated_at}, skipping")
+        return [], True
+
+    notifications_sent, avg_temp = evaluate_location_alert(location, subscribers, forecast['high_temp_f'], source=source)
+    if state is None:
+        state = LocationCheckState(location_key=location_key, location=location)
+        db.session.add(state)
+    state.forecast_date = forecast.get('forecast_date')
+    state.forecast_fingerprint = fingerprint
+    state.high_temp_f = forecast['high_temp_f']
+    state.avg_temp_f = avg_temp
+    state.alerted = forecast['high_temp_f'] >= avg_temp + TEMP_THRESHOLD
+    state.evaluated_at = now
+    state.last_run_at = now
+    state.skipped_runs = 0
+    state.check_interval_minutes = compute_check_interval(state.high_temp_f, avg_temp, state.alerted)
+    state.next_check_at = now + timedelta(minutes=state.check_interval_minutes - CADENCE_SLACK_MINUTES)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Could not record delta-run state for {location}: {e}")
+    return notifications_sent, False
+
+@app.route('/api/check-temperatures', methods=['GET'])
+def check_temperatures():
+    """Check forecasted high temperatures and send notifications if conditions are met"""
+    if not WEATHER_API_KEY:
+        return jsonify({'error': 'Weather API key not configured'}), 500
     
+    force = request.args.get('force', 'false').lower() == 'true'  # Ignore per-location cadence
     notifications_sent = []
-    processed_locations = set()  # Track locations to avoid duplicate push notifications
+    deferred_locations = []
+    skipped_locations = []
+    not_due_locations = []
+    alert_locations = get_alert_locations()
     
-    for subscriber in Subscriber.query.all():
+    for index, (location, subscribers) in enumerate(alert_locations):
+        if not force and not location_check_due(location):
+            not_due_locations.append(location)
+            continue
+        # Defer the remaining (lowest-priority) locations once the budget can't cover a full check
+        if not provider_has_budget('weatherapi', LOCATION_CHECK_COST):
+            deferred_locations.extend(loc for loc, _ in alert_locations[index:])
+            print(f"⏳ WeatherAPI budget exhausted, deferring {len(alert_locations) - index} location(s)")
+            break
         try:
-            location = subscriber.location
-            if location == 'auto':
-                location = 'New York'
-            
             # Get forecasted high temperature for today
-            forecast_url = f"{WEATHER_BASE_URL}/forecast.json"
-            forecast_params = {
-                'key': WEATHER_API_KEY,
-                'q': location,
-                'days': 1,
-                'aqi': 'no',
-                'alerts': 'no'
-            }
-            forecast_response = requests.get(forecast_url, params=forecast_params)
-            if forecast_response.status_code != 200:
-                print(f"Failed to get forecast for {location}: {forecast_response.status_code}")
+            forecast = get_weatherapi_forecast(location)
+            if not forecast:
                 continue
-            
-            forecast_data = forecast_response.json()
-            current_temp = forecast_data['forecast']['forecastday'][0]['day']['maxtemp_f']
-            
-            # Get historical data for today's date (last 30 years)
-            today = datetime.now()
-            historical_url = f"{WEATHER_BASE_URL}/history.json"
-            
-            # Calculate average temperature from historical data
-            historical_temps = []
-            for year in range(1, 31):  # Last 30 years
-                try:
-                    historical_date = today.replace(year=today.year - year)
-                    historical_params = {
-                        'key': WEATHER_API_KEY,
-                        'q': location,
-                        'dt': historical_date.strftime('%Y-%m-%d')
-                    }
-                    historical_response = requests.get(historical_url, params=historical_params)
-                    
-                    if historical_response.status_code == 200:
-                        historical_data = historical_response.json()
-                        if 'forecast' in historical_data and historical_data['forecast']['forecastday']:
-                            historical_temp = historical_data['forecast']['forecastday'][0]['day']['maxtemp_f']
-                            historical_temps.append(historical_temp)
-                except Exception as e:
-                    print(f"Error fetching historical data for {location} year {year}: {e}")
-                    continue
-            
-            # Calculate average temperature
-            if historical_temps:
-                avg_temp = sum(historical_temps) / len(historical_temps)
-                print(f"{location}: Current temp {current_temp}°F, Avg temp {avg_temp:.1f}°F, Diff {current_temp - avg_temp:.1f}°F")
-            else:
-                # Fallback to hardcoded average if historical data fails
-                avg_temp = 85
-                print(f"{location}: Using fallback avg temp {avg_temp}°F")
-            
-            # Check if temperature exceeds threshold
-            if current_temp >= avg_temp + TEMP_THRESHOLD:
-                print(f"🌡️ TEMPERATURE ALERT: {location} is {current_temp - avg_temp:.1f}°F hotter than average!")
-                
-                # Send email notification
-                send_notification(subscriber.email, location, current_temp, avg_temp)
-                notifications_sent.append({
-                    'email': subscriber.email,
-                    'location': location,
-                    'current_temp': current_temp,
-                    'avg_temp': avg_temp,
-                    'threshold': TEMP_THRESHOLD
-                })
-                
-                # Send push notification (only once per location)
-                if location not in processed_locations:
-                    send_push_notification(location, current_temp, avg_temp)
-                    processed_locations.add(location)
-            else:
-                print(f"No alert for {location}: {current_temp}°F vs {avg_temp:.1f}°F avg (threshold: {TEMP_THRESHOLD}°F)")
-                
+            location_notifications, skipped = process_location_forecast(location, subscribers, forecast)
+            notifications_sent.extend(location_notifications)
+            if skipped:
+                skipped_locations.append(location)
+            if EARLY_ALERTS_ENABLED:
+                notifications_sent.extend(send_early_alerts(location, subscribers, 'WeatherAPI.com'))
+        except ProviderQuotaExceeded as e:
+            deferred_locations.extend(loc for loc, _ in alert_locations[index:])
+            print(f"⏳ {e}, deferring {len(alert_locations) - index} location(s)")
+            break
         except Exception as e:
-            print(f"Error processing subscriber {subscriber.email}: {e}")
+            print(f"Error processing location {location}: {e}")
             continue
     
     return jsonify({
-        'message': f'Processed {len(Subscriber.query.all())} subscribers',
+        'message': f'Processed {sum(len(subs) for _, subs in alert_locations)} subscribers',
         'notifications_sent': len(notifications_sent),
         'threshold': TEMP_THRESHOLD,
-        'details': notifications_sent
+        'details': notifications_sent,
+        'deferred_locations': deferred_locations,
+        'skipped_locations': skipped_locations,
+        'not_due_locations': not_due_locations
     })
 
 def get_weatherkit_credentials():
@@ -1100,9 +2491,49 @@ def get_weatherkit_credentials():
         print(f"❌ Error getting WeatherKit credentials from GCP: {e}")
         return None
 
-def get_weatherkit_forecast(location, coordinates=None):
-    """Get daily forecast from Apple WeatherKit"""
+def parse_weatherkit_daily_highs(weather_data, timezone_name):
+    """Reduce a forecastDaily payload to [(local YYYY-MM-DD, high_f), ...] plus its read time"""
+    forecast_daily = weather_data.get('forecastDaily') or {}
+    local_tz = timezone(timezone_name)
+    days = []
+    for day in forecast_daily.get('days', []):
+        start = parse_provider_timestamp(day.get('forecastStart'))
+        high_temp_c = day.get('temperatureMax')
+        if start is None or high_temp_c is None:
+            continue
+        local_date = timezone('UTC').localize(start).astimezone(local_tz).strftime('%Y-%m-%d')
+        high_temp_f = (high_temp_c * 9/5) + 32  # Convert C to F
+        days.append((local_date, round(high_temp_f, 1)))
+    issued_at = parse_provider_timestamp((forecast_daily.get('metadata') or {}).get('readTime'))
+    return days, issued_at
+
+def get_weatherkit_forecast(location, coordinates=None, timezone_name=None):
+    """Get today's forecasted high from Apple WeatherKit, reading the forecast cache first.
+
+    Only the forecastDaily data set is requested; every returned day is cached so the
+    following days' checks can be answered without another WeatherKit call.
+    """
     try:
+        # Use coordinates if provided, otherwise use location name
+        if not coordinates:
+            # For location names, we'd need to geocode first
+            # For now, default to New York coordinates
+            coordinates = WEATHERKIT_DEFAULT_COORDINATES
+        timezone_name = timezone_name or WEATHERKIT_DEFAULT_TIMEZONE
+        today = datetime.now(timezone(timezone_name)).strftime('%Y-%m-%d')
+
+        cached = get_cached_forecast(location, today, 'WeatherKit', WEATHERKIT_CACHE_MAX_AGE_HOURS)
+        if cached:
+            return {
+                'location': location,
+                'high_temp_f': cached.high_temp_f,
+                'source': 'WeatherKit',
+                'forecast_date': cached.forecast_date,
+                'issued_at': cached.issued_at.isoformat() if cached.issued_at else None,
+                'cached': True,
+                'timestamp': datetime.now().isoformat()
+            }
+
         credentials = get_weatherkit_credentials()
         if not credentials:
             print("❌ WeatherKit credentials not available")
@@ -1111,7 +2542,6 @@ def get_weatherkit_forecast(location, coordinates=None):
         # Generate JWT token
         import jwt
         import base64
-        from datetime import datetime, timedelta
         
         # Decode private key
         private_key = base64.b64decode(credentials['private_key']).decode('utf-8')
@@ -1135,14 +2565,13 @@ def get_weatherkit_forecast(location, coordinates=None):
         # Generate JWT token
         token = jwt.encode(payload, private_key, algorithm='ES256', headers=headers)
         
-        # Use coordinates if provided, otherwise use location name
-        if coordinates:
-            lat, lon = coordinates
-            weather_url = f"https://weatherkit.apple.com/v1/weather/en/{lat}/{lon}"
-        else:
-            # For location names, we'd need to geocode first
-            # For now, default to New York coordinates
-            weather_url = "https://weatherkit.apple.com/v1/weather/en/40.7128/-74.0060"
+        lat, lon = coordinates
+        weather_url = f"https://weatherkit.apple.com/v1/weather/en/{lat}/{lon}"
+        # Daily highs are all we use: skip currentWeather/forecastHourly, which dominate the payload
+        params = {
+            'dataSets': 'forecastDaily',
+            'timezone': timezone_name
+        }
         
         headers = {
             'Authorization': f'Bearer {token}',
@@ -1150,207 +2579,1461 @@ def get_weatherkit_forecast(location, coordinates=None):
             'User-Agent': 'TooHotApp/1.0'
         }
         
-        response = requests.get(weather_url, headers=headers)
+        response = provider_request('weatherkit', 'GET', weather_url, headers=headers, params=params)
         
         if response.status_code == 200:
-            weather_data = response.json()
-            
-            # Extract daily forecast data
-            if 'forecastDaily' in weather_data and weather_data['forecastDaily']:
-                daily_forecast = weather_data['forecastDaily'][0]  # Today's forecast
-                
-                # Get high temperature (convert from Celsius to Fahrenheit if needed)
-                high_temp_c = daily_forecast.get('temperatureMax', 0)
-                high_temp_f = (high_temp_c * 9/5) + 32  # Convert C to F
-                
-                return {
-                    'location': location,
-                    'high_temp_f': round(high_temp_f, 1),
-                    'source': 'WeatherKit',
-                    'timestamp': datetime.now().isoformat()
-                }
-            else:
+            days, issued_at = parse_weatherkit_daily_highs(response.json(), timezone_name)
+            if not days:
                 print(f"❌ No daily forecast data in WeatherKit response for {location}")
                 return None
+            store_forecast_days(location, 'WeatherKit', days, issued_at=issued_at, timezone_name=timezone_name)
+            
+            # Today's forecast, falling back to the first day returned
+            forecast_date, high_temp_f = next(((d, t) for d, t in days if d == today), days[0])
+            return {
+                'location': location,
+                'high_temp_f': high_temp_f,
+                'source': 'WeatherKit',
+                'forecast_date': forecast_date,
+                'issued_at': issued_at.isoformat() if issued_at else None,
+                'cached': False,
+                'timestamp': datetime.now().isoformat()
+            }
         else:
             print(f"❌ WeatherKit API error for {location}: {response.status_code} - {response.text}")
             return None
             
+    except ProviderQuotaExceeded:
+        raise
     except Exception as e:
         print(f"❌ Error getting WeatherKit forecast for {location}: {e}")
         return None
 
-def check_temperatures_with_weatherkit():
-    """Check forecasted high temperatures using WeatherKit and send notifications if conditions are met"""
-    if not WEATHERKIT_ENABLED:
-        print("⚠️ WeatherKit not enabled, falling back to WeatherAPI.com")
-        return check_temperatures()
-    
-    notifications_sent = []
-    processed_locations = set()  # Track locations to avoid duplicate push notifications
-    
-    for subscriber in Subscriber.query.all():
+def check_temperatures_with_weatherkit():
+    """Check forecasted high temperatures using WeatherKit and send notifications if conditions are met"""
+    if not WEATHERKIT_ENABLED:
+        print("⚠️ WeatherKit not enabled, falling back to WeatherAPI.com")
+        return check_temperatures()
+    
+    force = request.args.get('force', 'false').lower() == 'true'  # Ignore per-location cadence
+    notifications_sent = []
+    deferred_locations = []
+    skipped_locations = []
+    not_due_locations = []
+    alert_locations = get_alert_locations()
+    
+    for index, (location, subscribers) in enumerate(alert_locations):
+        if not force and not location_check_due(location):
+            not_due_locations.append(location)
+            continue
+        # Historical averages still come from WeatherAPI.com
+        if not (provider_has_budget('weatherkit', 1) and provider_has_budget('weatherapi', HISTORY_YEARS)):
+            deferred_locations.extend(loc for loc, _ in alert_locations[index:])
+            print(f"⏳ Provider budget exhausted, deferring {len(alert_locations) - index} location(s)")
+            break
+        try:
+            # Get forecasted high temperature from WeatherKit
+            forecast_data = get_weatherkit_forecast(location)
+            if not forecast_data:
+                print(f"⚠️ WeatherKit failed for {location}, falling back to WeatherAPI.com")
+                # Fall back to the original function for this location
+                continue
+            
+            current_temp = forecast_data['high_temp_f']
+            print(f"✅ WeatherKit forecast for {location}: {current_temp}°F")
+            location_notifications, skipped = process_location_forecast(
+                location, subscribers, forecast_data, source='WeatherKit'
+            )
+            notifications_sent.extend(location_notifications)
+            if skipped:
+                skipped_locations.append(location)
+            if EARLY_ALERTS_ENABLED:
+                notifications_sent.extend(send_early_alerts(location, subscribers, 'WeatherKit'))
+        except ProviderQuotaExceeded as e:
+            deferred_locations.extend(loc for loc, _ in alert_locations[index:])
+            print(f"⏳ {e}, deferring {len(alert_locations) - index} location(s)")
+            break
+        except Exception as e:
+            print(f"Error processing location {location}: {e}")
+            continue
+    
+    return jsonify({
+        'message': f'Processed {sum(len(subs) for _, subs in alert_locations)} subscribers with WeatherKit',
+        'notifications_sent': len(notifications_sent),
+        'threshold': TEMP_THRESHOLD,
+        'details': notifications_sent,
+        'deferred_locations': deferred_locations,
+        'skipped_locations': skipped_locations,
+        'not_due_locations': not_due_locations,
+        'source': 'WeatherKit'
+    })
+
+# --- Alert Email Rendering ---
+# Every subscriber in a location gets the same alert, so the HTML is rendered once per
+# (location, temps, years, day) and only the per-recipient placeholders are substituted.
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', 'https://its2hot.org')
+UNSUBSCRIBE_URL_PLACEHOLDER = '%%UNSUBSCRIBE_URL%%'
+
+UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS = int(os.getenv('UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS', '90'))  # Links in older emails stop working
+
+unsubscribe_serializer = URLSafeTimedSerializer(app.secret_key, salt='email-unsubscribe')
+
+def unsubscribe_tokens_enabled():
+    """Tokens signed with the public default key could be forged, so none are issued or accepted"""
+    return app.secret_key != DEFAULT_SECRET_KEY
+
+if not unsubscribe_tokens_enabled():
+    print("⚠️ SECRET_KEY is not set: alert emails link to the site instead of a one-click unsubscribe URL")
+
+def make_unsubscribe_url(email):
+    """Signed, expiring unsubscribe URL for an email address, or None without a real SECRET_KEY"""
+    if not unsubscribe_tokens_enabled():
+        return None
+    return f"{PUBLIC_BASE_URL}/unsubscribe/{unsubscribe_serializer.dumps(email)}"
+
+@lru_cache(maxsize=256)
+def render_alert_email(location, current_temp, avg_temp, years=30, day_label='Today'):
+    """Render the shared alert HTML for a location (per-recipient fields left as placeholders)"""
+    return render_template(
+        'alert_email.html',
+        location=location,
+        current_temp=current_temp,
+        avg_temp=avg_temp,
+        temp_diff=round(current_temp - avg_temp, 1),
+        years=years,
+        day_label=day_label,
+        unsubscribe_url=UNSUBSCRIBE_URL_PLACEHOLDER
+    )
+
+def personalize_email(html, unsubscribe_url):
+    # Without a token the link goes to the site, which has its own unsubscribe form
+    return html.replace(UNSUBSCRIBE_URL_PLACEHOLDER, unsubscribe_url or PUBLIC_BASE_URL)
+
+def send_notification(email, location, current_temp, avg_temp, years=30, day_label='Today', commit=True):
+    """Queue a climate alert notification for a subscriber (HTML email).
+
+    Fan-out loops pass commit=False and commit once after the loop.
+    """
+    try:
+        subject = f"🌡️ Climate Alert - {location} - IT'S TOO HOT!"
+        if day_label != 'Today':
+            subject = f"🌡️ Climate Alert - {location} - {day_label} will be TOO HOT!"
+        unsubscribe_url = make_unsubscribe_url(email)
+        html_body = personalize_email(render_alert_email(location, current_temp, avg_temp, years, day_label),
+                                      unsubscribe_url)
+        enqueue_email(email, subject, html=html_body, kind='alert', commit=commit, unsubscribe_url=unsubscribe_url)
+        print(f"Notification queued for {email}")
+    except Exception as e:
+        print(f"Failed to queue notification to {email}: {e}")
+
+# --- Digest Delivery ---
+# Digest-mode subscribers collect alerts for DIGEST_WINDOW_HOURS (counted from their oldest pending
+# alert) and then get a single email. Repeats of the same location and day collapse to the latest.
+DIGEST_WINDOW_HOURS = float(os.getenv('DIGEST_WINDOW_HOURS', '24'))
+DIGEST_FLUSH_INTERVAL_SECONDS = int(os.getenv('DIGEST_FLUSH_INTERVAL_SECONDS', '300'))
+DIGEST_FLUSH_BATCH = 500  # Subscribers per flush pass
+
+def collapse_digest_entries(entries):
+    """Keep the latest alert per (location, day, label), oldest first"""
+    latest = {}
+    for entry in sorted(entries, key=lambda e: e.created_at):
+        latest[(entry.location, entry.created_at.date(), entry.day_label)] = entry
+    return sorted(latest.values(), key=lambda e: e.created_at)
+
+def send_digest_email(email, entries, commit=True):
+    """Queue one digest email covering a subscriber's pending alerts"""
+    alerts = [{
+        'location': entry.location,
+        'current_temp': entry.current_temp,
+        'avg_temp': round(entry.avg_temp, 1),
+        'temp_diff': round(entry.current_temp - entry.avg_temp, 1),
+        'years': entry.years,
+        'day_label': entry.day_label,
+        'date': entry.created_at.strftime('%b %d')
+    } for entry in collapse_digest_entries(entries)]
+    subject = f"🌡️ Your IT'S TOO HOT! digest - {len(alerts)} climate alert{'s' if len(alerts) != 1 else ''}"
+    unsubscribe_url = make_unsubscribe_url(email)
+    html_body = render_template('digest_email.html', alerts=alerts, unsubscribe_url=unsubscribe_url or PUBLIC_BASE_URL)
+    enqueue_email(email, subject, html=html_body, kind='digest', commit=commit, unsubscribe_url=unsubscribe_url)
+    print(f"Digest with {len(alerts)} alerts queued for {email}")
+
+def flush_due_digests():
+    """Queue digests for subscribers whose window has closed. Returns the number of digests queued."""
+    with app.app_context():
+        now = datetime.utcnow()
+        cutoff = now - timedelta(hours=DIGEST_WINDOW_HOURS)
+        due_emails = [email for (email,) in db.session.query(DigestEntry.email)
+                      .filter(DigestEntry.digest_sent_at == None)
+                      .group_by(DigestEntry.email)
+                      .having(db.func.min(DigestEntry.created_at) <= cutoff)
+                      .limit(DIGEST_FLUSH_BATCH).all()]
+        if not due_emails:
+            return 0
+        # Claim with a conditional UPDATE so two workers never send the same digest
+        token = os.urandom(16).hex()
+        DigestEntry.query.filter(DigestEntry.email.in_(due_emails), DigestEntry.digest_sent_at == None).update(
+            {'digest_sent_at': now, 'digest_token': token}, synchronize_session=False
+        )
+        db.session.commit()
+        by_email = {}
+        for entry in DigestEntry.query.filter_by(digest_token=token).all():
+            by_email.setdefault(entry.email, []).append(entry)
+        subscribed = {email for (email,) in db.session.query(Subscriber.email)
+                      .filter(Subscriber.email.in_(list(by_email)), Subscriber.suppressed == False).all()}
+        queued = 0
+        for email, entries in by_email.items():
+            if email not in subscribed:
+                continue  # Unsubscribed or suppressed while the digest was collecting
+            try:
+                send_digest_email(email, entries, commit=False)
+                queued += 1
+            except Exception as e:
+                print(f"Failed to queue digest for {email}: {e}")
+        db.session.commit()
+        email_outbox_wakeup.set()
+        return queued
+
+# --- Bounce Processing ---
+# DSN (RFC 3464) bounces and ARF complaints are read from BOUNCE_MAILBOX and counted per subscriber.
+# A complaint or BOUNCE_HARD_LIMIT hard bounces suppresses the address; so do BOUNCE_SOFT_LIMIT soft
+# bounces that each arrive within BOUNCE_SOFT_WINDOW_DAYS of the previous one.
+BOUNCE_MAILBOX = os.getenv('BOUNCE_MAILBOX', '')  # maildir:/path, mbox:/path or imap(s)://user:pass@host[:port]/FOLDER
+BOUNCE_POLL_SECONDS = int(os.getenv('BOUNCE_POLL_SECONDS', '600'))
+BOUNCE_HARD_LIMIT = int(os.getenv('BOUNCE_HARD_LIMIT', '1'))
+BOUNCE_SOFT_LIMIT = int(os.getenv('BOUNCE_SOFT_LIMIT', '5'))
+BOUNCE_SOFT_WINDOW_DAYS = int(os.getenv('BOUNCE_SOFT_WINDOW_DAYS', '14'))
+
+def _report_address(value):
+    """'rfc822; <User@Example.com>' -> 'user@example.com'"""
+    if not value:
+        return None
+    value = str(value).split(';', 1)[-1].strip().strip('<>').strip()
+    return value.lower() if '@' in value else None
+
+def parse_bounce_message(raw):
+    """Extract bounces/complaints from a DSN or ARF message.
+
+    Returns (message_key, [{'email', 'kind', 'status', 'reason'}, ...]); non-reports yield no events.
+    """
+    msg = email_parser.message_from_bytes(raw) if isinstance(raw, bytes) else email_parser.message_from_string(raw)
+    message_key = (msg.get('Message-ID') or '').strip() or hashlib.sha1(
+        raw if isinstance(raw, bytes) else raw.encode()
+    ).hexdigest()
+    events = []
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if content_type == 'message/delivery-status':
+            # First block is per-message fields, the rest are one block per recipient
+            for block in (part.get_payload() or [])[1:]:
+                address = _report_address(block.get('Final-Recipient') or block.get('Original-Recipient'))
+                action = (block.get('Action') or '').strip().lower()
+                status = (block.get('Status') or '').strip()
+                if not address or action not in ('failed', 'delayed'):
+                    continue
+                kind = 'hard' if action == 'failed' and status.startswith('5') else 'soft'
+                events.append({'email': address, 'kind': kind, 'status': status or None,
+                               'reason': (block.get('Diagnostic-Code') or '').strip()[:500] or None})
+        elif content_type == 'message/feedback-report':
+            report = (part.get_payload() or [None])[0]
+            if report is None:
+                continue
+            address = _report_address(report.get('Original-Rcpt-To'))
+            if not address:
+                # Fall back to the To: header of the returned original message
+                for original in msg.walk():
+                    if original.get_content_type() in ('message/rfc822', 'text/rfc822-headers'):
+                        inner = original.get_payload()
+                        inner = inner[0] if isinstance(inner, list) else email_parser.message_from_string(inner)
+                        address = _report_address(parseaddr(inner.get('To', ''))[1])
+                        break
+            if address:
+                events.append({'email': address, 'kind': 'complaint', 'status': None,
+                               'reason': f"Feedback-Type: {(report.get('Feedback-Type') or 'abuse').strip()}"})
+    return message_key, events
+
+def record_bounce(address, kind, reason=None, status=None, message_key=None):
+    """Count a bounce against a subscriber and suppress them when the rules say so.
+
+    Returns True if this event suppressed the subscriber. Events already recorded (same
+    message_key and address) are ignored, so re-reading a mailbox is harmless.
+    """
+    now = datetime.utcnow()
+    try:
+        db.session.add(BounceEvent(
+            message_key=(message_key or f'manual:{now.isoformat()}')[:255],
+            email=address,
+            kind=kind,
+            status=status,
+            reason=reason
+        ))
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()  # Already processed (another worker or an earlier pass)
+        return False
+    subscriber = Subscriber.query.filter(db.func.lower(Subscriber.email) == address.lower()).first()
+    suppressed_now = False
+    if subscriber:
+        if kind == 'hard':
+            subscriber.hard_bounces = (subscriber.hard_bounces or 0) + 1
+        elif kind == 'soft':
+            window_start = now - timedelta(days=BOUNCE_SOFT_WINDOW_DAYS)
+            if subscriber.last_bounce_at and subscriber.last_bounce_at < window_start:
+                subscriber.soft_bounces = 0
+            subscriber.soft_bounces = (subscriber.soft_bounces or 0) + 1
+        subscriber.last_bounce_at = now
+        should_suppress = (kind == 'complaint'
+                           or (subscriber.hard_bounces or 0) >= BOUNCE_HARD_LIMIT
+                           or (subscriber.soft_bounces or 0) >= BOUNCE_SOFT_LIMIT)
+        if should_suppress and not subscriber.suppressed:
+            subscriber.suppressed = True
+            subscriber.suppressed_at = now
+            subscriber.suppression_reason = f"{kind}: {status or reason or 'bounce'}"[:255]
+            suppressed_now = True
+            print(f"🚫 Suppressed {subscriber.email} after {kind} bounce ({status or reason})")
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # Another worker recorded the same event concurrently
+        return False
+    return suppressed_now
+
+def process_bounce_message(raw, summary):
+    message_key, events = parse_bounce_message(raw)
+    summary['messages'] += 1
+    if not events:
+        summary['unrecognized'] += 1
+    for event in events:
+        summary[event['kind']] += 1
+        if record_bounce(event['email'], event['kind'], event['reason'], event['status'], message_key):
+            summary['suppressed'].append(event['email'])
+
+def read_maildir_bounces(path, handle):
+    """Feed unread maildir messages to handle(raw), then move them to cur/ as seen"""
+    box = mailbox.Maildir(path, factory=None, create=False)
+    for key in list(box.iterkeys()):
+        message = box.get_message(key)
+        if message.get_subdir() != 'new':
+            continue
+        handle(box.get_bytes(key))
+        message.set_subdir('cur')
+        message.add_flag('S')
+        box[key] = message
+
+def read_mbox_bounces(path, handle):
+    """Feed every mbox message to handle(raw), removing each once processed"""
+    box = mailbox.mbox(path, create=False)
+    box.lock()
+    try:
+        for key in list(box.iterkeys()):
+            handle(box.get_bytes(key))
+            box.remove(key)
+        box.flush()
+    finally:
+        box.unlock()
+        box.close()
+
+def read_imap_bounces(url, handle):
+    """Feed unseen messages in an IMAP folder to handle(raw), flagging each \\Seen once processed"""
+    parsed = urlparse(url)
+    use_ssl = parsed.scheme == 'imaps'
+    client = (imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4)(parsed.hostname, parsed.port or (993 if use_ssl else 143))
+    try:
+        client.login(unquote(parsed.username or ''), unquote(parsed.password or ''))
+        client.select(parsed.path.lstrip('/') or 'INBOX')
+        typ, data = client.search(None, 'UNSEEN')
+        for num in (data[0].split() if data and data[0] else []):
+            typ, fetched = client.fetch(num, '(BODY.PEEK[])')
+            if typ != 'OK' or not fetched or not isinstance(fetched[0], tuple):
+                continue
+            handle(fetched[0][1])
+            client.store(num, '+FLAGS', '\\Seen')
+    finally:
+        try:
+            client.logout()
+        except Exception:
+            pass
+
+def ingest_bounces(source=None):
+    """Process new bounce/complaint messages from BOUNCE_MAILBOX (or `source`) and return a summary"""
+    source = source or BOUNCE_MAILBOX
+    summary = {'messages': 0, 'hard': 0, 'soft': 0, 'complaint': 0, 'unrecognized': 0, 'suppressed': []}
+    if not source:
+        return summary
+    with app.app_context():
+        handle = lambda raw: process_bounce_message(raw, summary)
+        if source.startswith('maildir:'):
+            read_maildir_bounces(source[len('maildir:'):], handle)
+        elif source.startswith('mbox:'):
+            read_mbox_bounces(source[len('mbox:'):], handle)
+        elif source.startswith(('imap://', 'imaps://')):
+            read_imap_bounces(source, handle)
+        else:
+            raise ValueError(f"Unsupported BOUNCE_MAILBOX: {source}")
+    if summary['messages']:
+        print(f"📬 Processed {summary['messages']} bounce messages, suppressed {len(summary['suppressed'])} addresses")
+    return summary
+
+# --- Expo Push Dispatcher ---
+# Batches of up to 100 messages go out on a pool of threads (one keep-alive session each), at most
+# EXPO_PUSH_CONCURRENCY in flight per process across all sends (see Push Priority Lanes),
+# gzip-compressed and paced to EXPO_PUSH_RATE_PER_SECOND notifications/sec for this process. Results
+# are handed back to the caller batch by batch, so logging keeps pace with the send.
+EXPO_PUSH_URL = os.getenv('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+EXPO_RECEIPTS_URL = os.getenv('EXPO_RECEIPTS_URL', 'https://exp.host/--/api/v2/push/getReceipts')
+EXPO_ACCESS_TOKEN = os.getenv('EXPO_ACCESS_TOKEN')  # Only needed if enhanced push security is enabled
+EXPO_BATCH_SIZE = 100  # Expo's per-request message limit
+EXPO_PUSH_CONCURRENCY = int(os.getenv('EXPO_PUSH_CONCURRENCY', '6'))
+EXPO_PUSH_RATE_PER_SECOND = float(os.getenv('EXPO_PUSH_RATE_PER_SECOND', '600'))  # Expo's documented project limit
+EXPO_PUSH_MAX_RETRIES = 3  # For 429 and 5xx responses
+EXPO_GZIP_MIN_BYTES = 1024  # Smaller bodies aren't worth compressing
+DEVICE_PAGE_SIZE = int(os.getenv('DEVICE_PAGE_SIZE', '1000'))  # Devices read per keyset page during fan-out
+PUSH_LOG_ASYNC = os.getenv('PUSH_LOG_ASYNC', 'true').lower() == 'true'  # Write push logs on a background thread
+PUSH_LOG_QUEUE_BATCHES = int(os.getenv('PUSH_LOG_QUEUE_BATCHES', '50'))  # Logged batches buffered before sends wait
+PUSH_LOG_COALESCE_BATCHES = 20  # Queued batches merged into one insert
+
+class PushRatePacer:
+    """Spaces batches so no more than `rate` notifications/sec leave this process"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, count):
+        """Book `count` sends and return how many seconds to wait before making them"""
+        if not self.interval:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_at, now)
+            self.next_at = start + count * self.interval
+        return start - now
+
+    def wait(self, count):
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+
+expo_push_pacer = PushRatePacer(EXPO_PUSH_RATE_PER_SECOND)  # Shared, so concurrent sends split the rate
+
+def iter_push_devices(location=None, platform='expo', page_size=None, cap_since=None, stats=None):
+    """Yield (id, push_token, device_type) rows for active devices, one keyset page at a time.
+
+    Pages are plain rows ordered by primary key (no ORM identity map), so memory stays flat
+    whatever the device count and the first batch can go out before the table has been read.
+    Each page is a range scan on ix_device_active_location_platform (or ix_device_active_platform).
+
+    With cap_since (frequency cap), devices alerted after that time are skipped and the rest are
+    claimed by stamping last_alert_sent_at with a conditional UPDATE before they are yielded, so
+    overlapping fan-outs in other workers can't alert the same device twice. Skipped devices are
+    counted in stats['capped'] and the claim stamps kept in stats['claim_stamps'], so claims on
+    devices the send never reached can be released (release_push_claims).
+    """
+    page_size = page_size or DEVICE_PAGE_SIZE
+    last_id = 0
+    while True:
+        query = db.session.query(Device.id, Device.push_token, Device.device_type).filter(
+            Device.is_active == True,
+            Device.platform == platform,
+            Device.id > last_id
+        )
+        if location is not None:
+            query = query.filter(Device.location_key == normalize_location_key(location))
+        page = query.order_by(Device.id).limit(page_size).all()
+        if cap_since is None:
+            yield from page
+        elif page:
+            yield from claim_push_devices(page, cap_since, stats)
+        if len(page) < page_size:
+            return
+        last_id = page[-1].id
+
+def claim_push_devices(page, cap_since, stats=None):
+    """The rows of a page not alerted since cap_since, after stamping them as alerted now"""
+    not_recent = or_(Device.last_alert_sent_at == None, Device.last_alert_sent_at < cap_since)
+    ids = [row.id for row in page]
+    stamp = datetime.utcnow()
+    Device.query.filter(Device.id.in_(ids), not_recent).update(
+        {Device.last_alert_sent_at: stamp}, synchronize_session=False)
+    db.session.commit()
+    claimed = {device_id for (device_id,) in db.session.query(Device.id).filter(
+        Device.id.in_(ids), Device.last_alert_sent_at == stamp)}
+    if stats is not None:
+        stats['capped'] = stats.get('capped', 0) + len(ids) - len(claimed)
+        if claimed:
+            stats.setdefault('claim_stamps', []).append(stamp)
+    return [row for row in page if row.id in claimed]
+
+def release_push_claims(stats, device_ids=None):
+    """Clear this fan-out's frequency-cap claims on devices whose alert was not accepted, or on every
+    device it claimed when device_ids is None (the provider failed part-way, so who got it is unknown).
+
+    NULL is as good as the timestamp the claim replaced: a device is only claimed once that is
+    outside the window. Devices queued for retry are stamped again when a retry reaches them.
+    """
+    stamps = stats.get('claim_stamps') or []
+    if not stamps or device_ids == []:
+        return
+    if device_ids is None:
+        chunks = [Device.last_alert_sent_at.in_(stamps[i:i + PUSH_RETRY_BATCH_DEVICES])
+                  for i in range(0, len(stamps), PUSH_RETRY_BATCH_DEVICES)]
+    else:
+        device_ids = list(dict.fromkeys(device_ids))
+        # Claims on these devices are this fan-out's own: a claimed device can't be claimed again until released
+        chunks = [and_(Device.id.in_(device_ids[i:i + PUSH_RETRY_BATCH_DEVICES]), Device.last_alert_sent_at >= min(stamps))
+                  for i in range(0, len(device_ids), PUSH_RETRY_BATCH_DEVICES)]
+    try:
+        for condition in chunks:
+            Device.query.filter(condition).update({Device.last_alert_sent_at: None}, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Failed to release push frequency-cap claims: {e}")
+
+def stamp_push_claims(device_ids, superseded_after):
+    """Stamp devices a retry reached as alerted now, unless a newer alert (stamped after
+    superseded_after, the retry row's creation) has claimed them since"""
+    now = datetime.utcnow()
+    not_superseded = or_(Device.last_alert_sent_at == None, Device.last_alert_sent_at <= superseded_after)
+    for start in range(0, len(device_ids), PUSH_RETRY_BATCH_DEVICES):
+        Device.query.filter(Device.id.in_(device_ids[start:start + PUSH_RETRY_BATCH_DEVICES]), not_superseded).update(
+            {Device.last_alert_sent_at: now}, synchronize_session=False)
+    db.session.commit()
+
+def iter_batches(items, size=EXPO_BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def post_expo_batch(session, batch):
+    """POST one batch to Expo, retrying 429/5xx with jittered backoff. Returns (tickets, error)."""
+    payload = json.dumps(batch).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
+    if EXPO_ACCESS_TOKEN:
+        headers['Authorization'] = f'Bearer {EXPO_ACCESS_TOKEN}'
+    if len(payload) >= EXPO_GZIP_MIN_BYTES:
+        payload = gzip.compress(payload)
+        headers['Content-Encoding'] = 'gzip'
+    error = None
+    for attempt in range(EXPO_PUSH_MAX_RETRIES + 1):
+        try:
+            response = session.post(EXPO_PUSH_URL, data=payload, headers=headers, timeout=30)
+            if response.status_code == 200:
+                return response.json().get('data', []), None
+            error = response.text
+            if response.status_code != 429 and response.status_code < 500:
+                return None, error
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < EXPO_PUSH_MAX_RETRIES:
+            time.sleep(min(2 ** attempt, 8) * (0.5 + random.random()))
+    return None, error
+
+def dispatch_expo_push(messages, on_batch, concurrency=None, rate=None, lane='alert'):
+    """Send an iterable of (expo_message, device) pairs in concurrent, paced, compressed batches.
+
+    `device` is whatever the caller needs to log the result (an (id, token, type) row here); only
+    the message is sent. The iterable is consumed lazily, so batches go out as devices are read.
+    on_batch(batch, tickets, error) runs on the calling thread as each batch completes, while
+    later batches are still in flight. Each request takes a slot in `lane` ('alert' or 'bulk')
+    first. Returns the number of batches sent.
+    """
+    concurrency = concurrency or push_lanes['expo'].capacity(lane)
+    pacer = expo_push_pacer if rate is None else PushRatePacer(rate)
+    quota_reserve = 0.0 if lane == 'alert' else PUSH_BULK_QUOTA_RESERVE
+    local = threading.local()
+    sessions = []
+
+    def send(batch):
+        try:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+                sessions.append(local.session)
+            with push_lanes['expo'].slot(lane):
+                pacer.wait(len(batch))
+                with app.app_context():
+                    if not acquire_provider_quota('expo', reserve=quota_reserve):
+                        return batch, None, 'Expo budget exhausted'
+                tickets, error = post_expo_batch(local.session, [message for message, _ in batch])
+            return batch, tickets, error
+        except Exception as e:
+            return batch, None, str(e)
+
+    batches = 0
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch in iter_batches(messages):
+            # Keep a bounded window in flight so a huge fan-out never queues every batch at once
+            if len(in_flight) >= concurrency * 2:
+                done, in_flight = wait_futures(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_batch(*future.result())
+            in_flight.add(pool.submit(send, batch))
+            batches += 1
+        for future in as_completed(in_flight):
+            on_batch(*future.result())
+    for session in sessions:
+        session.close()
+    return batches
+
+# --- Direct APNs / FCM Providers ---
+# Devices registered with platform 'apns' (raw APNs device token) or 'fcm' (FCM registration
+# token) go straight to Apple or Google instead of through Expo's relay: one request per device,
+# multiplexed as concurrent streams over a few long-lived HTTP/2 connections, with no batch limit.
+# A provider is used once its credentials are configured and httpx[http2] is installed.
+# Responses are turned into Expo-style tickets so logging and dead-token pruning treat all alike.
+APNS_URL = os.getenv('APNS_URL', 'https://api.push.apple.com')  # https://api.sandbox.push.apple.com for dev builds
+APNS_TOPIC = os.getenv('APNS_TOPIC')  # The app's bundle id
+APNS_KEY_ID = os.getenv('APNS_KEY_ID')
+APNS_TEAM_ID = os.getenv('APNS_TEAM_ID')
+APNS_AUTH_KEY = os.getenv('APNS_AUTH_KEY')  # Contents of the .p8 signing key...
+APNS_AUTH_KEY_PATH = os.getenv('APNS_AUTH_KEY_PATH')  # ...or a path to it
+APNS_TOKEN_REFRESH_SECONDS = 3000  # Apple rejects provider tokens older than an hour
+FCM_URL = os.getenv('FCM_URL', 'https://fcm.googleapis.com')
+FCM_PROJECT_ID = os.getenv('FCM_PROJECT_ID')
+FCM_SERVICE_ACCOUNT_FILE = os.getenv('FCM_SERVICE_ACCOUNT_FILE')  # Otherwise application default credentials
+FCM_ACCESS_TOKEN = os.getenv('FCM_ACCESS_TOKEN')  # Fixed OAuth token, for local stand-ins
+DIRECT_PUSH_CONNECTIONS = int(os.getenv('DIRECT_PUSH_CONNECTIONS', '4'))  # HTTP/2 connections per provider
+DIRECT_PUSH_STREAMS_PER_CONNECTION = 100  # httpx's cap on concurrent streams per connection
+DIRECT_PUSH_RATE_PER_SECOND = float(os.getenv('DIRECT_PUSH_RATE_PER_SECOND', '0'))  # Per provider, 0 = unpaced
+DIRECT_PUSH_MAX_RETRIES = 3  # For 5xx, FCM 429 and connection errors
+DIRECT_PUSH_RESULT_BATCH = 500  # Results handed to on_batch (and the log writer) this many at a time
+
+# Provider error reasons -> the Expo error codes the pruning rules use (as Expo itself maps them)
+APNS_ERROR_CODES = {
+    'BadDeviceToken': 'DeviceNotRegistered',
+    'Unregistered': 'DeviceNotRegistered',
+    'DeviceTokenNotForTopic': 'DeviceNotRegistered',
+    'TooManyRequests': 'MessageRateExceeded',
+    'PayloadTooLarge': 'MessageTooBig',
+    'ExpiredProviderToken': 'InvalidCredentials',
+    'InvalidProviderToken': 'InvalidCredentials',
+    'MissingProviderToken': 'InvalidCredentials'
+}
+FCM_ERROR_CODES = {
+    'UNREGISTERED': 'DeviceNotRegistered',
+    'QUOTA_EXCEEDED': 'MessageRateExceeded',
+    'SENDER_ID_MISMATCH': 'MismatchSenderId',
+    'THIRD_PARTY_AUTH_ERROR': 'InvalidCredentials'
+}
+
+_apns_token = {'value': None, 'issued_at': 0}
+_fcm_credentials = {'value': None}
+_provider_token_lock = threading.Lock()
+
+def apns_provider_token():
+    """ES256 provider JWT for APNs, reused until APNS_TOKEN_REFRESH_SECONDS old"""
+    with _provider_token_lock:
+        if _apns_token['value'] and time.time() - _apns_token['issued_at'] < APNS_TOKEN_REFRESH_SECONDS:
+            return _apns_token['value']
+        key = APNS_AUTH_KEY
+        if not key:
+            with open(APNS_AUTH_KEY_PATH) as f:
+                key = f.read()
+        issued_at = int(time.time())
+        _apns_token['value'] = jwt.encode({'iss': APNS_TEAM_ID, 'iat': issued_at}, key,
+                                          algorithm='ES256', headers={'kid': APNS_KEY_ID})
+        _apns_token['issued_at'] = issued_at
+        return _apns_token['value']
+
+def fcm_access_token():
+    """OAuth token for the FCM v1 API (service account file or application default credentials)"""
+    if FCM_ACCESS_TOKEN:
+        return FCM_ACCESS_TOKEN
+    from google.auth.transport.requests import Request
+    with _provider_token_lock:
+        credentials = _fcm_credentials['value']
+        if credentials is None:
+            scopes = ['https://www.googleapis.com/auth/firebase.messaging']
+            if FCM_SERVICE_ACCOUNT_FILE:
+                from google.oauth2 import service_account
+                credentials = service_account.Credentials.from_service_account_file(FCM_SERVICE_ACCOUNT_FILE, scopes=scopes)
+            else:
+                from google.auth import default
+                credentials, _ = default(scopes=scopes)
+            _fcm_credentials['value'] = credentials
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return credentials.token
+
+def direct_push_platforms():
+    """Device platforms besides 'expo' whose direct provider is configured"""
+    if httpx is None:
+        return []
+    platforms = []
+    if APNS_TOPIC and APNS_KEY_ID and APNS_TEAM_ID and (APNS_AUTH_KEY or APNS_AUTH_KEY_PATH):
+        platforms.append('apns')
+    if FCM_PROJECT_ID:
+        platforms.append('fcm')
+    return platforms
+
+def push_platforms():
+    return ['expo'] + direct_push_platforms()
+
+def apns_request(message):
+    """(url, headers, body) for one Expo-style message sent to APNs"""
+    body = {'aps': {
+        'alert': {'title': message.get('title'), 'body': message.get('body')},
+        'sound': message.get('sound') or 'default'
+    }}
+    body.update(message.get('data') or {})  # Custom keys sit beside 'aps'
+    headers = {
+        'authorization': f'bearer {apns_provider_token()}',
+        'apns-topic': APNS_TOPIC,
+        'apns-push-type': 'alert',
+        'apns-priority': '10' if message.get('priority') == 'high' else '5'
+    }
+    if message.get('collapseId'):
+        headers['apns-collapse-id'] = message['collapseId']  # Replaces an earlier alert on the device
+    if message.get('ttl'):
+        headers['apns-expiration'] = str(int(time.time()) + message['ttl'])
+    return f"{APNS_URL}/3/device/{message['to']}", headers, body
+
+def fcm_request(message):
+    """(url, headers, body) for one Expo-style message sent to FCM"""
+    # FCM data values must be strings
+    data = {key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in (message.get('data') or {}).items()}
+    body = {'message': {
+        'token': message['to'],
+        'notification': {'title': message.get('title'), 'body': message.get('body')},
+        'data': data,
+        'android': {
+            'priority': 'HIGH' if message.get('priority') == 'high' else 'NORMAL',
+            'notification': {'sound': message.get('sound') or 'default'}
+        }
+    }}
+    if message.get('collapseId'):
+        # collapse_key drops a pending older alert; the tag replaces one already on screen
+        body['message']['android']['collapse_key'] = message['collapseId']
+        body['message']['android']['notification']['tag'] = message['collapseId']
+    if message.get('ttl'):
+        body['message']['android']['ttl'] = f"{message['ttl']}s"
+    headers = {'authorization': f'Bearer {fcm_access_token()}'}
+    return f"{FCM_URL}/v1/projects/{FCM_PROJECT_ID}/messages:send", headers, body
+
+def direct_push_ticket(platform, response):
+    """Expo-style ticket for one APNs/FCM response"""
+    if response.status_code == 200:
+        if platform == 'apns':
+            return {'status': 'ok', 'id': response.headers.get('apns-id')}
+        return {'status': 'ok', 'id': response.json().get('name')}
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = {}
+    if platform == 'apns':
+        reason = payload.get('reason') or f'HTTP {response.status_code}'
+        code = APNS_ERROR_CODES.get(reason, reason)
+    else:
+        error = payload.get('error') or {}
+        reason = next((d.get('errorCode') for d in error.get('details', []) if d.get('errorCode')), None) \
+            or error.get('status') or f'HTTP {response.status_code}'
+        code = FCM_ERROR_CODES.get(reason, reason)
+    return {'status': 'error', 'message': f'{platform} {response.status_code} {reason}',
+            'details': {'error': code, 'provider_status': response.status_code}}
+
+async def post_direct_push(client, platform, message):
+    """Send one message, retrying 5xx (and FCM's project-wide 429) with jittered backoff"""
+    build = apns_request if platform == 'apns' else fcm_request
+    error = None
+    for attempt in range(DIRECT_PUSH_MAX_RETRIES + 1):
+        url, headers, body = build(message)
+        try:
+            response = await client.post(url, json=body, headers=headers)
+            retryable = response.status_code >= 500 or (platform == 'fcm' and response.status_code == 429)
+            if not retryable or attempt == DIRECT_PUSH_MAX_RETRIES:
+                return direct_push_ticket(platform, response)
+            error = f'HTTP {response.status_code}'
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+        if attempt < DIRECT_PUSH_MAX_RETRIES:
+            await asyncio.sleep(min(2 ** attempt, 8) * (0.5 + random.random()))
+    return {'status': 'error', 'message': f'{platform}: {error}', 'details': {}}
+
+async def _send_direct_push(platform, messages, on_batch, connections, rate, lane):
+    base_url = APNS_URL if platform == 'apns' else FCM_URL
+    # https negotiates HTTP/2 through ALPN; plain http (local stand-ins) needs HTTP/2 prior knowledge
+    clients = [httpx.AsyncClient(http2=True, http1=not base_url.startswith('http://'), timeout=30)
+               for _ in range(max(1, connections))]
+    streams = asyncio.Semaphore(len(clients) * DIRECT_PUSH_STREAMS_PER_CONNECTION)
+    lanes = push_lanes[platform]
+    pacer = PushRatePacer(rate)
+    done = []
+    sent = 0
+
+    def hand_off():
+        batch, tickets = [item for item, _ in done], [ticket for _, ticket in done]
+        done.clear()
+        on_batch(batch, tickets, None)
+
+    async def send(item, client):
+        try:
+            delay = pacer.reserve(1)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            ticket = await post_direct_push(client, platform, item[0])
+        except Exception as e:
+            ticket = {'status': 'error', 'message': str(e), 'details': {}}
+        finally:
+            lanes.release(lane)
+            streams.release()
+        done.append((item, ticket))
+        if len(done) >= DIRECT_PUSH_RESULT_BATCH:
+            hand_off()
+
+    tasks = set()
+    try:
+        for item in messages:
+            await streams.acquire()  # Bounds in-flight requests, so the device stream is read lazily
+            await lanes.acquire_async(lane)
+            task = asyncio.ensure_future(send(item, clients[sent % len(clients)]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+        if done:
+            hand_off()
+    finally:
+        for client in clients:
+            await client.aclose()
+    return sent
+
+def dispatch_direct_push(platform, messages, on_batch, connections=None, rate=None, lane='alert'):
+    """Send (expo_message, device) pairs straight to APNs ('apns') or FCM ('fcm') over HTTP/2.
+
+    Same contract as dispatch_expo_push(): on_batch(batch, tickets, error) receives results in
+    groups of DIRECT_PUSH_RESULT_BATCH. Each request takes a stream slot in `lane` first.
+    Returns the number of messages sent.
+    """
+    if httpx is None:
+        raise RuntimeError("httpx[http2] is not installed")
+    return asyncio.run(_send_direct_push(
+        platform,
+        messages,
+        on_batch,
+        connections or DIRECT_PUSH_CONNECTIONS,
+        DIRECT_PUSH_RATE_PER_SECOND if rate is None else rate,
+        lane
+    ))
+
+# --- Push Priority Lanes ---
+# Heat alerts and admin/test traffic share the same upstream capacity, so every send runs in a
+# lane: 'alert' for temperature alerts, 'bulk' for manual broadcasts and test alerts. Per process and
+# provider, in-flight requests are capped per lane and in total, and a bulk request only starts
+# while no alert request is waiting. Across workers the bulk lane may not spend the last
+# PUSH_BULK_QUOTA_RESERVE of the shared Expo call budget.
+PUSH_LANE_PRIORITY = {'alert': 0, 'bulk': 1}  # Lower runs first
+PUSH_ALERT_CONCURRENCY = int(os.getenv('PUSH_ALERT_CONCURRENCY', str(EXPO_PUSH_CONCURRENCY)))  # Expo batches in flight
+PUSH_BULK_CONCURRENCY = int(os.getenv('PUSH_BULK_CONCURRENCY', '2'))
+PUSH_BULK_DIRECT_STREAMS = int(os.getenv('PUSH_BULK_DIRECT_STREAMS', '50'))  # APNs/FCM streams in flight for bulk
+PUSH_BULK_QUOTA_RESERVE = float(os.getenv('PUSH_BULK_QUOTA_RESERVE', '0.25'))
+
+class PushLaneScheduler:
+    """In-flight request slots for one push provider, handed out by lane priority"""
+
+    def __init__(self, total, lane_limits):
+        self.total = total
+        self.lane_limits = lane_limits
+        self.active = {lane: 0 for lane in lane_limits}
+        self.waiting = {lane: 0 for lane in lane_limits}
+        self.cond = threading.Condition()
+
+    def capacity(self, lane):
+        return min(self.total, self.lane_limits[lane])
+
+    def _can_start(self, lane):
+        if sum(self.active.values()) >= self.total or self.active[lane] >= self.lane_limits[lane]:
+            return False
+        # Strict priority: nothing starts while a more urgent lane has requests waiting
+        return not any(self.waiting[other] for other in self.waiting
+                       if PUSH_LANE_PRIORITY[other] < PUSH_LANE_PRIORITY[lane])
+
+    def acquire(self, lane):
+        with self.cond:
+            self.waiting[lane] += 1
+            try:
+                while not self._can_start(lane):
+                    self.cond.wait()
+            finally:
+                self.waiting[lane] -= 1
+            self.active[lane] += 1
+            self.cond.notify_all()  # This lane may have stopped holding back lower ones
+
+    async def acquire_async(self, lane):
+        """acquire() for asyncio senders: polls instead of blocking the event loop"""
+        with self.cond:
+            self.waiting[lane] += 1
         try:
-            location = subscriber.location
-            if location == 'auto':
-                location = 'New York'
-            
-            # Get forecasted high temperature from WeatherKit
-            forecast_data = get_weatherkit_forecast(location)
-            if not forecast_data:
-                print(f"⚠️ WeatherKit failed for {location}, falling back to WeatherAPI.com")
-                # Fall back to the original function for this location
-                continue
-            
-            current_temp = forecast_data['high_temp_f']
-            print(f"✅ WeatherKit forecast for {location}: {current_temp}°F")
-            
-            # Get historical data for today's date (last 30 years) from WeatherAPI.com
-            today = datetime.now()
-            historical_url = f"{WEATHER_BASE_URL}/history.json"
-            
-            # Calculate average temperature from historical data
-            historical_temps = []
-            for year in range(1, 31):  # Last 30 years
+            while True:
+                with self.cond:
+                    if self._can_start(lane):
+                        self.active[lane] += 1
+                        return
+                await asyncio.sleep(0.005)
+        finally:
+            with self.cond:
+                self.waiting[lane] -= 1
+                self.cond.notify_all()
+
+    def release(self, lane):
+        with self.cond:
+            self.active[lane] -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, lane):
+        self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    def status(self):
+        with self.cond:
+            return {
+                'total': self.total,
+                'lanes': {lane: {'limit': self.lane_limits[lane], 'active': self.active[lane],
+                                 'waiting': self.waiting[lane]} for lane in self.lane_limits}
+            }
+
+_direct_push_streams = DIRECT_PUSH_CONNECTIONS * DIRECT_PUSH_STREAMS_PER_CONNECTION
+push_lanes = {
+    'expo': PushLaneScheduler(EXPO_PUSH_CONCURRENCY, {'alert': PUSH_ALERT_CONCURRENCY, 'bulk': PUSH_BULK_CONCURRENCY}),
+    'apns': PushLaneScheduler(_direct_push_streams, {'alert': _direct_push_streams, 'bulk': PUSH_BULK_DIRECT_STREAMS}),
+    'fcm': PushLaneScheduler(_direct_push_streams, {'alert': _direct_push_streams, 'bulk': PUSH_BULK_DIRECT_STREAMS})
+}
+
+# Collapse keys and TTL for heat alerts (and test alerts, which look the same on a phone), and a
+# per-device frequency cap for real heat alerts only: capped kinds share device.last_alert_sent_at,
+# so capping test pushes too would let an admin's test suppress the next real alert. Look-ahead
+# ('early_alert') pushes are about another day, so they get their own collapse id and no cap.
+PUSH_COLLAPSED_KINDS = set(filter(None, os.getenv('PUSH_COLLAPSED_KINDS', 'alert,early_alert,test').split(',')))
+PUSH_CAPPED_KINDS = set(filter(None, os.getenv('PUSH_CAPPED_KINDS', 'alert').split(',')))
+PUSH_ALERT_MIN_INTERVAL_MINUTES = int(os.getenv('PUSH_ALERT_MIN_INTERVAL_MINUTES', '180'))  # 0 = no cap
+PUSH_ALERT_TTL_SECONDS = int(os.getenv('PUSH_ALERT_TTL_SECONDS', '21600'))  # 0 = provider default
+
+def push_lane(kind):
+    """Lane for a campaign kind: temperature alerts go first, everything else ('manual', 'test') is bulk"""
+    return 'alert' if kind in ('alert', 'early_alert') else 'bulk'
+
+# --- Dead Token Pruning ---
+# Ticket and receipt errors are sorted by Expo error code: permanent ones (the token will never
+# work again) deactivate the device at once; transient device-level ones only after
+# PUSH_TRANSIENT_LIMIT in a row. Anything else (bad payload, credentials) isn't the device's fault.
+PUSH_PERMANENT_ERRORS = set(filter(None, os.getenv('PUSH_PERMANENT_ERRORS', 'DeviceNotRegistered').split(',')))
+PUSH_TRANSIENT_ERRORS = set(filter(None, os.getenv('PUSH_TRANSIENT_ERRORS', 'MessageRateExceeded').split(',')))
+PUSH_TRANSIENT_LIMIT = int(os.getenv('PUSH_TRANSIENT_LIMIT', '5'))  # Consecutive transient errors before a device is pruned
+
+def push_error_code(result):
+    """The Expo error code of an error ticket or receipt, e.g. 'DeviceNotRegistered'"""
+    details = result.get('details') or {}
+    return details.get('error') if isinstance(details, dict) else None
+
+def apply_push_outcomes(failures, delivered_device_ids=()):
+    """Bulk-update devices from ticket/receipt outcomes; the caller commits.
+
+    failures is a list of (device id, error code). Returns the number of devices deactivated.
+    """
+    now = datetime.utcnow()
+    deactivated = 0
+    by_code = {}
+    for device_id, code in failures:
+        if device_id is not None and code:
+            by_code.setdefault(code, []).append(device_id)
+    for code, device_ids in by_code.items():
+        if code in PUSH_PERMANENT_ERRORS:
+            deactivated += Device.query.filter(Device.id.in_(set(device_ids)), Device.is_active == True).update({
+                Device.is_active: False,
+                Device.deactivated_at: now,
+                Device.deactivation_reason: code,
+                Device.last_push_error: code
+            }, synchronize_session=False)
+        elif code in PUSH_TRANSIENT_ERRORS:
+            # One increment per failure; a device can appear more than once in a receipt page
+            counts = {}
+            for device_id in device_ids:
+                counts[device_id] = counts.get(device_id, 0) + 1
+            for increment in set(counts.values()):
+                ids = [device_id for device_id, n in counts.items() if n == increment]
+                Device.query.filter(Device.id.in_(ids)).update({
+                    Device.push_failures: func.coalesce(Device.push_failures, 0) + increment,
+                    Device.last_push_error: code
+                }, synchronize_session=False)
+            deactivated += Device.query.filter(
+                Device.id.in_(list(counts)),
+                Device.is_active == True,
+                Device.push_failures >= PUSH_TRANSIENT_LIMIT
+            ).update({
+                Device.is_active: False,
+                Device.deactivated_at: now,
+                Device.deactivation_reason: f"{PUSH_TRANSIENT_LIMIT}x {code}"
+            }, synchronize_session=False)
+    if delivered_device_ids:
+        Device.query.filter(Device.id.in_(set(delivered_device_ids)), Device.push_failures > 0).update(
+            {Device.push_failures: 0}, synchronize_session=False)
+    if deactivated:
+        print(f"🧹 Deactivated {deactivated} push devices with dead tokens")
+    return deactivated
+
+def insert_push_logs(rows, failures=None):
+    """Bulk-insert PushNotificationLog rows (plain dicts) with a single executemany, then prune dead tokens"""
+    if rows:
+        try:
+            db.session.execute(PushNotificationLog.__table__.insert(), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Failed to log {len(rows)} push notifications: {e}")
+    if failures:
+        try:
+            apply_push_outcomes(failures)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Failed to prune push devices: {e}")
+
+class PushLogWriter:
+    """Background thread that bulk-inserts push log rows, so the send loop never waits on the database.
+
+    Batches queued while an insert is running are coalesced into the next executemany. The queue is
+    bounded (PUSH_LOG_QUEUE_BATCHES) so a slow database applies back-pressure instead of growing memory.
+    """
+
+    def __init__(self, max_batches):
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, rows, failures=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+        self.queue.put((rows, failures or []))
+
+    def flush(self):
+        """Block until every submitted row has been written"""
+        if self.thread is not None:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            while len(pending) < PUSH_LOG_COALESCE_BATCHES:
                 try:
-                    historical_date = today.replace(year=today.year - year)
-                    historical_params = {
-                        'key': WEATHER_API_KEY,
-                        'q': location,
-                        'dt': historical_date.strftime('%Y-%m-%d')
-                    }
-                    historical_response = requests.get(historical_url, params=historical_params)
-                    
-                    if historical_response.status_code == 200:
-                        historical_data = historical_response.json()
-                        if 'forecast' in historical_data and historical_data['forecast']['forecastday']:
-                            historical_temp = historical_data['forecast']['forecastday'][0]['day']['maxtemp_f']
-                            historical_temps.append(historical_temp)
-                except Exception as e:
-                    print(f"Error fetching historical data for {location} year {year}: {e}")
-                    continue
-            
-            # Calculate average temperature
-            if historical_temps:
-                avg_temp = sum(historical_temps) / len(historical_temps)
-                print(f"{location}: Current temp {current_temp}°F, Avg temp {avg_temp:.1f}°F, Diff {current_temp - avg_temp:.1f}°F")
-            else:
-                # Fallback to hardcoded average if historical data fails
-                avg_temp = 85
-                print(f"{location}: Using fallback avg temp {avg_temp}°F")
-            
-            # Check if temperature exceeds threshold
-            if current_temp >= avg_temp + TEMP_THRESHOLD:
-                print(f"🌡️ TEMPERATURE ALERT: {location} is {current_temp - avg_temp:.1f}°F hotter than average!")
-                
-                # Send email notification
-                send_notification(subscriber.email, location, current_temp, avg_temp)
-                notifications_sent.append({
-                    'email': subscriber.email,
-                    'location': location,
-                    'current_temp': current_temp,
-                    'avg_temp': avg_temp,
-                    'threshold': TEMP_THRESHOLD,
-                    'source': 'WeatherKit'
-                })
-                
-                # Send push notification (only once per location)
-                if location not in processed_locations:
-                    send_push_notification(location, current_temp, avg_temp)
-                    processed_locations.add(location)
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with app.app_context():
+                    insert_push_logs([row for rows, _ in pending for row in rows],
+                                     [failure for _, failures in pending for failure in failures])
+            except Exception as e:
+                print(f"[ERROR] in push log writer: {e}")
+            finally:
+                for _ in pending:
+                    self.queue.task_done()
+
+push_log_writer = PushLogWriter(PUSH_LOG_QUEUE_BATCHES)
+
+def flush_push_logs():
+    """Wait for queued push logs to reach the database (no-op when logging synchronously)"""
+    if PUSH_LOG_ASYNC:
+        push_log_writer.flush()
+
+def start_push_campaign(title, body, data, kind='alert', location=None):
+    """Store a send's content once and return the campaign id its delivery rows point at"""
+    campaign = NotificationCampaign(
+        kind=kind,
+        location=location,
+        title=title,
+        body=body,
+        data=json.dumps(data) if data is not None else None
+    )
+    db.session.add(campaign)
+    db.session.commit()
+    return campaign.id
+
+def finish_push_campaign(campaign_id, stats):
+    """Record the send's aggregate counters once every batch has been logged"""
+    # Added rather than set: the receipt fetcher and push retries may already be updating this campaign
+    NotificationCampaign.query.filter_by(id=campaign_id).update({
+        NotificationCampaign.total: func.coalesce(NotificationCampaign.total, 0) + stats.get('devices', 0),
+        NotificationCampaign.successful: func.coalesce(NotificationCampaign.successful, 0) + stats['successful'],
+        NotificationCampaign.failed: func.coalesce(NotificationCampaign.failed, 0) + stats['failed'],
+        # Direct APNs/FCM acceptances are final, so they count as delivered straight away
+        NotificationCampaign.delivered: func.coalesce(NotificationCampaign.delivered, 0) + stats.get('delivered', 0),
+        NotificationCampaign.completed_at: datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+
+def log_push_batch(batch, tickets, error, stats, campaign_id, final=False):
+    """Log one dispatched batch as per-device delivery rows (bulk insert) and update stats in place.
+
+    final=True is for direct APNs/FCM results: an accepted message has no receipt to wait for,
+    so it is logged as 'delivered' straight away. Devices worth another attempt (failed batch,
+    missing ticket, transient error) are collected in stats['retry_device_ids'] for the retry queue,
+    and every device whose message was not accepted in stats['unsent_device_ids'].
+    """
+    stats['devices'] = stats.get('devices', 0) + len(batch)
+    retry_ids = stats.setdefault('retry_device_ids', [])
+    unsent_ids = stats.setdefault('unsent_device_ids', [])
+    if tickets is None:
+        stats['failed'] += len(batch)
+        stats['errors'].append(error)
+        stats['retry_error'] = error
+        retry_ids.extend(device.id for _, device in batch)
+    now = datetime.utcnow()
+    rows = []
+    failures = []  # (device id, Expo error code) for the pruning stage
+    for idx, (msg, device) in enumerate(batch):
+        row = {
+            'campaign_id': campaign_id,
+            'device_id': device.id,
+            'ticket_id': None,
+            'status': 'failure',
+            'error': error,
+            'timestamp': now,
+            'receipt_checked_at': None
+        }
+        ticket = tickets[idx] if tickets is not None and idx < len(tickets) else None
+        if ticket is not None:
+            row['ticket_id'] = ticket.get('id')
+            if ticket.get('status') == 'ok':
+                stats['successful'] += 1
+                row['status'] = 'success'
+                row['error'] = None
+                if final:
+                    stats['delivered'] = stats.get('delivered', 0) + 1
+                    row['status'] = 'delivered'
+                    row['receipt_checked_at'] = now
             else:
-                print(f"No alert for {location}: {current_temp}°F vs {avg_temp:.1f}°F avg (threshold: {TEMP_THRESHOLD}°F)")
-                
-        except Exception as e:
-            print(f"Error processing subscriber {subscriber.email}: {e}")
-            continue
-    
-    return jsonify({
-        'message': f'Processed {len(Subscriber.query.all())} subscribers with WeatherKit',
-        'notifications_sent': len(notifications_sent),
-        'threshold': TEMP_THRESHOLD,
-        'details': notifications_sent,
-        'source': 'WeatherKit'
-    })
+                stats['failed'] += 1
+                stats['errors'].append(ticket.get('message'))
+                row['status'] = 'ticket_error'
+                row['error'] = json.dumps(ticket)
+                failures.append((device.id, push_error_code(ticket)))
+                if is_retryable_push_error(ticket):
+                    retry_ids.append(device.id)
+                    stats['retry_error'] = ticket.get('message')
+        elif tickets is not None:
+            stats['failed'] += 1
+            row['error'] = 'No ticket returned'
+            retry_ids.append(device.id)
+        if row['status'] in ('failure', 'ticket_error'):
+            unsent_ids.append(device.id)
+        rows.append(row)
+    if PUSH_LOG_ASYNC:
+        push_log_writer.submit(rows, failures)
+    else:
+        insert_push_logs(rows, failures)
 
-def send_notification(email, location, current_temp, avg_temp, years=30):
-    """Send climate alert notification to subscriber (HTML email)"""
-    try:
-        temp_diff = round(current_temp - avg_temp, 1)
-        subject = f"🌡️ Climate Alert - {location} - IT'S TOO HOT!"
-        html_body = render_template(
-            'alert_email.html',
-            location=location,
-            current_temp=current_temp,
-            avg_temp=avg_temp,
-            temp_diff=temp_diff,
-            years=years
+def push_message(device, title, body, data, platform='expo', collapse_id=None, ttl=None):
+    message = {
+        "to": device.push_token,
+        "title": title,
+        "body": body,
+        "data": data,
+        "sound": "default",
+        "priority": "high"
+    }
+    if ttl:
+        message["ttl"] = ttl  # Undelivered alerts expire instead of arriving hours late
+    if collapse_id and platform != 'expo':
+        message["collapseId"] = collapse_id  # Expo's send API has no collapse key; APNs/FCM do
+    return message
+
+def push_campaign_options(kind, location):
+    """(collapse_id, ttl, capped) for a campaign kind: heat and test alerts for a place replace each
+    other and expire after PUSH_ALERT_TTL_SECONDS (look-ahead alerts only replace each other);
+    heat alerts also count against the frequency cap"""
+    capped = kind in PUSH_CAPPED_KINDS and PUSH_ALERT_MIN_INTERVAL_MINUTES > 0
+    if kind not in PUSH_COLLAPSED_KINDS:
+        return None, None, capped
+    key = normalize_location_key(location) or 'all'
+    if kind == 'early_alert':
+        key = f"{key}|tomorrow"  # Must not replace today's alert on the device
+    collapse_id = f"too-hot-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}"  # APNs allows 64 bytes
+    return collapse_id, PUSH_ALERT_TTL_SECONDS or None, capped
+
+def dispatch_push_platform(platform, messages, campaign_id, stats, lane='alert'):
+    """Send (message, device) pairs through the platform's provider, logging every batch into `stats`"""
+    if platform == 'expo':
+        dispatch_expo_push(
+            messages,
+            lambda batch, tickets, error: log_push_batch(batch, tickets, error, stats, campaign_id),
+            lane=lane
         )
-        msg = Message(
-            subject=subject,
-            sender=app.config['MAIL_DEFAULT_SENDER'],
-            recipients=[email],
-            html=html_body
+    else:
+        dispatch_direct_push(
+            platform,
+            messages,
+            lambda batch, tickets, error: log_push_batch(batch, tickets, error, stats, campaign_id, final=True),
+            lane=lane
         )
-        mail.send(msg)
-        print(f"Notification sent to {email}")
-    except Exception as e:
-        print(f"Failed to send notification to {email}: {e}")
 
-def send_push_notification(location, current_temp, avg_temp, years=30):
-    """Send push notification to devices in the specific location"""
+def fan_out_push(campaign_id, stats, title, body, data, location=None, lane='alert', kind=None):
+    """Send one notification to every active device (optionally in one location) on every push platform.
+
+    Expo devices go through Expo's batch API; 'apns' and 'fcm' devices go directly to Apple and
+    Google when those providers are configured. Results accumulate in `stats` via log_push_batch(),
+    and devices that could not be reached are queued for retry per platform. For capped kinds,
+    devices alerted within PUSH_ALERT_MIN_INTERVAL_MINUTES are skipped (stats['capped']), and the
+    claims on devices the send did not reach are released so the cap only counts accepted alerts.
+    """
+    collapse_id, ttl, capped = push_campaign_options(kind, location)
+    cap_since = datetime.utcnow() - timedelta(minutes=PUSH_ALERT_MIN_INTERVAL_MINUTES) if capped else None
+    for platform in push_platforms():
+        messages = ((push_message(device, title, body, data, platform, collapse_id, ttl), device)
+                    for device in iter_push_devices(location, platform, cap_since=cap_since, stats=stats))
+        try:
+            dispatch_push_platform(platform, messages, campaign_id, stats, lane)
+        except Exception as e:
+            # One provider failing (bad credentials, outage) must not stop the others
+            print(f"❌ {platform} push fan-out failed: {e}")
+            stats['errors'].append(f"{platform}: {e}")
+            if capped:
+                release_push_claims(stats)
+        unsent_ids = stats.pop('unsent_device_ids', [])
+        if capped:
+            release_push_claims(stats, unsent_ids)
+        stats.pop('claim_stamps', None)  # Claims are released per platform
+        stats['retry_queued'] = stats.get('retry_queued', 0) + enqueue_push_retries(
+            campaign_id, platform, stats.pop('retry_device_ids', []), stats.pop('retry_error', None), lane=lane)
+    flush_push_logs()
+
+def send_push_notification(location, current_temp, avg_temp, years=30, day_label='Today', kind='alert'):
+    """Send push notification to devices in the specific location ('test' kinds ride the bulk lane)"""
     try:
         temp_diff = round(current_temp - avg_temp, 1)
+        if day_label == 'Today':
+            push_body = f"Temperature is {temp_diff}°F hotter than average. Wear your shirt!"
+        else:
+            push_body = f"{day_label} will be {temp_diff}°F hotter than average. Get your shirt ready!"
         
-        # Get active devices for this specific location
-        devices = Device.query.filter_by(is_active=True, location=location).all()
-        
-        if not devices:
-            print(f"No active devices found for location: {location}")
+        title = f"🌡️ IT'S TOO HOT! - {location}"
+        data = {
+            "location": location,
+            "current_temp": current_temp,
+            "avg_temp": avg_temp,
+            "temp_diff": temp_diff,
+            "day": day_label.lower()
+        }
+        if not any(next(iter_push_devices(location, platform, page_size=1), None) for platform in push_platforms()):
+            print(f"No active push devices found for location: {location}")
             return
-        
-        # For Expo push notifications, we need to send to Expo's servers
-        # This is a simplified version - in production you'd use Expo's SDK
-        expo_tokens = [device.push_token for device in devices if device.platform == 'expo']
-        
-        if expo_tokens:
-            # Send to Expo push service
-            expo_url = "https://exp.host/--/api/v2/push/send"
-            
-            messages = []
-            for token in expo_tokens:
-                messages.append({
-                    "to": token,
-                    "title": f"🌡️ IT'S TOO HOT! - {location}",
-                    "body": f"Temperature is {temp_diff}°F hotter than average. Wear your shirt!",
-                    "data": {
-                        "location": location,
-                        "current_temp": current_temp,
-                        "avg_temp": avg_temp,
-                        "temp_diff": temp_diff
-                    },
-                    "sound": "default",
-                    "priority": "high"
-                })
-            
-            # Send in batches of 100 (Expo limit)
-            batch_size = 100
-            for i in range(0, len(messages), batch_size):
-                batch = messages[i:i + batch_size]
-                response = requests.post(expo_url, json=batch, headers={
-                    'Content-Type': 'application/json'
-                })
-                
-                if response.status_code == 200:
-                    print(f"✅ Push notifications sent to {len(batch)} devices in {location}")
-                else:
-                    print(f"❌ Failed to send push notifications to {location}: {response.text}")
-        else:
-            print(f"No Expo devices found for location: {location}")
+        campaign_id = start_push_campaign(title, push_body, data, kind, location)
+        stats = {'successful': 0, 'failed': 0, 'errors': []}
+        started = time.time()
+        # Active devices for this location, streamed page by page per platform
+        fan_out_push(campaign_id, stats, title, push_body, data, location, push_lane(kind), kind)
+        finish_push_campaign(campaign_id, stats)
+        print(f"✅ Push notifications for {location}: {stats['successful']} sent, {stats['failed']} failed "
+              f"({stats['retry_queued']} queued for retry, {stats.get('capped', 0)} capped) "
+              f"in {time.time() - started:.1f}s")
         
     except Exception as e:
         print(f"Failed to send push notifications for {location}: {e}")
 
+# --- Push Retry Queue ---
+# Devices a send could not reach (failed batch POST, non-200 response, missing ticket, transient
+# error) are stored in push_retry and re-sent by a dispatcher thread in each worker with
+# exponential backoff. Rows are claimed with a conditional UPDATE, as in the email outbox.
+# After PUSH_RETRY_MAX_ATTEMPTS the remaining devices move to push_dead_letter.
+PUSH_RETRY_ENABLED = os.getenv('PUSH_RETRY_ENABLED', 'true').lower() == 'true'
+PUSH_RETRY_POLL_SECONDS = float(os.getenv('PUSH_RETRY_POLL_SECONDS', '15'))
+PUSH_RETRY_MAX_ATTEMPTS = int(os.getenv('PUSH_RETRY_MAX_ATTEMPTS', '5'))
+PUSH_RETRY_BASE_SECONDS = 60  # Backoff doubles per attempt: 1m, 2m, 4m, ...
+PUSH_RETRY_MAX_SECONDS = 1800
+PUSH_RETRY_BATCH_DEVICES = 1000  # Devices per retry row
+PUSH_RETRY_CLAIM_LIMIT = 20  # Retry rows claimed per dispatcher pass
+PUSH_RETRY_CLAIM_TIMEOUT_SECONDS = 600  # Claims older than this (crashed worker) are picked up again
+
+push_retry_wakeup = threading.Event()
+
+def is_retryable_push_error(ticket):
+    """True for error tickets worth re-sending: transient codes and transport errors without a code"""
+    code = push_error_code(ticket)
+    return code is None or code in PUSH_TRANSIENT_ERRORS
+
+def push_retry_delay(attempts):
+    return min(PUSH_RETRY_BASE_SECONDS * (2 ** attempts), PUSH_RETRY_MAX_SECONDS)
+
+def enqueue_push_retries(campaign_id, platform, device_ids, error=None, delay=None, lane='alert'):
+    """Queue devices for another attempt at the campaign, PUSH_RETRY_BATCH_DEVICES per row"""
+    device_ids = list(dict.fromkeys(device_ids))
+    if not device_ids:
+        return 0
+    next_attempt_at = datetime.utcnow() + timedelta(seconds=push_retry_delay(0) if delay is None else delay)
+    try:
+        for start in range(0, len(device_ids), PUSH_RETRY_BATCH_DEVICES):
+            db.session.add(PushRetry(
+                campaign_id=campaign_id,
+                platform=platform,
+                device_ids=json.dumps(device_ids[start:start + PUSH_RETRY_BATCH_DEVICES]),
+                priority=PUSH_LANE_PRIORITY[lane],
+                status='pending',
+                attempts=0,
+                next_attempt_at=next_attempt_at,
+                last_error=str(error)[:1000] if error else None
+            ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Failed to queue {len(device_ids)} {platform} devices for push retry: {e}")
+        return 0
+    print(f"🔁 Queued {len(device_ids)} {platform} devices from campaign {campaign_id} for push retry")
+    push_retry_wakeup.set()
+    return len(device_ids)
+
+def claim_push_retries(limit=None):
+    """Claim up to `limit` due retry rows for this dispatcher and return them"""
+    limit = limit or PUSH_RETRY_CLAIM_LIMIT
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=PUSH_RETRY_CLAIM_TIMEOUT_SECONDS)
+    due = db.or_(
+        and_(PushRetry.status == 'pending', PushRetry.next_attempt_at <= now),
+        and_(PushRetry.status == 'sending', PushRetry.claimed_at < stale)
+    )
+    # Alert retries are claimed before bulk ones
+    ids = [row_id for (row_id,) in db.session.query(PushRetry.id).filter(due)
+           .order_by(PushRetry.priority, PushRetry.next_attempt_at).limit(limit).all()]
+    if not ids:
+        return []
+    token = os.urandom(16).hex()
+    # Only rows still due when the UPDATE runs are taken; another worker may have claimed the rest
+    PushRetry.query.filter(PushRetry.id.in_(ids), due).update(
+        {'status': 'sending', 'claim_token': token, 'claimed_at': now},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return PushRetry.query.filter_by(claim_token=token, status='sending').all()
+
+def retry_push_row(row):
+    """Re-send one claimed retry row; reschedule what still failed, or dead-letter it after the last attempt"""
+    stats = {'successful': 0, 'failed': 0, 'errors': []}
+    error = None
+    campaign = db.session.get(NotificationCampaign, row.campaign_id)
+    if campaign is None:
+        db.session.delete(row)
+        db.session.commit()
+        return stats
+    try:
+        data = json.loads(campaign.data) if campaign.data else None
+        collapse_id, ttl, capped = push_campaign_options(campaign.kind, campaign.location)
+        # Devices deactivated since the failure (dead tokens) are dropped
+        query = db.session.query(Device.id, Device.push_token, Device.device_type).filter(
+            Device.id.in_(json.loads(row.device_ids)),
+            Device.is_active == True,
+            Device.platform == row.platform
+        )
+        if capped:
+            # Claims stamped after this row was queued belong to a newer alert, which supersedes this one
+            query = query.filter(or_(Device.last_alert_sent_at == None, Device.last_alert_sent_at <= row.created_at))
+        devices = query.order_by(Device.id).all()
+        dispatch_push_platform(
+            row.platform,
+            [(push_message(device, campaign.title, campaign.body, data, row.platform, collapse_id, ttl), device)
+             for device in devices],
+            campaign.id,
+            stats,
+            push_lane(campaign.kind)
+        )
+        flush_push_logs()
+        if capped:
+            # The original fan-out released these devices' claims when it failed to reach them
+            unsent = set(stats.get('unsent_device_ids', []))
+            stamp_push_claims([device.id for device in devices if device.id not in unsent], row.created_at)
+        remaining = list(dict.fromkeys(stats.get('retry_device_ids', [])))
+        error = stats.get('retry_error')
+    except Exception as e:
+        db.session.rollback()
+        remaining = json.loads(row.device_ids)
+        error = str(e)
+    # The original send counted these devices as failed; move the ones reached now over to successful
+    NotificationCampaign.query.filter_by(id=campaign.id).update({
+        NotificationCampaign.successful: func.coalesce(NotificationCampaign.successful, 0) + stats['successful'],
+        NotificationCampaign.failed: func.coalesce(NotificationCampaign.failed, 0) - stats['successful'],
+        NotificationCampaign.delivered: func.coalesce(NotificationCampaign.delivered, 0) + stats.get('delivered', 0)
+    }, synchronize_session=False)
+    attempts = (row.attempts or 0) + 1
+    if not remaining:
+        db.session.delete(row)
+    elif attempts >= PUSH_RETRY_MAX_ATTEMPTS:
+        db.session.add(PushDeadLetter(
+            campaign_id=row.campaign_id,
+            platform=row.platform,
+            device_ids=json.dumps(remaining),
+            attempts=attempts,
+            last_error=str(error)[:1000] if error else row.last_error,
+            first_failed_at=row.created_at
+        ))
+        db.session.delete(row)
+        print(f"❌ Giving up on {len(remaining)} {row.platform} devices from campaign {row.campaign_id} "
+              f"after {attempts} retries: {error}")
+    else:
+        delay = push_retry_delay(attempts)
+        row.device_ids = json.dumps(remaining)
+        row.attempts = attempts
+        row.status = 'pending'
+        row.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        row.claim_token = None
+        row.claimed_at = None
+        row.last_error = str(error)[:1000] if error else None
+        print(f"⚠️ Push retry {row.id}: {len(remaining)} {row.platform} devices still failing "
+              f"(attempt {attempts}), retrying in {delay}s: {error}")
+    db.session.commit()
+    return stats
+
+def dispatch_push_retries():
+    """Re-send one claimed set of due retries. Returns the number of retry rows processed."""
+    with app.app_context():
+        rows = claim_push_retries()
+        reached = 0
+        for row in rows:
+            try:
+                reached += retry_push_row(row)['successful']
+            except Exception as e:
+                db.session.rollback()
+                print(f"[ERROR] retrying push row {row.id}: {e}")
+        if rows:
+            print(f"🔁 Push retries: {reached} devices reached from {len(rows)} queued batches")
+        return len(rows)
+
+def get_push_retry_status():
+    counts = dict(db.session.query(PushRetry.status, db.func.count(PushRetry.id))
+                  .group_by(PushRetry.status).all())
+    next_due = db.session.query(db.func.min(PushRetry.next_attempt_at)).filter(PushRetry.status == 'pending').scalar()
+    return {
+        'pending': counts.get('pending', 0),
+        'sending': counts.get('sending', 0),
+        'dead_letters': PushDeadLetter.query.count(),
+        'next_attempt_at': next_due.isoformat() if next_due else None
+    }
+
+def start_push_retry_dispatcher():
+    def run():
+        while True:
+            try:
+                # Keep draining while there is a backlog; otherwise sleep until woken or the poll interval
+                if dispatch_push_retries() >= PUSH_RETRY_CLAIM_LIMIT:
+                    continue
+            except Exception as e:
+                print(f"[ERROR] in push retry dispatcher: {e}")
+            push_retry_wakeup.wait(PUSH_RETRY_POLL_SECONDS)
+            push_retry_wakeup.clear()
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    atexit.register(lambda: t.join(timeout=1))
+
 # --- Update /api/subscribers to use DB ---
 @app.route('/api/subscribers', methods=['GET'])
 def get_subscribers():
@@ -1793,73 +4476,315 @@ def admin_get_logs():
     trigger_log = load_json_file('trigger_log.json', default=[])
     return jsonify({'notification_log': notif_log, 'trigger_log': trigger_log})
 
+# --- API to get remaining provider budgets (for dashboard AJAX) ---
+@app.route('/admin/quota', methods=['GET'])
+@requires_auth
+def admin_get_quota():
+    return jsonify({'providers': [get_provider_quota_status(provider) for provider in PROVIDER_QUOTAS]})
+
+# --- API to get email outbox status (for dashboard AJAX) ---
+@app.route('/admin/email-outbox', methods=['GET'])
+@requires_auth
+def admin_get_email_outbox():
+    status = get_email_outbox_status()
+    with smtp_stats_lock:
+        status['smtp_connections'] = [{k: v for k, v in stats.items() if k != 'started'}
+                                      for stats in smtp_connection_stats]
+    latencies = sorted(smtp_send_latencies)
+    status['smtp_send_ms'] = {
+        'samples': len(latencies),
+        'p50': round(latencies[len(latencies) // 2], 1) if latencies else None,
+        'p99': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1) if latencies else None
+    }
+    status['recent_failures'] = [row.as_dict() for row in EmailOutbox.query.filter_by(status='failed')
+                                 .order_by(EmailOutbox.id.desc()).limit(20).all()]
+    return jsonify(status)
+
+# --- Push retry queue and dead letters ---
+@app.route('/admin/push-retries', methods=['GET'])
+@requires_auth
+def admin_get_push_retries():
+    status = get_push_retry_status()
+    status['queued'] = [row.as_dict() for row in PushRetry.query.order_by(PushRetry.priority, PushRetry.next_attempt_at)
+                        .limit(50).all()]
+    status['lanes'] = {provider: scheduler.status() for provider, scheduler in push_lanes.items()}
+    status['recent_dead_letters'] = [row.as_dict() for row in PushDeadLetter.query
+                                     .order_by(PushDeadLetter.id.desc()).limit(20).all()]
+    return jsonify(status)
+
+@app.route('/admin/push-dead-letters/<int:dead_letter_id>/requeue', methods=['POST'])
+@requires_auth
+def admin_requeue_push_dead_letter(dead_letter_id):
+    dead_letter = db.session.get(PushDeadLetter, dead_letter_id)
+    if dead_letter is None:
+        return jsonify({'success': False, 'error': 'Dead letter not found'}), 404
+    campaign = db.session.get(NotificationCampaign, dead_letter.campaign_id)
+    queued = enqueue_push_retries(dead_letter.campaign_id, dead_letter.platform,
+                                  json.loads(dead_letter.device_ids), dead_letter.last_error, delay=0,
+                                  lane=push_lane(campaign.kind if campaign else None))
+    if not queued:
+        return jsonify({'success': False, 'error': 'Could not queue retry'}), 500
+    db.session.delete(dead_letter)
+    db.session.commit()
+    return jsonify({'success': True, 'queued_devices': queued})
+
+# --- Process bounce mailbox now and list suppressed addresses ---
+@app.route('/admin/bounces', methods=['GET', 'POST'])
+@requires_auth
+def admin_bounces():
+    summary = None
+    if request.method == 'POST':
+        try:
+            summary = ingest_bounces()
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
+    suppressed = Subscriber.query.filter(Subscriber.suppressed == True).order_by(Subscriber.suppressed_at.desc()).limit(100).all()
+    return jsonify({
+        'success': True,
+        'processed': summary,
+        'suppressed_count': Subscriber.query.filter(Subscriber.suppressed == True).count(),
+        'suppressed': [dict(s.as_dict(), suppressed_at=s.suppressed_at.isoformat() if s.suppressed_at else None)
+                       for s in suppressed],
+        'recent_events': [e.as_dict() for e in BounceEvent.query.order_by(BounceEvent.id.desc()).limit(50).all()]
+    })
+
+# --- Receipt fetcher leader, last run and backlog ---
+@app.route('/admin/receipt-fetcher', methods=['GET', 'POST'])
+@requires_auth
+def admin_receipt_fetcher():
+    run = None
+    if request.method == 'POST':
+        run = run_receipt_fetcher_pass()
+    status = get_receipt_fetcher_status()
+    if request.method == 'POST':
+        status['ran'] = run is not None
+    return jsonify(status)
+
+# --- Push campaign stats (one row per send) ---
+@app.route('/admin/push-campaigns', methods=['GET'])
+@requires_auth
+def admin_push_campaigns():
+    limit = int(request.args.get('limit', 50))
+    campaigns = NotificationCampaign.query.order_by(NotificationCampaign.id.desc()).limit(limit).all()
+    return jsonify({'campaigns': [c.as_dict() for c in campaigns]})
+
+@app.route('/admin/push-campaigns/<int:campaign_id>', methods=['GET'])
+@requires_auth
+def admin_push_campaign(campaign_id):
+    campaign = db.session.get(NotificationCampaign, campaign_id)
+    if campaign is None:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return jsonify(campaign.as_dict())
+
+# --- Service Leases ---
+# Background jobs that must run once per deployment (not once per gunicorn worker or Cloud Run
+# instance) take a lease row first. Taking it is a single conditional UPDATE, so two processes
+# can't both win; a leader that dies simply lets the lease expire.
+SERVICE_LEASE_HOLDER = f"{os.uname().nodename}:{os.getpid()}:{os.urandom(4).hex()}"
+
+def acquire_service_lease(name, holder=None, ttl_seconds=600):
+    """Take or renew the named lease for `holder`; True when this process is the leader"""
+    holder = holder or SERVICE_LEASE_HOLDER
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    try:
+        if db.session.get(ServiceLease, name) is None:
+            db.session.add(ServiceLease(name=name, holder=holder, expires_at=expires_at))
+            db.session.commit()
+            return True
+    except IntegrityError:
+        db.session.rollback()  # Another process created it first; fall through to the conditional update
+    taken = ServiceLease.query.filter(
+        ServiceLease.name == name,
+        or_(ServiceLease.holder == holder, ServiceLease.expires_at < now)
+    ).update({ServiceLease.holder: holder, ServiceLease.expires_at: expires_at}, synchronize_session=False)
+    db.session.commit()
+    return taken == 1
+
+def release_service_lease(name, holder=None):
+    """Give the lease up early (e.g. on shutdown) so another process can take over at once"""
+    holder = holder or SERVICE_LEASE_HOLDER
+    ServiceLease.query.filter_by(name=name, holder=holder).update(
+        {ServiceLease.expires_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+def record_service_run(name, started_at, summary=None, error=None, holder=None):
+    """Store the outcome of a leader's run on its lease row for the status endpoints"""
+    holder = holder or SERVICE_LEASE_HOLDER
+    ServiceLease.query.filter_by(name=name, holder=holder).update({
+        ServiceLease.last_run_started_at: started_at,
+        ServiceLease.last_run_finished_at: datetime.utcnow(),
+        ServiceLease.last_run_summary: json.dumps(summary) if summary is not None else None,
+        ServiceLease.last_error: error
+    }, synchronize_session=False)
+    db.session.commit()
+
 # --- Expo Push Receipt Fetcher ---
-RECEIPT_FETCH_INTERVAL = 900  # 15 minutes
+RECEIPT_FETCH_INTERVAL = int(os.getenv('RECEIPT_FETCH_INTERVAL', '900'))  # 15 minutes
 RECEIPT_LOOKBACK_MINUTES = 30  # How far back to look for tickets
+RECEIPT_BATCH_SIZE = 1000  # Expo's getReceipts limit, and the keyset page size
+RECEIPT_FETCHER_MODE = os.getenv('RECEIPT_FETCHER_MODE', 'lease')  # 'lease' = thread in every worker, one leads; 'off' = run receipt_fetcher.py
+RECEIPT_FETCHER_LEASE = 'receipt_fetcher'
+RECEIPT_LEASE_SECONDS = RECEIPT_FETCH_INTERVAL * 2  # A dead leader is replaced within two intervals
 
 def fetch_and_update_push_receipts():
+    """Poll Expo for receipts of unchecked tickets, a keyset page (one getReceipts call) at a time.
+
+    Only rows with receipt_checked_at NULL are read, through ix_push_notification_log_receipt_pending,
+    so the cost follows the number of pending tickets rather than the size of the log.
+    """
     with app.app_context():
-        # Find logs with ticket_id and status 'success' but not yet updated with receipt
-        cutoff = datetime.utcnow() - timedelta(minutes=RECEIPT_LOOKBACK_MINUTES)
-        logs = PushNotificationLog.query.filter(
-            and_(
+        table = PushNotificationLog.__table__
+        now = datetime.utcnow()
+        cutoff = now - timedelta(minutes=RECEIPT_LOOKBACK_MINUTES)
+        # Close out tickets too old to be worth polling so the pending set stays small
+        expired = db.session.execute(table.update().where(and_(
+            table.c.receipt_checked_at == None,
+            table.c.status == 'success',
+            table.c.timestamp < cutoff
+        )).values(receipt_checked_at=now)).rowcount
+        db.session.commit()
+        mark_checked = table.update().where(table.c.id == bindparam('log_id')).values(
+            status=bindparam('new_status'),
+            error=bindparam('new_error'),
+            receipt_checked_at=bindparam('checked_at')
+        )
+        checked = 0
+        fetch_error = None
+        last_id = 0
+        while True:
+            page = db.session.query(PushNotificationLog.id, PushNotificationLog.ticket_id,
+                                    PushNotificationLog.campaign_id, PushNotificationLog.device_id).filter(
+                PushNotificationLog.receipt_checked_at == None,
                 PushNotificationLog.status == 'success',
-                PushNotificationLog.timestamp >= cutoff,
-                PushNotificationLog.data != None
-            )
-        ).all()
-        ticket_id_map = {}
-        for log in logs:
-            try:
-                data = json.loads(log.data)
-                ticket_id = data.get('ticket_id')
-                if ticket_id:
-                    ticket_id_map[ticket_id] = log
-            except Exception:
-                continue
-        if not ticket_id_map:
-            return
-        # Query Expo receipts in batches of 1000
-        ticket_ids = list(ticket_id_map.keys())
-        batch_size = 1000
-        for i in range(0, len(ticket_ids), batch_size):
-            batch = ticket_ids[i:i+batch_size]
+                PushNotificationLog.id > last_id,
+                PushNotificationLog.ticket_id != None
+            ).order_by(PushNotificationLog.id).limit(RECEIPT_BATCH_SIZE).all()
+            if not page:
+                break
+            last_id = page[-1].id
             try:
-                resp = requests.post(
-                    'https://exp.host/--/api/v2/push/getReceipts',
+                resp = provider_request(
+                    'expo', 'POST',
+                    EXPO_RECEIPTS_URL,
                     headers={'Content-Type': 'application/json'},
-                    json={'ids': batch}
+                    json={'ids': [row.ticket_id for row in page]}
                 )
-                if resp.status_code == 200:
-                    data = resp.json().get('data', {})
-                    for tid, receipt in data.items():
-                        log = ticket_id_map.get(tid)
-                        if log:
-                            # Update log with receipt status and details
-                            log.data = json.dumps({**json.loads(log.data), 'receipt': receipt})
-                            if receipt.get('status') == 'ok':
-                                log.status = 'delivered'
-                                log.error = None
-                            else:
-                                log.status = 'delivery_error'
-                                log.error = json.dumps(receipt)
-                    db.session.commit()
+                if resp.status_code != 200:
+                    fetch_error = f"HTTP {resp.status_code}"
+                    print(f"[ERROR] Failed to fetch push receipts: {fetch_error}")
+                    break
+                receipts = resp.json().get('data', {})
             except Exception as e:
+                fetch_error = str(e)
                 print(f"[ERROR] Failed to fetch push receipts: {e}")
+                break
+            updates = []
+            campaign_counts = {}  # campaign id -> [delivered, delivery_errors]
+            failures, delivered_devices = [], []
+            for row in page:
+                receipt = receipts.get(row.ticket_id)
+                if receipt is None:
+                    continue  # Not ready yet; stays pending for the next pass
+                ok = receipt.get('status') == 'ok'
+                updates.append({
+                    'log_id': row.id,
+                    'new_status': 'delivered' if ok else 'delivery_error',
+                    'new_error': None if ok else json.dumps(receipt),
+                    'checked_at': now
+                })
+                counts = campaign_counts.setdefault(row.campaign_id, [0, 0])
+                counts[0 if ok else 1] += 1
+                if row.device_id is not None:
+                    if ok:
+                        delivered_devices.append(row.device_id)
+                    else:
+                        failures.append((row.device_id, push_error_code(receipt)))
+            try:
+                if updates:
+                    db.session.execute(mark_checked, updates)
+                apply_push_outcomes(failures, delivered_devices)
+                for campaign_id, (delivered, delivery_errors) in campaign_counts.items():
+                    if campaign_id is None:
+                        continue
+                    NotificationCampaign.query.filter_by(id=campaign_id).update({
+                        NotificationCampaign.delivered: NotificationCampaign.delivered + delivered,
+                        NotificationCampaign.delivery_errors: NotificationCampaign.delivery_errors + delivery_errors
+                    }, synchronize_session=False)
+                db.session.commit()
+                checked += len(updates)
+            except Exception as e:
+                db.session.rollback()
+                fetch_error = str(e)
+                print(f"[ERROR] Failed to record push receipts: {e}")
+            if len(page) < RECEIPT_BATCH_SIZE:
+                break
+        if checked or expired:
+            print(f"📬 Push receipts: {checked} recorded, {expired} expired unchecked")
+        return {'recorded': checked, 'expired': expired, 'error': fetch_error}
+
+def run_receipt_fetcher_pass():
+    """Fetch receipts if this process holds (or can take) the lease; returns the summary, or None when not leader"""
+    with app.app_context():
+        if not acquire_service_lease(RECEIPT_FETCHER_LEASE, ttl_seconds=RECEIPT_LEASE_SECONDS):
+            return None
+        started_at = datetime.utcnow()
+        summary, error = None, None
+        try:
+            summary = fetch_and_update_push_receipts()
+            error = summary.get('error')
+        except Exception as e:
+            error = str(e)
+            print(f"[ERROR] in receipt fetcher: {e}")
+        record_service_run(RECEIPT_FETCHER_LEASE, started_at, summary, error)
+        return summary
+
+def get_receipt_fetcher_status():
+    """Lease holder, last run and the pending-ticket backlog"""
+    lease = db.session.get(ServiceLease, RECEIPT_FETCHER_LEASE)
+    pending = PushNotificationLog.query.filter(
+        PushNotificationLog.receipt_checked_at == None,
+        PushNotificationLog.status == 'success',
+        PushNotificationLog.ticket_id != None
+    )
+    oldest = pending.order_by(PushNotificationLog.id).first()
+    status = lease.as_dict() if lease else {'name': RECEIPT_FETCHER_LEASE, 'holder': None}
+    status.update({
+        'mode': RECEIPT_FETCHER_MODE,
+        'leader_active': bool(lease and lease.expires_at > datetime.utcnow()),
+        'interval_seconds': RECEIPT_FETCH_INTERVAL,
+        'pending_tickets': pending.count(),
+        'oldest_pending_at': oldest.timestamp.isoformat() if oldest and oldest.timestamp else None
+    })
+    return status
 
 def start_receipt_fetcher():
     def run():
         while True:
             try:
-                fetch_and_update_push_receipts()
+                run_receipt_fetcher_pass()
             except Exception as e:
                 print(f"[ERROR] in receipt fetcher: {e}")
             time.sleep(RECEIPT_FETCH_INTERVAL)
+    def release():
+        try:
+            with app.app_context():
+                release_service_lease(RECEIPT_FETCHER_LEASE)
+        except Exception as e:
+            print(f"[ERROR] releasing receipt fetcher lease: {e}")
     t = threading.Thread(target=run, daemon=True)
     t.start()
     atexit.register(lambda: t.join(timeout=1))
+    atexit.register(release)  # Runs first (LIFO), so a restarting worker hands over immediately
+
+if RECEIPT_FETCHER_MODE == 'lease':
+    start_receipt_fetcher()
 
-start_receipt_fetcher()
+if EMAIL_DISPATCHER_ENABLED:
+    start_email_dispatcher()
+
+if PUSH_RETRY_ENABLED:
+    start_push_retry_dispatcher()
 
 # --- Update /api/send-push-notification to log ticket info ---
 @app.route('/api/send-push-notification', methods=['POST'])
@@ -1872,9 +4797,8 @@ def api_send_push_notification():
     current_temp = data.get('current_temp')
     avg_temp = data.get('avg_temp')
     
-    devices = Device.query.filter_by(is_active=True).all()
-    expo_tokens = [device.push_token for device in devices if device.platform == 'expo']
-    if not expo_tokens:
+    total_subscribers = Device.query.filter(Device.is_active == True, Device.platform.in_(push_platforms())).count()
+    if not total_subscribers:
         # Log the attempt
         log = PushNotificationLog(
             device_id=None,
@@ -1891,120 +4815,27 @@ def api_send_push_notification():
         db.session.commit()
         return jsonify({'success': False, 'message': 'No Expo push tokens registered', 'total_subscribers': 0}), 200
     
-    expo_url = "https://exp.host/--/api/v2/push/send"
-    messages = []
-    device_map = {}
-    for device in devices:
-        if device.platform == 'expo':
-            msg = {
-                "to": device.push_token,
-                "title": title,
-                "body": body,
-                "data": {
-                    "url": url,
-                    "location": location,
-                    "current_temp": current_temp,
-                    "avg_temp": avg_temp
-                },
-                "sound": "default",
-                "priority": "high"
-            }
-            messages.append(msg)
-            device_map[device.push_token] = device
-    batch_size = 100
-    successful_sends = 0
-    failed_sends = 0
-    errors = []
-    for i in range(0, len(messages), batch_size):
-        batch = messages[i:i + batch_size]
-        tokens = [msg['to'] for msg in batch]
-        try:
-            response = requests.post(expo_url, json=batch, headers={'Content-Type': 'application/json'})
-            if response.status_code == 200:
-                resp_data = response.json()
-                tickets = resp_data.get('data', [])
-                for idx, ticket in enumerate(tickets):
-                    msg = batch[idx]
-                    device = device_map.get(msg['to'])
-                    ticket_id = ticket.get('id')
-                    log_data = {
-                        'url': url,
-                        'ticket_id': ticket_id,
-                        'ticket_status': ticket.get('status'),
-                        'ticket_message': ticket.get('message'),
-                        'ticket_details': ticket.get('details')
-                    }
-                    if ticket.get('status') == 'ok':
-                        successful_sends += 1
-                        log = PushNotificationLog(
-                            device_id=device.id if device else None,
-                            push_token=msg['to'],
-                            platform='expo',
-                            device_type=device.device_type if device else None,
-                            title=title,
-                            body=body,
-                            data=json.dumps(log_data),
-                            status='success',
-                            error=None
-                        )
-                    else:
-                        failed_sends += 1
-                        errors.append(ticket.get('message'))
-                        log = PushNotificationLog(
-                            device_id=device.id if device else None,
-                            push_token=msg['to'],
-                            platform='expo',
-                            device_type=device.device_type if device else None,
-                            title=title,
-                            body=body,
-                            data=json.dumps(log_data),
-                            status='ticket_error',
-                            error=json.dumps(ticket)
-                        )
-                    db.session.add(log)
-                db.session.commit()
-            else:
-                failed_sends += len(batch)
-                errors.append(response.text)
-                for msg in batch:
-                    device = device_map.get(msg['to'])
-                    log = PushNotificationLog(
-                        device_id=device.id if device else None,
-                        push_token=msg['to'],
-                        platform='expo',
-                        device_type=device.device_type if device else None,
-                        title=title,
-                        body=body,
-                        data=json.dumps({'url': url}),
-                        status='failure',
-                        error=response.text
-                    )
-                    db.session.add(log)
-                db.session.commit()
-        except Exception as e:
-            failed_sends += len(batch)
-            errors.append(str(e))
-            for msg in batch:
-                device = device_map.get(msg['to'])
-                log = PushNotificationLog(
-                    device_id=device.id if device else None,
-                    push_token=msg['to'],
-                    platform='expo',
-                    device_type=device.device_type if device else None,
-                    title=title,
-                    body=body,
-                    data=json.dumps({'url': url}),
-                    status='failure',
-                    error=str(e)
-                )
-                db.session.add(log)
-            db.session.commit()
+    push_data = {
+        "url": url,
+        "location": location,
+        "current_temp": current_temp,
+        "avg_temp": avg_temp
+    }
+    campaign_id = start_push_campaign(title, body, push_data, 'manual', location)
+    stats = {'successful': 0, 'failed': 0, 'errors': []}
+    fan_out_push(campaign_id, stats, title, body, push_data, lane=push_lane('manual'), kind='manual')
+    finish_push_campaign(campaign_id, stats)
+    successful_sends = stats['successful']
+    failed_sends = stats['failed']
+    errors = stats['errors']
     return jsonify({
         'success': failed_sends == 0,
         'message': 'Push notifications sent' if failed_sends == 0 else 'Some notifications failed',
         'successful_sends': successful_sends,
         'failed_sends': failed_sends,
-        'total_subscribers': len(expo_tokens),
+        'total_subscribers': total_subscribers,
+        'campaign_id': campaign_id,
+        'queued_for_retry': stats.get('retry_queued', 0),
         'errors': errors
     })
 
@@ -2064,6 +4895,19 @@ def log_debug():
     print(f"📱 Mobile log saved: {source} - {message[:50]}...")
     return jsonify({'success': True, 'log_id': log.id})
 
+def push_logs_as_dicts(logs):
+    """Serialize push logs, filling campaign rows' title/body/data from their campaign"""
+    campaign_ids = {l.campaign_id for l in logs if l.campaign_id}
+    campaigns = {c.id: c for c in NotificationCampaign.query.filter(NotificationCampaign.id.in_(campaign_ids)).all()} if campaign_ids else {}
+    result = []
+    for l in logs:
+        entry = l.as_dict()
+        campaign = campaigns.get(l.campaign_id)
+        if campaign is not None:
+            entry.update(title=campaign.title, body=campaign.body, data=campaign.data)
+        result.append(entry)
+    return result
+
 # --- API: Fetch Logs ---
 @app.route('/api/logs', methods=['GET'])
 def get_logs():
@@ -2071,7 +4915,7 @@ def get_logs():
     limit = int(request.args.get('limit', 100))
     if log_type == 'push':
         logs = PushNotificationLog.query.order_by(PushNotificationLog.timestamp.desc()).limit(limit).all()
-        return jsonify({'logs': [l.as_dict() for l in logs]})
+        return jsonify({'logs': push_logs_as_dicts(logs)})
     elif log_type == 'debug':
         logs = DebugLog.query.order_by(DebugLog.timestamp.desc()).limit(limit).all()
         return jsonify({'logs': [l.as_dict() for l in logs]})
@@ -2083,7 +4927,7 @@ def get_logs():
         debug_logs = DebugLog.query.order_by(DebugLog.timestamp.desc()).limit(limit).all()
         scheduler_logs = SchedulerLog.query.order_by(SchedulerLog.timestamp.desc()).limit(limit).all()
         return jsonify({
-            'push_logs': [l.as_dict() for l in push_logs],
+            'push_logs': push_logs_as_dicts(push_logs),
             'debug_logs': [l.as_dict() for l in debug_logs],
             'scheduler_logs': [l.as_dict() for l in scheduler_logs]
         })
@@ -2108,9 +4952,11 @@ def test_temperature_alert():
     
     if use_real_data:
         # Fetch forecasted high temperature for today
-        forecast_url = f"{WEATHER_BASE_URL}/forecast.json"
         forecast_params = {'key': WEATHER_API_KEY, 'q': location, 'days': 1, 'aqi': 'no', 'alerts': 'no'}
-        forecast_response = requests.get(forecast_url, params=forecast_params)
+        try:
+            forecast_response = weather_api_get('forecast.json', forecast_params)
+        except ProviderQuotaExceeded as e:
+            return jsonify({'success': False, 'error': str(e)}), 429
         if forecast_response.status_code != 200:
             return jsonify({'success': False, 'error': 'Failed to fetch forecasted weather'}), 500
         forecast_data = forecast_response.json()
@@ -2118,7 +4964,6 @@ def test_temperature_alert():
         
         # Get historical average temperature for this location and date
         today = datetime.now()
-        historical_url = f"{WEATHER_BASE_URL}/history.json"
         historical_params = {
             'key': WEATHER_API_KEY, 
             'q': location, 
@@ -2127,7 +4972,7 @@ def test_temperature_alert():
         }
         
         try:
-            historical_response = requests.get(historical_url, params=historical_params)
+            historical_response = weather_api_get('history.json', historical_params)
             if historical_response.status_code == 200:
                 historical_data = historical_response.json()
                 # Get the average temperature from historical data
@@ -2148,15 +4993,17 @@ def test_temperature_alert():
     should_alert = temp_diff >= test_threshold
     
     if should_alert:
-        # Send push notifications
-        send_push_notification(location, current_temp, avg_temp)
+        # Send push notifications (bulk lane, behind real alerts)
+        send_push_notification(location, current_temp, avg_temp, kind='test')
 
-        # Send emails to all subscribers
-        for subscriber in Subscriber.query.all():
+        # Queue emails to all subscribers
+        for subscriber in Subscriber.query.filter(Subscriber.suppressed == False).all():
             try:
-                send_notification(subscriber.email, location, current_temp, avg_temp, years=30)
+                send_notification(subscriber.email, location, current_temp, avg_temp, years=30, commit=False)
             except Exception as e:
-                print(f"[ERROR] Failed to send test alert email to {subscriber.email}: {e}")
+                print(f"[ERROR] Failed to queue test alert email to {subscriber.email}: {e}")
+        db.session.commit()
+        email_outbox_wakeup.set()
 
     return jsonify({
         'success': True,
@@ -2269,10 +5116,12 @@ def scheduler_health():
         if WEATHER_API_KEY:
             try:
                 # Quick test of weather API
-                test_response = requests.get(f"{WEATHER_BASE_URL}/current.json", 
-                                          params={'key': WEATHER_API_KEY, 'q': 'New York'}, 
-                                          timeout=5)
+                test_response = weather_api_get('current.json',
+                                                params={'key': WEATHER_API_KEY, 'q': 'New York'},
+                                                timeout=5)
                 weather_status = 'healthy' if test_response.status_code == 200 else 'error'
+            except ProviderQuotaExceeded:
+                weather_status = 'quota_exhausted'
             except:
                 weather_status = 'error'
         
@@ -2972,9 +5821,19 @@ def update_settings():
         return jsonify({'success': False, 'error': 'Frequency must be hourly or daily'}), 400
     
     # Update global variables
+    threshold_changed = new_threshold != TEMP_THRESHOLD
     TEMP_THRESHOLD = new_threshold
     CHECK_FREQUENCY = new_frequency
     
+    # Per-location cadences were computed against the old threshold
+    if threshold_changed:
+        try:
+            LocationCheckState.query.update({'next_check_at': None})
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️ Could not reset location cadences: {e}")
+    
     # Update Cloud Scheduler jobs
     scheduler_updated = update_cloud_scheduler_jobs(new_frequency)
     
@@ -2994,6 +5853,10 @@ def migrate_database():
     try:
         from sqlalchemy import text
         
+        columns_added = add_missing_columns()
+        indexes_added = add_missing_indexes()
+        location_keys_backfilled = backfill_device_location_keys()
+        
         # For SQLite, check if location column exists by trying to query it
         try:
             # Try to query the location column
@@ -3066,7 +5929,10 @@ def migrate_database():
         
         return jsonify({
             'success': True,
-            'message': 'Database migration completed'
+            'message': 'Database migration completed',
+            'columns_added': columns_added,
+            'indexes_added': indexes_added,
+            'location_keys_backfilled': location_keys_backfilled
         })
             
     except Exception as e:
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Email throughput benchmark
+Starts a local SMTP sink, seeds a throwaway database with synthetic subscribers,
+runs the alert fan-out and drains the email outbox, then reports messages/sec,
+p50/p99 send latency (each engine's SMTP send call per message, from app.smtp_send_latencies),
+p50/p99 queue wait (created_at -> sent_at on each outbox row, which adds the time spent
+behind earlier messages) and peak RSS.
+
+Usage:
+    pip install aiosmtpd
+    BENCH_SUBSCRIBERS=5000 BENCH_LOCATIONS=20 python benchmark_email_throughput.py
+    BENCH_ENGINE=async BENCH_SINK_LATENCY_MS=20 python benchmark_email_throughput.py
+
+Set BENCH_MIN_RATE to fail (exit 1) when throughput drops below that many messages/sec.
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCH_SUBSCRIBERS = int(os.getenv('BENCH_SUBSCRIBERS', '1000'))
+BENCH_LOCATIONS = int(os.getenv('BENCH_LOCATIONS', '10'))
+BENCH_ENGINE = os.getenv('BENCH_ENGINE', 'sync')  # 'sync' (pooled Flask-Mail) or 'async' (aiosmtplib)
+BENCH_SINK_PORT = int(os.getenv('BENCH_SINK_PORT', '10255'))
+BENCH_SINK_LATENCY_MS = float(os.getenv('BENCH_SINK_LATENCY_MS', '0'))
+BENCH_MIN_RATE = float(os.getenv('BENCH_MIN_RATE', '0'))
+
+# The app reads its configuration at import time, so point it at the sink and a scratch database first
+_db_dir = tempfile.mkdtemp(prefix='email_bench_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ['MAIL_SERVER'] = '127.0.0.1'
+os.environ['MAIL_PORT'] = str(BENCH_SINK_PORT)
+os.environ['MAIL_USE_SSL'] = 'false'
+os.environ['MAIL_USERNAME'] = 'bench'
+os.environ['MAIL_PASSWORD'] = 'bench'
+os.environ['EMAIL_DISPATCHER_ENABLED'] = 'false'  # Drained explicitly below so timing is deterministic
+os.environ['EMAIL_ASYNC_ENGINE'] = 'true' if BENCH_ENGINE == 'async' else 'false'
+
+from smtp_sink import start_smtp_sink
+import app as too_hot
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def seed_subscribers():
+    """Spread BENCH_SUBSCRIBERS synthetic subscribers over BENCH_LOCATIONS locations"""
+    locations = [f"Bench City {i}" for i in range(BENCH_LOCATIONS)]
+    with too_hot.app.app_context():
+        too_hot.db.session.bulk_insert_mappings(too_hot.Subscriber, [
+            {
+                'email': f"bench{i}@example.com",
+                'location': locations[i % BENCH_LOCATIONS],
+                'subscribed_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+            }
+            for i in range(BENCH_SUBSCRIBERS)
+        ])
+        too_hot.db.session.commit()
+    return locations
+
+
+def run_fanout():
+    """Queue one alert per subscriber, location by location, like a check run"""
+    with too_hot.app.app_context(), too_hot.app.test_request_context():
+        queued = 0
+        for location, subscribers in too_hot.get_alert_locations():
+            queued += too_hot.queue_alert_emails(location, subscribers, 104, 88)
+        return queued
+
+
+def drain_outbox():
+    batches = 0
+    while too_hot.dispatch_email_outbox():
+        batches += 1
+    return batches
+
+
+def collect_queue_waits():
+    with too_hot.app.app_context():
+        rows = too_hot.EmailOutbox.query.filter_by(status='sent').all()
+        return [(row.sent_at - row.created_at).total_seconds() * 1000 for row in rows]
+
+
+def collect_send_latencies():
+    return list(too_hot.smtp_send_latencies)
+
+
+def main():
+    print("📨 Email Throughput Benchmark")
+    print("=" * 50)
+    print(f"Subscribers: {BENCH_SUBSCRIBERS}  Locations: {BENCH_LOCATIONS}  Engine: {BENCH_ENGINE}  "
+          f"Sink latency: {BENCH_SINK_LATENCY_MS}ms")
+
+    controller, sink = start_smtp_sink(port=BENCH_SINK_PORT, latency_ms=BENCH_SINK_LATENCY_MS)
+    try:
+        seed_subscribers()
+
+        started = time.time()
+        queued = run_fanout()
+        fanout_seconds = time.time() - started
+
+        drain_started = time.time()
+        batches = drain_outbox()
+        finished = time.time()
+    finally:
+        controller.stop()
+
+    with too_hot.app.app_context():
+        status = too_hot.get_email_outbox_status()
+    queue_waits = collect_queue_waits()
+    send_latencies = collect_send_latencies()
+    total_seconds = finished - started
+    rate = status['sent'] / total_seconds if total_seconds > 0 else 0
+
+    print("\n📊 Results")
+    print(f"Queued:            {queued} in {fanout_seconds:.2f}s")
+    print(f"Sent:              {status['sent']} (failed {status['failed']}, pending {status['pending']})")
+    print(f"Sink received:     {sink.messages} over {len(sink.sessions)} connections")
+    print(f"Dispatch batches:  {batches} in {finished - drain_started:.2f}s")
+    print(f"Throughput:        {rate:.1f} messages/sec (end to end)")
+    print(f"Send latency p50:  {percentile(send_latencies, 50):.1f}ms" if send_latencies else "Send latency p50:  n/a")
+    print(f"Send latency p99:  {percentile(send_latencies, 99):.1f}ms" if send_latencies else "Send latency p99:  n/a")
+    print(f"Queue wait p50:    {percentile(queue_waits, 50):.0f}ms" if queue_waits else "Queue wait p50:    n/a")
+    print(f"Queue wait p99:    {percentile(queue_waits, 99):.0f}ms" if queue_waits else "Queue wait p99:    n/a")
+    print(f"Peak RSS:          {peak_rss_mb()} MB")
+
+    if status['sent'] != BENCH_SUBSCRIBERS:
+        print(f"❌ Expected {BENCH_SUBSCRIBERS} messages to be sent")
+        return 1
+    if BENCH_MIN_RATE and rate < BENCH_MIN_RATE:
+        print(f"❌ Throughput below BENCH_MIN_RATE ({BENCH_MIN_RATE} messages/sec)")
+        return 1
+    print("✅ Benchmark complete")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
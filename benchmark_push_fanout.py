@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Push pipeline benchmark
+Starts the local Expo stand-in in its own process, seeds a throwaway database with a synthetic
+device population, runs a push fan-out and then drives the receipt fetcher until every ticket
+is reconciled. Reports end-to-end fan-out time, devices/sec, time to first send, push log write
+rate, peak RSS of the app process and receipt reconciliation lag.
+
+Two entry points can be measured:
+    BENCH_MODE=alert  send_push_notification() for one location (the heat alert path)
+    BENCH_MODE=api    POST /api/send-push-notification to every device (the manual broadcast path,
+                      which runs in the bulk lane at PUSH_BULK_CONCURRENCY)
+
+Receipt passes start once the fan-out has finished, so the ticket -> receipt lag includes the
+time the rest of the fan-out took; "all reconciled after" is measured from the end of the fan-out.
+
+Usage:
+    BENCH_DEVICES=100000 python benchmark_push_fanout.py
+    BENCH_DEVICES=1000000 BENCH_MODE=api python benchmark_push_fanout.py            # takes several minutes
+    BENCH_DEVICES=20000 BENCH_CONCURRENCY=1 python benchmark_push_fanout.py         # serial baseline
+    BENCH_RATE=600 python benchmark_push_fanout.py                                  # paced like production
+    BENCH_ERROR_RATE=0.02 BENCH_RECEIPT_DELAY_MS=5000 python benchmark_push_fanout.py  # a bad day at Expo
+
+Population knobs: BENCH_LOCATIONS spreads devices over that many locations (the alert goes to
+one of them), BENCH_DEAD_RATE makes that fraction of tokens unregistered at send time.
+Stand-in knobs: BENCH_STANDIN_LATENCY_MS, BENCH_ERROR_RATE (503s), BENCH_TICKET_ERROR_RATE
+(MessageRateExceeded tickets), BENCH_RECEIPT_ERROR_RATE (DeviceNotRegistered receipts) and
+BENCH_RECEIPT_DELAY_MS (how long receipts take to become available).
+
+Set BENCH_MIN_RATE to fail (exit 1) when throughput drops below that many devices/sec.
+"""
+
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from sqlalchemy import text
+
+BENCH_DEVICES = int(os.getenv('BENCH_DEVICES', '20000'))
+BENCH_MODE = os.getenv('BENCH_MODE', 'alert')  # 'alert' or 'api'
+BENCH_CONCURRENCY = os.getenv('BENCH_CONCURRENCY', '6')
+BENCH_RATE = os.getenv('BENCH_RATE', '0')  # Notifications/sec pacing; 0 = unpaced, measures the pipeline itself
+BENCH_LOCATIONS = int(os.getenv('BENCH_LOCATIONS', '1'))  # Locations the population is spread over
+BENCH_DEAD_RATE = float(os.getenv('BENCH_DEAD_RATE', '0.01'))  # Fraction of tokens Expo rejects as unregistered
+BENCH_STANDIN_PORT = int(os.getenv('BENCH_STANDIN_PORT', '18765'))
+BENCH_STANDIN_LATENCY_MS = os.getenv('BENCH_STANDIN_LATENCY_MS', '100')  # Roughly a real Expo round trip
+BENCH_ERROR_RATE = os.getenv('BENCH_ERROR_RATE', '0')
+BENCH_TICKET_ERROR_RATE = os.getenv('BENCH_TICKET_ERROR_RATE', '0')
+BENCH_RECEIPT_ERROR_RATE = os.getenv('BENCH_RECEIPT_ERROR_RATE', '0.005')
+BENCH_RECEIPT_DELAY_MS = os.getenv('BENCH_RECEIPT_DELAY_MS', '0')
+BENCH_RECEIPTS = os.getenv('BENCH_RECEIPTS', 'true').lower() == 'true'  # Run the reconciliation phase
+BENCH_RECEIPT_INTERVAL = float(os.getenv('BENCH_RECEIPT_INTERVAL', '1'))  # Seconds between receipt passes
+BENCH_RECEIPT_TIMEOUT = float(os.getenv('BENCH_RECEIPT_TIMEOUT', '600'))
+BENCH_MIN_RATE = float(os.getenv('BENCH_MIN_RATE', '0'))
+BENCH_SEED = int(os.getenv('BENCH_SEED', '42'))
+BENCH_SEED_CHUNK = 10000
+BENCH_LOCATION = 'Bench City'
+STANDIN_URL = f"http://127.0.0.1:{BENCH_STANDIN_PORT}"
+
+# The app reads its configuration at import time, so point it at the stand-in and a scratch database first
+_db_dir = tempfile.mkdtemp(prefix='push_bench_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'bench.db')}"
+os.environ['EXPO_PUSH_URL'] = f"{STANDIN_URL}/--/api/v2/push/send"
+os.environ['EXPO_RECEIPTS_URL'] = f"{STANDIN_URL}/--/api/v2/push/getReceipts"
+os.environ['EXPO_PUSH_CONCURRENCY'] = BENCH_CONCURRENCY
+os.environ['EXPO_PUSH_RATE_PER_SECOND'] = BENCH_RATE
+os.environ['EXPO_CALLS_PER_MINUTE'] = '0'  # Don't let the shared provider budget cap the benchmark
+os.environ['EXPO_CALLS_PER_DAY'] = '0'
+os.environ['EMAIL_DISPATCHER_ENABLED'] = 'false'
+os.environ['RECEIPT_FETCHER_MODE'] = 'off'  # Receipt passes are driven by the benchmark
+os.environ['PUSH_RETRY_ENABLED'] = 'false'  # Retries are counted, not sent, so each run measures one fan-out
+
+import app as too_hot
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def location_name(n):
+    return BENCH_LOCATION if n == 0 else f"{BENCH_LOCATION} {n}"
+
+
+def generate_devices(count, locations=BENCH_LOCATIONS, dead_rate=BENCH_DEAD_RATE, seed=BENCH_SEED):
+    """Yield Device rows for a synthetic population, round-robin over `locations` locations.
+
+    A `dead_rate` fraction of tokens use the stand-in's 'dead' prefix, so Expo rejects them at
+    send time and the fan-out has to deactivate them.
+    """
+    rng = random.Random(seed)
+    keys = [too_hot.normalize_location_key(location_name(n)) for n in range(locations)]
+    for i in range(count):
+        n = i % locations
+        prefix = 'dead' if dead_rate and rng.random() < dead_rate else 'bench'
+        yield {
+            'push_token': f"ExponentPushToken[{prefix}{i:08d}]",
+            'platform': 'expo',
+            'device_type': 'ios' if i % 2 else 'android',
+            'location': location_name(n),
+            'location_key': keys[n],
+            'is_active': True
+        }
+
+
+def seed_devices():
+    # Seed in chunks so seeding itself doesn't set the peak RSS the fan-out is measured against
+    rows = generate_devices(BENCH_DEVICES)
+    with too_hot.app.app_context():
+        for _ in range(0, BENCH_DEVICES, BENCH_SEED_CHUNK):
+            chunk = [row for _, row in zip(range(BENCH_SEED_CHUNK), rows)]
+            too_hot.db.session.bulk_insert_mappings(too_hot.Device, chunk)
+            too_hot.db.session.commit()
+        if BENCH_MODE == 'api':
+            return BENCH_DEVICES
+        return too_hot.Device.query.filter_by(location_key=too_hot.normalize_location_key(BENCH_LOCATION)).count()
+
+
+def start_standin():
+    """Run the stand-in as its own process so its ticket map doesn't count towards our peak RSS"""
+    env = dict(os.environ,
+               EXPO_STANDIN_PORT=str(BENCH_STANDIN_PORT),
+               EXPO_STANDIN_LATENCY_MS=BENCH_STANDIN_LATENCY_MS,
+               EXPO_STANDIN_ERROR_RATE=BENCH_ERROR_RATE,
+               EXPO_STANDIN_TICKET_ERROR_RATE=BENCH_TICKET_ERROR_RATE,
+               EXPO_STANDIN_RECEIPT_ERROR_RATE=BENCH_RECEIPT_ERROR_RATE,
+               EXPO_STANDIN_RECEIPT_DELAY_MS=BENCH_RECEIPT_DELAY_MS,
+               EXPO_STANDIN_SEED=str(BENCH_SEED))
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'expo_push_standin.py')],
+                               env=env, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            standin_stats()
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Expo stand-in did not start on port {BENCH_STANDIN_PORT}")
+
+
+def standin_stats():
+    return requests.get(f"{STANDIN_URL}/--/stats", timeout=5).json()
+
+
+def run_fan_out():
+    """Run one fan-out through the selected entry point; returns the campaign id"""
+    with too_hot.app.app_context():
+        if BENCH_MODE == 'api':
+            response = too_hot.app.test_client().post('/api/send-push-notification', json={
+                'title': 'Benchmark', 'body': 'Broadcast to every device'})
+            return response.get_json().get('campaign_id')
+        too_hot.send_push_notification(BENCH_LOCATION, 104, 88)
+        campaign = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id.desc()).first()
+        return campaign.id if campaign else None
+
+
+def pending_receipts():
+    with too_hot.app.app_context():
+        return too_hot.PushNotificationLog.query.filter(
+            too_hot.PushNotificationLog.receipt_checked_at == None,
+            too_hot.PushNotificationLog.status == 'success',
+            too_hot.PushNotificationLog.ticket_id != None).count()
+
+
+def reconcile_receipts():
+    """Run receipt passes until nothing is pending (or BENCH_RECEIPT_TIMEOUT); returns (passes, recorded, errors)"""
+    passes, recorded, errors = 0, 0, 0
+    started = time.time()
+    while pending_receipts() and time.time() - started < BENCH_RECEIPT_TIMEOUT:
+        result = too_hot.fetch_and_update_push_receipts()
+        passes += 1
+        recorded += result.get('recorded', 0)
+        errors += 1 if result.get('error') else 0
+        if pending_receipts():
+            time.sleep(BENCH_RECEIPT_INTERVAL)
+    return passes, recorded, errors
+
+
+def receipt_lag_percentiles(campaign_id, percentiles=(0.5, 0.99)):
+    """Seconds from a ticket being logged to its receipt being recorded, at the given percentiles"""
+    lag = "(julianday(receipt_checked_at) - julianday(timestamp)) * 86400"
+    where = "campaign_id = :campaign AND status IN ('delivered', 'delivery_error') AND receipt_checked_at IS NOT NULL"
+    with too_hot.app.app_context():
+        total = too_hot.db.session.execute(text(
+            f"SELECT COUNT(*) FROM push_notification_log WHERE {where}"), {'campaign': campaign_id}).scalar()
+        if not total:
+            return {}
+        return {p: too_hot.db.session.execute(text(
+            f"SELECT {lag} FROM push_notification_log WHERE {where} ORDER BY {lag} LIMIT 1 OFFSET :offset"),
+            {'campaign': campaign_id, 'offset': min(total - 1, int(total * p))}).scalar() for p in percentiles}
+
+
+def main():
+    print("📲 Push Pipeline Benchmark")
+    print("=" * 50)
+    print(f"Devices: {BENCH_DEVICES} over {BENCH_LOCATIONS} location(s)  Mode: {BENCH_MODE}  "
+          f"Concurrency: {BENCH_CONCURRENCY} (bulk lane {too_hot.PUSH_BULK_CONCURRENCY})  "
+          f"Pacing: {BENCH_RATE or 'none'}/s")
+    print(f"Stand-in: {BENCH_STANDIN_LATENCY_MS}ms latency, {BENCH_ERROR_RATE} request errors, "
+          f"{BENCH_TICKET_ERROR_RATE} ticket errors, {BENCH_RECEIPT_ERROR_RATE} receipt errors, "
+          f"receipts after {BENCH_RECEIPT_DELAY_MS}ms  Dead tokens: {BENCH_DEAD_RATE}")
+
+    seed_started = time.time()
+    target = seed_devices()
+    print(f"🌱 Seeded {BENCH_DEVICES} devices in {time.time() - seed_started:.1f}s ({target} targeted)")
+
+    process = start_standin()
+    try:
+        rss_before = peak_rss_mb()
+        started = time.time()
+        campaign_id = run_fan_out()
+        fan_out_done = time.time()
+        elapsed = fan_out_done - started
+        fan_out_rss = peak_rss_mb()
+        send_stats = standin_stats()
+
+        passes, recorded, receipt_errors = 0, 0, 0
+        if BENCH_RECEIPTS:
+            passes, recorded, receipt_errors = reconcile_receipts()
+        reconciled_after = time.time() - fan_out_done
+        stats = standin_stats()
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    with too_hot.app.app_context():
+        logged = too_hot.PushNotificationLog.query.filter_by(campaign_id=campaign_id).count()
+        campaign = too_hot.db.session.get(too_hot.NotificationCampaign, campaign_id) if campaign_id else None
+        queued = sum(len(json.loads(row.device_ids)) for row in too_hot.PushRetry.query.all())
+        deactivated = too_hot.Device.query.filter_by(is_active=False).count()
+    pending = pending_receipts()
+    rate = target / elapsed if elapsed > 0 else 0
+    first_send = send_stats['first_message_at'] - started if send_stats['first_message_at'] else None
+    lag = receipt_lag_percentiles(campaign_id) if BENCH_RECEIPTS and campaign_id else {}
+
+    print("\n📊 Fan-out")
+    print(f"Delivered to stand-in: {send_stats['messages']} in {send_stats['requests']} requests "
+          f"({send_stats['gzip_requests']} gzip, {send_stats['throttled']} throttled, "
+          f"{send_stats['server_errors']} failed, {send_stats['ticket_errors']} error tickets)")
+    print(f"Elapsed:               {elapsed:.2f}s")
+    print(f"Throughput:            {rate:.0f} devices/sec")
+    print(f"First send after:      {first_send * 1000:.0f}ms" if first_send is not None else "First send after:      n/a")
+    print(f"Push log writes:       {logged} rows ({logged / elapsed if elapsed > 0 else 0:.0f} rows/sec)")
+    print(f"Queued for retry:      {queued} devices")
+    print(f"Peak RSS:              {fan_out_rss} MB (after seeding: {rss_before} MB)")
+    if campaign is not None:
+        print(f"Campaign:              {campaign.successful} successful, {campaign.failed} failed")
+
+    if BENCH_RECEIPTS:
+        print("\n📊 Receipts")
+        print(f"Passes:                {passes} ({receipt_errors} failed), {recorded} receipts recorded "
+              f"({recorded / reconciled_after if reconciled_after > 0 else 0:.0f} rows/sec)")
+        print(f"All reconciled after:  {reconciled_after:.2f}s from the end of the fan-out"
+              + (f" ({pending} still pending)" if pending else ""))
+        if lag:
+            print(f"Ticket -> receipt lag: p50 {lag[0.5]:.2f}s  p99 {lag[0.99]:.2f}s")
+        if campaign is not None:
+            print(f"Campaign:              {campaign.delivered} delivered, {campaign.delivery_errors} delivery errors")
+        print(f"Devices deactivated:   {deactivated}")
+        print(f"Peak RSS:              {peak_rss_mb()} MB")
+
+    if logged != target:
+        print(f"❌ Expected {target} push log rows, got {logged}")
+        return 1
+    if BENCH_RECEIPTS and pending:
+        print(f"❌ {pending} receipts still pending after {BENCH_RECEIPT_TIMEOUT:.0f}s")
+        return 1
+    if BENCH_MIN_RATE and rate < BENCH_MIN_RATE:
+        print(f"❌ Throughput below BENCH_MIN_RATE ({BENCH_MIN_RATE} devices/sec)")
+        return 1
+    print("✅ Benchmark complete")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Local Expo push service stand-in
+Implements /--/api/v2/push/send and /--/api/v2/push/getReceipts closely enough for the push
+dispatcher, receipt fetcher and benchmarks to run offline. Accepts gzip request bodies.
+GET /--/stats returns the counters as JSON (used when the stand-in runs as its own process).
+
+Token conventions for exercising error paths:
+    ExponentPushToken[dead...]  -> error ticket with DeviceNotRegistered
+    ExponentPushToken[gone...]  -> ok ticket, DeviceNotRegistered receipt
+
+Random failures for load tests (fractions, 0 = never; seeded so runs are repeatable):
+    EXPO_STANDIN_ERROR_RATE          send and getReceipts requests answered 503
+    EXPO_STANDIN_TICKET_ERROR_RATE   messages given a MessageRateExceeded error ticket
+    EXPO_STANDIN_RECEIPT_ERROR_RATE  ok tickets whose receipt is DeviceNotRegistered
+    EXPO_STANDIN_RECEIPT_DELAY_MS    receipts aren't returned until this long after the ticket
+
+Usage:
+    EXPO_STANDIN_PORT=8765 EXPO_STANDIN_LATENCY_MS=50 python expo_push_standin.py
+
+Point the app at it with
+    EXPO_PUSH_URL=http://127.0.0.1:8765/--/api/v2/push/send
+    EXPO_RECEIPTS_URL=http://127.0.0.1:8765/--/api/v2/push/getReceipts
+"""
+
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STANDIN_HOST = os.getenv('EXPO_STANDIN_HOST', '127.0.0.1')
+STANDIN_PORT = int(os.getenv('EXPO_STANDIN_PORT', '8765'))
+STANDIN_LATENCY_MS = float(os.getenv('EXPO_STANDIN_LATENCY_MS', '0'))  # Simulated per-request service time
+STANDIN_MAX_RPS = float(os.getenv('EXPO_STANDIN_MAX_RPS', '0'))  # Reply 429 above this many requests/sec, 0 = never
+STANDIN_ERROR_RATE = float(os.getenv('EXPO_STANDIN_ERROR_RATE', '0'))
+STANDIN_TICKET_ERROR_RATE = float(os.getenv('EXPO_STANDIN_TICKET_ERROR_RATE', '0'))
+STANDIN_RECEIPT_ERROR_RATE = float(os.getenv('EXPO_STANDIN_RECEIPT_ERROR_RATE', '0'))
+STANDIN_RECEIPT_DELAY_MS = float(os.getenv('EXPO_STANDIN_RECEIPT_DELAY_MS', '0'))
+STANDIN_SEED = int(os.getenv('EXPO_STANDIN_SEED', '42'))
+
+NOT_REGISTERED = {'error': 'DeviceNotRegistered'}
+RATE_EXCEEDED = {'error': 'MessageRateExceeded'}
+
+
+class StandinState:
+    def __init__(self, latency_ms=0, max_rps=0, error_rate=0, ticket_error_rate=0, receipt_error_rate=0,
+                 receipt_delay_ms=0, seed=STANDIN_SEED):
+        self.latency = latency_ms / 1000.0
+        self.max_rps = max_rps
+        self.error_rate = error_rate
+        self.ticket_error_rate = ticket_error_rate
+        self.receipt_error_rate = receipt_error_rate
+        self.receipt_delay = receipt_delay_ms / 1000.0
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.gzip_requests = 0
+        self.messages = 0
+        self.bytes_in = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.ticket_errors = 0
+        self.receipt_requests = 0
+        self.receipts = 0
+        self.receipt_errors = 0
+        self.receipts_not_ready = 0
+        self.started = time.time()
+        self.first_message_at = None
+        self.last_message_at = None
+        self.tokens = {}  # ticket id -> (issued at, receipt is an error)
+        self.window = []
+        self.lock = threading.Lock()
+
+    def throttle(self):
+        if not self.max_rps:
+            return False
+        with self.lock:
+            now = time.time()
+            self.window = [t for t in self.window if now - t < 1.0]
+            if len(self.window) >= self.max_rps:
+                self.throttled += 1
+                return True
+            self.window.append(now)
+            return False
+
+    def fail_request(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            if self.random.random() >= self.error_rate:
+                return False
+            self.server_errors += 1
+            return True
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'requests': self.requests,
+            'gzip_requests': self.gzip_requests,
+            'messages': self.messages,
+            'bytes_in': self.bytes_in,
+            'throttled': self.throttled,
+            'server_errors': self.server_errors,
+            'ticket_errors': self.ticket_errors,
+            'receipt_requests': self.receipt_requests,
+            'receipts': self.receipts,
+            'receipt_errors': self.receipt_errors,
+            'receipts_not_ready': self.receipts_not_ready,
+            'first_message_at': self.first_message_at,
+            'last_message_at': self.last_message_at,
+            'seconds': round(elapsed, 2),
+            'per_second': round(self.messages / elapsed, 1) if elapsed > 0 else None
+        }
+
+
+class ExpoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real service
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        compressed = self.headers.get('Content-Encoding', '').lower() == 'gzip'
+        if compressed:
+            raw = gzip.decompress(raw)
+        return json.loads(raw or b'null'), len(raw), compressed
+
+    def do_GET(self):
+        if self.path == '/--/stats':
+            return self.reply(200, self.server.state.stats())
+        self.reply(404, {'errors': [{'code': 'NOT_FOUND', 'message': self.path}]})
+
+    def do_POST(self):
+        state = self.server.state
+        payload, size, compressed = self.read_json()
+        if state.latency:
+            time.sleep(state.latency)
+        if state.fail_request():
+            return self.reply(503, {'errors': [{'code': 'INTERNAL_SERVER_ERROR', 'message': 'Service unavailable'}]})
+        if self.path.endswith('/push/send'):
+            if state.throttle():
+                return self.reply(429, {'errors': [{'code': 'TOO_MANY_REQUESTS', 'message': 'Rate limit exceeded'}]})
+            messages = payload if isinstance(payload, list) else [payload]
+            if len(messages) > 100:
+                return self.reply(400, {'errors': [{'code': 'PUSH_TOO_MANY_NOTIFICATIONS',
+                                                    'message': 'You are trying to send more than 100 push notifications in one request'}]})
+            tickets = []
+            with state.lock:
+                now = time.time()
+                state.requests += 1
+                state.first_message_at = state.first_message_at or now
+                state.last_message_at = now
+                state.gzip_requests += 1 if compressed else 0
+                state.messages += len(messages)
+                state.bytes_in += size
+                for msg in messages:
+                    token = msg.get('to', '')
+                    if token.startswith('ExponentPushToken[dead'):
+                        tickets.append({'status': 'error',
+                                        'message': f'"{token}" is not a registered push notification recipient',
+                                        'details': NOT_REGISTERED})
+                        continue
+                    if state.ticket_error_rate and state.random.random() < state.ticket_error_rate:
+                        state.ticket_errors += 1
+                        tickets.append({'status': 'error', 'message': 'Message rate exceeded',
+                                        'details': RATE_EXCEEDED})
+                        continue
+                    ticket_id = str(uuid.uuid4())
+                    gone = token.startswith('ExponentPushToken[gone') or (
+                        state.receipt_error_rate and state.random.random() < state.receipt_error_rate)
+                    state.tokens[ticket_id] = (now, bool(gone))
+                    tickets.append({'status': 'ok', 'id': ticket_id})
+            return self.reply(200, {'data': tickets})
+        if self.path.endswith('/push/getReceipts'):
+            receipts = {}
+            with state.lock:
+                state.receipt_requests += 1
+                ready_before = time.time() - state.receipt_delay
+                for ticket_id in (payload or {}).get('ids', []):
+                    ticket = state.tokens.get(ticket_id)
+                    if ticket is None:
+                        continue
+                    issued_at, gone = ticket
+                    if issued_at > ready_before:
+                        state.receipts_not_ready += 1
+                        continue
+                    state.receipts += 1
+                    if gone:
+                        state.receipt_errors += 1
+                        receipts[ticket_id] = {'status': 'error', 'message': 'The device is not registered',
+                                               'details': NOT_REGISTERED}
+                    else:
+                        receipts[ticket_id] = {'status': 'ok'}
+            return self.reply(200, {'data': receipts})
+        self.reply(404, {'errors': [{'code': 'NOT_FOUND', 'message': self.path}]})
+
+
+class ExpoStandin(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state):
+        self.state = state
+        super().__init__(address, ExpoHandler)
+
+
+def start_expo_standin(host=STANDIN_HOST, port=STANDIN_PORT, latency_ms=STANDIN_LATENCY_MS, max_rps=STANDIN_MAX_RPS,
+                       error_rate=STANDIN_ERROR_RATE, ticket_error_rate=STANDIN_TICKET_ERROR_RATE,
+                       receipt_error_rate=STANDIN_RECEIPT_ERROR_RATE, receipt_delay_ms=STANDIN_RECEIPT_DELAY_MS):
+    """Serve in a background thread. Returns (server, state); call server.shutdown()."""
+    state = StandinState(latency_ms, max_rps, error_rate, ticket_error_rate, receipt_error_rate, receipt_delay_ms)
+    server = ExpoStandin((host, port), state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    server, state = start_expo_standin()
+    print(f"📲 Expo stand-in listening on http://{STANDIN_HOST}:{STANDIN_PORT} "
+          f"(latency {STANDIN_LATENCY_MS}ms, max {STANDIN_MAX_RPS or 'unlimited'} req/s, "
+          f"errors {STANDIN_ERROR_RATE:.1%} requests / {STANDIN_TICKET_ERROR_RATE:.1%} tickets / "
+          f"{STANDIN_RECEIPT_ERROR_RATE:.1%} receipts, receipts after {STANDIN_RECEIPT_DELAY_MS}ms)")
+    last = 0
+    try:
+        while True:
+            time.sleep(5)
+            stats = state.stats()
+            if stats['messages'] != last:
+                print(f"📨 {stats['messages']} messages in {stats['requests']} requests "
+                      f"({stats['gzip_requests']} gzip), {stats['throttled']} throttled, "
+                      f"{stats['server_errors']} failed, {stats['receipts']} receipts")
+                last = stats['messages']
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(f"✅ Stand-in stopped: {state.stats()}")
+
+
+if __name__ == "__main__":
+    main()
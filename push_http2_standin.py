@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Local APNs / FCM HTTP/2 stand-in
+Speaks cleartext HTTP/2 (prior knowledge, no TLS) and implements the two endpoints the direct
+push providers use, so they can be exercised and load-tested offline:
+
+    POST /3/device/<token>                   APNs provider API
+    POST /v1/projects/<project>/messages:send FCM HTTP v1 API
+
+Every stream is answered independently after the simulated latency, so many requests share
+one connection the way they do against Apple and Google.
+
+Token conventions for exercising error paths (APNs device token / FCM registration token):
+    dead...  -> APNs 410 Unregistered / FCM 404 UNREGISTERED
+    bad...   -> APNs 400 BadDeviceToken / FCM 400 INVALID_ARGUMENT
+    busy...  -> APNs 429 TooManyRequests / FCM 429 QUOTA_EXCEEDED
+
+Usage:
+    PUSH_STANDIN_PORT=8766 PUSH_STANDIN_LATENCY_MS=50 python push_http2_standin.py
+
+Point the app at it with
+    APNS_URL=http://127.0.0.1:8766
+    FCM_URL=http://127.0.0.1:8766
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+
+STANDIN_HOST = os.getenv('PUSH_STANDIN_HOST', '127.0.0.1')
+STANDIN_PORT = int(os.getenv('PUSH_STANDIN_PORT', '8766'))
+STANDIN_LATENCY_MS = float(os.getenv('PUSH_STANDIN_LATENCY_MS', '0'))  # Simulated per-request service time
+STANDIN_MAX_STREAMS = int(os.getenv('PUSH_STANDIN_MAX_STREAMS', '1000'))  # SETTINGS_MAX_CONCURRENT_STREAMS
+
+
+class StandinState:
+    def __init__(self, latency_ms=0, max_streams=1000):
+        self.latency = latency_ms / 1000.0
+        self.max_streams = max_streams
+        self.connections = 0
+        self.apns = 0
+        self.fcm = 0
+        self.errors = 0
+        self.active_streams = 0
+        self.peak_streams = 0
+        self.first_message_at = None
+        self.last_authorization = {}  # 'apns' / 'fcm' -> last authorization header
+        self.last_headers = {}  # 'apns' / 'fcm' -> last request headers
+        self.payloads = []  # Last few request bodies, for tests
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'connections': self.connections,
+            'apns': self.apns,
+            'fcm': self.fcm,
+            'messages': self.apns + self.fcm,
+            'errors': self.errors,
+            'peak_streams': self.peak_streams,
+            'first_message_at': self.first_message_at,
+            'seconds': round(elapsed, 2),
+            'per_second': round((self.apns + self.fcm) / elapsed, 1) if elapsed > 0 else None
+        }
+
+    def handle(self, headers, body):
+        """Return (status, extra headers, JSON body) for one request"""
+        path = headers.get(':path', '')
+        try:
+            payload = json.loads(body or b'null')
+        except ValueError:
+            payload = None
+        with self.lock:
+            self.first_message_at = self.first_message_at or time.time()
+            self.payloads = (self.payloads + [payload])[-20:]
+        if path.startswith('/3/device/'):
+            return self.handle_apns(headers, path[len('/3/device/'):], payload)
+        if path.startswith('/v1/projects/') and path.endswith('/messages:send'):
+            return self.handle_fcm(headers, path, payload)
+        return 404, [], {'reason': 'BadPath'}
+
+    def handle_apns(self, headers, token, payload):
+        with self.lock:
+            self.apns += 1
+            self.last_authorization['apns'] = headers.get('authorization')
+            self.last_headers['apns'] = headers
+        if not headers.get('authorization', '').startswith('bearer '):
+            return self.error(403, [], {'reason': 'MissingProviderToken'})
+        if not headers.get('apns-topic'):
+            return self.error(400, [], {'reason': 'MissingTopic'})
+        if not isinstance(payload, dict) or 'aps' not in payload:
+            return self.error(400, [], {'reason': 'PayloadEmpty'})
+        if token.startswith('dead'):
+            return self.error(410, [], {'reason': 'Unregistered', 'timestamp': int(time.time() * 1000)})
+        if token.startswith('bad'):
+            return self.error(400, [], {'reason': 'BadDeviceToken'})
+        if token.startswith('busy'):
+            return self.error(429, [], {'reason': 'TooManyRequests'})
+        return 200, [('apns-id', str(uuid.uuid4()).upper())], None
+
+    def handle_fcm(self, headers, path, payload):
+        with self.lock:
+            self.fcm += 1
+            self.last_authorization['fcm'] = headers.get('authorization')
+            self.last_headers['fcm'] = headers
+        if not headers.get('authorization', '').startswith('Bearer '):
+            return self.error(401, [], fcm_error(401, 'UNAUTHENTICATED', None))
+        token = ((payload or {}).get('message') or {}).get('token', '')
+        if token.startswith('dead'):
+            return self.error(404, [], fcm_error(404, 'NOT_FOUND', 'UNREGISTERED'))
+        if token.startswith('bad') or not token:
+            return self.error(400, [], fcm_error(400, 'INVALID_ARGUMENT', 'INVALID_ARGUMENT'))
+        if token.startswith('busy'):
+            return self.error(429, [], fcm_error(429, 'RESOURCE_EXHAUSTED', 'QUOTA_EXCEEDED'))
+        project = path[len('/v1/projects/'):-len('/messages:send')]
+        return 200, [], {'name': f'projects/{project}/messages/{uuid.uuid4().hex}'}
+
+    def error(self, status, headers, body):
+        with self.lock:
+            self.errors += 1
+        return status, headers, body
+
+
+def fcm_error(code, status, error_code):
+    error = {'code': code, 'message': status.replace('_', ' ').lower(), 'status': status}
+    if error_code:
+        error['details'] = [{'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError', 'errorCode': error_code}]
+    return {'error': error}
+
+
+class H2Protocol(asyncio.Protocol):
+    """One client connection; each request stream is answered by its own task"""
+
+    def __init__(self, state):
+        self.state = state
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        self.requests = {}  # stream id -> (headers, body)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        with self.state.lock:
+            self.state.connections += 1
+        self.conn.initiate_connection()
+        self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.state.max_streams})
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.requests[event.stream_id] = (dict(event.headers), bytearray())
+            elif isinstance(event, h2.events.DataReceived):
+                if event.stream_id in self.requests:
+                    self.requests[event.stream_id][1].extend(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                if event.stream_id in self.requests:
+                    asyncio.ensure_future(self.respond(event.stream_id, *self.requests.pop(event.stream_id)))
+            elif isinstance(event, h2.events.StreamReset):
+                self.requests.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id, headers, body):
+        state = self.state
+        with state.lock:
+            state.active_streams += 1
+            state.peak_streams = max(state.peak_streams, state.active_streams)
+        try:
+            if state.latency:
+                await asyncio.sleep(state.latency)
+            status, extra_headers, payload = state.handle(headers, bytes(body))
+        finally:
+            with state.lock:
+                state.active_streams -= 1
+        if self.transport.is_closing():
+            return
+        data = json.dumps(payload).encode() if payload is not None else b''
+        try:
+            self.conn.send_headers(stream_id, [
+                (':status', str(status)),
+                ('content-type', 'application/json'),
+                ('content-length', str(len(data)))
+            ] + extra_headers, end_stream=not data)
+            if data:
+                self.conn.send_data(stream_id, data, end_stream=True)
+        except h2.exceptions.StreamClosedError:
+            return
+        self.transport.write(self.conn.data_to_send())
+
+
+class PushStandin:
+    """Runs the HTTP/2 server on its own event loop thread; call shutdown() to stop"""
+
+    def __init__(self, host, port, state):
+        self.state = state
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: H2Protocol(state), host, port, reuse_address=True))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        def stop():
+            self.server.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(stop)
+        self.thread.join(timeout=5)
+
+
+def start_push_standin(host=STANDIN_HOST, port=STANDIN_PORT, latency_ms=STANDIN_LATENCY_MS, max_streams=STANDIN_MAX_STREAMS):
+    """Serve in a background thread. Returns (server, state); call server.shutdown()."""
+    state = StandinState(latency_ms, max_streams)
+    return PushStandin(host, port, state), state
+
+
+def main():
+    server, state = start_push_standin()
+    print(f"📲 APNs/FCM HTTP/2 stand-in listening on http://{STANDIN_HOST}:{STANDIN_PORT} "
+          f"(latency {STANDIN_LATENCY_MS}ms, {STANDIN_MAX_STREAMS} streams per connection)")
+    last = 0
+    try:
+        while True:
+            time.sleep(5)
+            stats = state.stats()
+            if stats['messages'] != last:
+                print(f"📨 {stats['apns']} APNs + {stats['fcm']} FCM requests over {stats['connections']} "
+                      f"connections (peak {stats['peak_streams']} concurrent streams), {stats['errors']} errors")
+                last = stats['messages']
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(f"✅ Stand-in stopped: {state.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Expo Push Receipt Fetcher
+Standalone entry point for the receipt fetcher, for deployments that run it as its own
+process instead of as a thread inside every web worker. Set RECEIPT_FETCHER_MODE=off on the
+web service and run one (or more, for failover) of these; the shared lease makes sure only
+one of them polls Expo at a time.
+
+Usage:
+    python receipt_fetcher.py          # poll every RECEIPT_FETCH_INTERVAL seconds
+    python receipt_fetcher.py --once   # single pass, e.g. from Cloud Scheduler / cron
+"""
+
+import os
+import signal
+import sys
+import time
+
+# This process is the fetcher: don't also start the in-app thread or the email/push retry dispatchers
+os.environ.setdefault('RECEIPT_FETCHER_MODE', 'off')
+os.environ.setdefault('EMAIL_DISPATCHER_ENABLED', 'false')
+os.environ.setdefault('PUSH_RETRY_ENABLED', 'false')
+
+import app as too_hot
+
+
+def main():
+    once = '--once' in sys.argv[1:]
+    # Docker and Cloud Run stop containers with SIGTERM; exit through `finally` so the lease is released
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"📬 Receipt fetcher {too_hot.SERVICE_LEASE_HOLDER} "
+          f"({'single pass' if once else f'every {too_hot.RECEIPT_FETCH_INTERVAL}s'})")
+    try:
+        while True:
+            summary = too_hot.run_receipt_fetcher_pass()
+            if summary is None:
+                print("⏸️  Another fetcher holds the lease; standing by")
+            if once:
+                return 0
+            time.sleep(too_hot.RECEIPT_FETCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with too_hot.app.app_context():
+            too_hot.release_service_lease(too_hot.RECEIPT_FETCHER_LEASE)
+    print("👋 Receipt fetcher stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Local SMTP stand-in server
+Accepts (and discards) every message so the email engines can be benchmarked offline.
+
+Address conventions for exercising error paths (local part prefix):
+    sender blocked...     -> 553 at MAIL FROM (sender refused)
+    recipient refused...  -> 550 at RCPT TO (mailbox unavailable)
+    recipient greylist... -> 450 at RCPT TO (try again later)
+    recipient spam...     -> 554 at DATA (content rejected)
+
+Usage:
+    pip install aiosmtpd
+    SMTP_SINK_PORT=1025 python smtp_sink.py
+
+Point the app at it with MAIL_SERVER=localhost, MAIL_PORT=1025, MAIL_USE_SSL=false.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import logging
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:
+    Controller = None
+
+logging.getLogger('mail.log').setLevel(logging.ERROR)  # aiosmtpd warns on every AUTH
+
+SINK_HOST = os.getenv('SMTP_SINK_HOST', '127.0.0.1')
+SINK_PORT = int(os.getenv('SMTP_SINK_PORT', '1025'))
+SINK_LATENCY_MS = float(os.getenv('SMTP_SINK_LATENCY_MS', '0'))  # Simulated per-message server time
+SINK_MAX_PER_CONNECTION = int(os.getenv('SMTP_SINK_MAX_PER_CONNECTION', '0'))  # Reply 421 after N, 0 = never
+
+
+class SinkHandler:
+    """Counts delivered messages; optionally slows down or rate-limits like a real server"""
+
+    def __init__(self, latency_ms=0, max_per_connection=0):
+        self.latency = latency_ms / 1000.0
+        self.max_per_connection = max_per_connection
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.refused = 0
+        self.sessions = set()
+        self.started = time.time()
+        self._per_session = {}
+        self._lock = threading.Lock()
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        if address.lower().startswith('blocked'):
+            return self.refuse('553 5.7.1 Sender address rejected')
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.lower().startswith('refused'):
+            return self.refuse('550 5.1.1 Mailbox unavailable')
+        if address.lower().startswith('greylist'):
+            return self.refuse('450 4.2.0 Greylisted, try again later')
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if any(rcpt.lower().startswith('spam') for rcpt in envelope.rcpt_tos):
+            return self.refuse('554 5.7.1 Message rejected as spam')
+        with self._lock:
+            count = self._per_session.get(id(session), 0)
+            if self.max_per_connection and count >= self.max_per_connection:
+                self.rejected += 1
+                return '421 Too many messages on this connection'
+            self._per_session[id(session)] = count + 1
+            self.sessions.add(id(session))
+            self.messages += 1
+            self.recipients += len(envelope.rcpt_tos)
+            self.bytes += len(envelope.content or b'')
+        return '250 Message accepted'
+
+    def refuse(self, reply):
+        with self._lock:
+            self.refused += 1
+        return reply
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            'messages': self.messages,
+            'recipients': self.recipients,
+            'bytes': self.bytes,
+            'rejected': self.rejected,
+            'refused': self.refused,
+            'connections': len(self.sessions),
+            'seconds': round(elapsed, 2),
+            'per_second': round(self.messages / elapsed, 2) if elapsed > 0 else None
+        }
+
+
+def accept_any_login(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
+
+
+def start_smtp_sink(host=SINK_HOST, port=SINK_PORT, latency_ms=SINK_LATENCY_MS,
+                    max_per_connection=SINK_MAX_PER_CONNECTION):
+    """Start the sink in a background thread. Returns (controller, handler); call controller.stop()."""
+    if Controller is None:
+        raise RuntimeError('aiosmtpd is not installed (pip install aiosmtpd)')
+    handler = SinkHandler(latency_ms, max_per_connection)
+    controller = Controller(
+        handler,
+        hostname=host,
+        port=port,
+        authenticator=accept_any_login,
+        auth_require_tls=False,
+        data_size_limit=0
+    )
+    controller.start()
+    return controller, handler
+
+
+def main():
+    controller, handler = start_smtp_sink()
+    print(f"📭 SMTP sink listening on {SINK_HOST}:{SINK_PORT} "
+          f"(latency {SINK_LATENCY_MS}ms, max/connection {SINK_MAX_PER_CONNECTION or 'unlimited'})")
+    last = 0
+    try:
+        while True:
+            time.sleep(5)
+            stats = handler.stats()
+            if stats['messages'] != last:
+                print(f"📨 {stats['messages']} messages over {stats['connections']} connections, "
+                      f"{stats['per_second']} msg/s, {stats['rejected']} rejected")
+                last = stats['messages']
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop()
+        print(f"✅ Sink stopped: {handler.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Test script for direct APNs / FCM push delivery
+Runs the alert fan-out against the local HTTP/2 stand-in with 'apns' and 'fcm' devices and
+checks provider auth, payloads, stream multiplexing, delivery logging and dead-token pruning.
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+
+import httpx
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from push_http2_standin import start_push_standin
+from testing_support import app_settings, check, reset_push_state, run_suite, too_hot
+
+PUSH_STANDIN_PORT = int(os.environ.get('PUSH_STANDIN_PORT', '18767'))
+_signing_key = ec.generate_private_key(ec.SECP256R1())
+
+LOCATION = 'Phoenix'
+LIVE_APNS = 600
+LIVE_FCM = 300
+DEAD = 5
+
+
+@contextmanager
+def direct_push_settings():
+    """APNs and FCM configured against the local HTTP/2 stand-in"""
+    standin_url = f"http://127.0.0.1:{PUSH_STANDIN_PORT}"
+    signing_key = _signing_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    with app_settings(APNS_URL=standin_url, FCM_URL=standin_url, APNS_TOPIC='org.its2hot.app',
+                      APNS_KEY_ID='TESTKEY123', APNS_TEAM_ID='TESTTEAM45', APNS_AUTH_KEY=signing_key,
+                      FCM_PROJECT_ID='its2hot-test', FCM_ACCESS_TOKEN='test-oauth-token'):
+        too_hot._apns_token.update(value=None, issued_at=0)  # Sign a provider token with this key
+        try:
+            yield
+        finally:
+            too_hot._apns_token.update(value=None, issued_at=0)
+
+
+def seed_devices():
+    reset_push_state()
+    with too_hot.app.app_context():
+        rows = [('apns', f'live{i:04d}', 'ios') for i in range(LIVE_APNS)]
+        rows += [('apns', f'dead{i:04d}', 'ios') for i in range(DEAD)]
+        rows += [('fcm', f'live-fcm{i:04d}', 'android') for i in range(LIVE_FCM)]
+        rows += [('fcm', f'dead-fcm{i:04d}', 'android') for i in range(DEAD)]
+        too_hot.db.session.bulk_insert_mappings(too_hot.Device, [
+            {
+                'push_token': token,
+                'platform': platform,
+                'device_type': device_type,
+                'location': LOCATION,
+                'location_key': too_hot.normalize_location_key(LOCATION),
+                'is_active': True
+            }
+            for platform, token, device_type in rows
+        ])
+        too_hot.db.session.commit()
+
+
+def test_ticket_mapping():
+    """Provider error reasons map onto the Expo codes the pruning rules use"""
+    print("🧪 Testing APNs/FCM response mapping...")
+    apns_gone = too_hot.direct_push_ticket('apns', httpx.Response(410, json={'reason': 'Unregistered'}))
+    apns_ok = too_hot.direct_push_ticket('apns', httpx.Response(200, headers={'apns-id': 'ABC'}))
+    fcm_gone = too_hot.direct_push_ticket('fcm', httpx.Response(404, json={'error': {
+        'status': 'NOT_FOUND', 'details': [{'errorCode': 'UNREGISTERED'}]}}))
+    fcm_other = too_hot.direct_push_ticket('fcm', httpx.Response(400, json={'error': {'status': 'INVALID_ARGUMENT'}}))
+    before = too_hot.push_platforms()
+    with direct_push_settings():
+        configured = too_hot.push_platforms()
+    check([
+        (apns_ok == {'status': 'ok', 'id': 'ABC'}, "APNs 200 becomes an ok ticket with the apns-id"),
+        (too_hot.push_error_code(apns_gone) == 'DeviceNotRegistered', "APNs 410 Unregistered -> DeviceNotRegistered"),
+        (too_hot.push_error_code(fcm_gone) == 'DeviceNotRegistered', "FCM UNREGISTERED -> DeviceNotRegistered"),
+        (too_hot.push_error_code(fcm_other) == 'INVALID_ARGUMENT', "unmapped FCM status kept as is"),
+        (configured == ['expo', 'apns', 'fcm'], "both providers enabled by configuration"),
+        (too_hot.push_platforms() == before, "provider settings restored afterwards"),
+    ])
+
+
+def test_fan_out():
+    """The alert fan-out reaches apns/fcm devices over a few multiplexed HTTP/2 connections"""
+    print("🧪 Testing direct fan-out (HTTP/2 stand-in)...")
+    seed_devices()
+    server, standin = start_push_standin(port=PUSH_STANDIN_PORT, latency_ms=50)
+    try:
+        with direct_push_settings(), too_hot.app.app_context():
+            too_hot.send_push_notification(LOCATION, 112, 101)
+    finally:
+        server.shutdown()
+    stats = standin.stats()
+    with too_hot.app.app_context():
+        campaign = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id.desc()).first()
+        delivered = too_hot.PushNotificationLog.query.filter_by(status='delivered').count()
+        pending = too_hot.PushNotificationLog.query.filter(
+            too_hot.PushNotificationLog.status == 'success',
+            too_hot.PushNotificationLog.receipt_checked_at.is_(None)).count()
+        still_active = too_hot.Device.query.filter(
+            too_hot.Device.push_token.like('dead%'), too_hot.Device.is_active == True).count()
+    token = standin.last_authorization.get('apns', '').split(' ')[-1]
+    try:
+        claims = jwt.decode(token, _signing_key.public_key(), algorithms=['ES256'])
+        header = jwt.get_unverified_header(token)
+        jwt_ok = claims['iss'] == 'TESTTEAM45' and header['kid'] == 'TESTKEY123'
+    except jwt.PyJWTError:
+        jwt_ok = False
+    fcm_payload = next((p for p in standin.payloads if p and 'message' in p), None)
+    apns_headers = standin.last_headers.get('apns', {})
+    collapse_id, _, _ = too_hot.push_campaign_options('alert', LOCATION)
+    check([
+        (stats['apns'] == LIVE_APNS + DEAD and stats['fcm'] == LIVE_FCM + DEAD, "every device sent exactly once"),
+        (stats['connections'] <= 2 * too_hot.DIRECT_PUSH_CONNECTIONS, "few connections per provider"),
+        (stats['peak_streams'] > 1, f"requests multiplexed (peak {stats['peak_streams']} concurrent streams)"),
+        (jwt_ok, "APNs provider token is a valid ES256 JWT with kid"),
+        (standin.last_authorization.get('fcm') == 'Bearer test-oauth-token', "FCM OAuth bearer token sent"),
+        (fcm_payload is not None and all(isinstance(v, str) for v in fcm_payload['message']['data'].values()),
+         "FCM data values stringified"),
+        (apns_headers.get('apns-collapse-id') == collapse_id and int(apns_headers.get('apns-expiration', 0)) > 0,
+         "APNs alert carries apns-collapse-id and apns-expiration"),
+        (fcm_payload is not None and fcm_payload['message']['android'].get('collapse_key') == collapse_id
+         and fcm_payload['message']['android']['notification'].get('tag') == collapse_id,
+         "FCM alert carries collapse_key and notification tag"),
+        (delivered == LIVE_APNS + LIVE_FCM and pending == 0, "accepted messages logged as delivered, no receipts pending"),
+        (campaign.delivered == LIVE_APNS + LIVE_FCM and campaign.failed == 2 * DEAD, "campaign counters recorded"),
+        (still_active == 0, "unregistered tokens deactivated"),
+    ])
+
+
+def main():
+    return run_suite("📲 Direct Push Test Suite", [test_ticket_mapping, test_fan_out])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Test script for the WeatherAPI forecast cache
+Serves forecast.json from a local stand-in and checks that the look-ahead days cached by one
+daily run serve the next day's run, while a day cached on the day itself still expires after
+FORECAST_CACHE_MAX_AGE_HOURS, and that a refetched but unchanged forecast doesn't re-alert.
+"""
+
+import sys
+from datetime import datetime, timedelta
+
+from pytz import timezone
+
+from testing_support import check, run_suite, too_hot, weatherapi_standin
+
+LOCATION = 'Phoenix'
+TZ = 'America/Phoenix'
+
+
+def age_cache(hours):
+    """Pretend every cached row was fetched `hours` earlier"""
+    with too_hot.app.app_context():
+        for row in too_hot.ForecastCache.query.all():
+            row.fetched_at = row.fetched_at - timedelta(hours=hours)
+        too_hot.db.session.commit()
+
+
+def reset_cache():
+    with too_hot.app.app_context():
+        too_hot.ForecastCache.query.delete()
+        too_hot.db.session.commit()
+
+
+def forecast():
+    with too_hot.app.app_context():
+        return too_hot.get_weatherapi_forecast(LOCATION)
+
+
+def test_next_day_served_from_cache():
+    """Yesterday's run cached today as a look-ahead day; today's run makes no upstream call"""
+    print("🧪 Testing the next daily run against yesterday's look-ahead...")
+    reset_cache()
+    today = datetime.now(timezone(TZ)).date()
+    with weatherapi_standin(today - timedelta(days=1), LOCATION, TZ) as server:
+        forecast()  # Yesterday's daily run
+        age_cache(24)
+        before = server.calls
+        result = forecast()  # Today's run, 24h later
+        served_calls = server.calls - before
+    check([
+        (served_calls == 0, f"no WeatherAPI call for the second day's run ({served_calls} made)"),
+        (result and result['cached'] and result['forecast_date'] == today.strftime('%Y-%m-%d'),
+         "today's high served from the cached look-ahead day"),
+        (result and result['high_temp_f'] == 101, "look-ahead value used"),
+    ])
+
+
+def test_same_day_rows_still_expire():
+    """A day fetched on the day itself is refetched after FORECAST_CACHE_MAX_AGE_HOURS"""
+    print("🧪 Testing same-day expiry...")
+    reset_cache()
+    today = datetime.now(timezone(TZ)).date()
+    with weatherapi_standin(today, LOCATION, TZ) as server:
+        forecast()
+        repeat = forecast()
+        age_cache(too_hot.FORECAST_CACHE_MAX_AGE_HOURS + 1)
+        before = server.calls
+        refreshed = forecast()
+        refetches = server.calls - before
+    check([
+        (repeat and repeat['cached'], "repeat check within the TTL served from cache"),
+        (refetches == 1 and refreshed and not refreshed['cached'], "stale same-day row refetched"),
+    ])
+
+
+def test_refetched_forecast_unchanged():
+    """A refetch with the same high but a newer last_updated_epoch leaves the location skipped"""
+    print("🧪 Testing delta runs across a WeatherAPI refetch...")
+    reset_cache()
+    with too_hot.app.app_context():
+        for model in (too_hot.LocationCheckState, too_hot.EmailOutbox, too_hot.Subscriber):
+            model.query.delete()
+        too_hot.db.session.add(too_hot.Subscriber(email='phoenix@example.com', location=LOCATION, subscribed_at='test'))
+        too_hot.db.session.commit()
+    today = datetime.now(timezone(TZ)).date()
+    client = too_hot.app.test_client()
+    with weatherapi_standin(today, LOCATION, TZ) as server:
+        server.updated_epoch = int(datetime.utcnow().timestamp()) - 3600
+        first = client.get('/api/check-temperatures?force=true').get_json()
+        age_cache(too_hot.FORECAST_CACHE_MAX_AGE_HOURS + 1)
+        server.updated_epoch += 1800  # WeatherAPI's current conditions moved on; the forecast didn't
+        before = server.calls
+        second = client.get('/api/check-temperatures?force=true').get_json()
+        refetches = server.calls - before
+    check([
+        (first['notifications_sent'] == 1 and first['skipped_locations'] == [], "first run evaluates and alerts"),
+        (refetches == 1, "second run refetched the forecast"),
+        (second['skipped_locations'] == [LOCATION] and second['notifications_sent'] == 0,
+         "same high with a newer last_updated_epoch is skipped, not re-alerted"),
+    ])
+
+
+def main():
+    return run_suite("🌤️ Forecast Cache Test Suite", [
+        test_next_day_served_from_cache, test_same_day_rows_still_expire, test_refetched_forecast_unchanged
+    ])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
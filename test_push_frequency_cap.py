@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-device push frequency cap
+Runs repeated and overlapping heat alerts against the local Expo stand-in and checks that a
+device gets at most one alert per PUSH_ALERT_MIN_INTERVAL_MINUTES, that manual broadcasts are
+not capped, that test pushes and failed sends never count against the cap, that a look-ahead
+("tomorrow") alert is not capped by today's, and that alert messages carry a TTL.
+"""
+
+import sys
+import threading
+from datetime import datetime, timedelta
+
+from pytz import timezone
+
+from testing_support import (app_settings, check, make_retries_due, reset_push_state, run_suite, seed_devices,
+                             start_standin, stop_standin, too_hot, weatherapi_standin)
+
+
+def alert(location):
+    with too_hot.app.app_context():
+        too_hot.send_push_notification(location, 105, 93)
+
+
+def test_repeat_alerts_capped():
+    """A re-fired alert (same place, any spelling) is not sent again inside the window"""
+    print("🧪 Testing repeat alerts against the cap...")
+    reset_push_state()
+    seed_devices('Reno', 250)
+    server, standin = start_standin()
+    try:
+        alert('Reno')
+        first = standin.stats()['messages']
+        alert('  reno ')  # Another subscriber's spelling of the same place
+        second = standin.stats()['messages'] - first
+        with too_hot.app.app_context():
+            too_hot.Device.query.update({too_hot.Device.last_alert_sent_at: datetime.utcnow() - timedelta(
+                minutes=too_hot.PUSH_ALERT_MIN_INTERVAL_MINUTES + 1)})
+            too_hot.db.session.commit()
+        alert('Reno')
+        third = standin.stats()['messages'] - first
+        response = too_hot.app.test_client().post('/api/send-push-notification',
+                                                  json={'title': 'Notice', 'body': 'Shop restocked'})
+        broadcast = standin.stats()['messages'] - first - third
+    finally:
+        stop_standin(server)
+    with too_hot.app.app_context():
+        campaigns = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id).all()
+    check([
+        (first == 250, "first alert reaches every device"),
+        (second == 0 and campaigns[1].total == 0, "repeat alert inside the window sends nothing"),
+        (third == 250, "alert goes out again once the window has passed"),
+        (broadcast == 250 and response.get_json()['successful_sends'] == 250, "manual broadcast is not capped"),
+    ])
+
+
+def test_overlapping_fan_outs():
+    """Two alert fan-outs for the same place running at once reach each device once between them"""
+    print("🧪 Testing overlapping fan-outs...")
+    reset_push_state()
+    seed_devices('Sparks', 600)
+    server, standin = start_standin(latency_ms=20)
+    try:
+        with app_settings(DEVICE_PAGE_SIZE=100):  # Several claim pages per fan-out
+            threads = [threading.Thread(target=alert, args=('Sparks',)) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        stop_standin(server)
+    with too_hot.app.app_context():
+        campaigns = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id.desc()).limit(2).all()
+        message = too_hot.push_message(too_hot.Device.query.first(), 't', 'b', {}, 'expo',
+                                       *too_hot.push_campaign_options('alert', 'Sparks')[:2])
+    check([
+        (standin.stats()['messages'] == 600, f"each device alerted once ({standin.stats()['messages']} sent)"),
+        (sum(c.total for c in campaigns) == 600, "devices split between the two campaigns"),
+        (message.get('ttl') == too_hot.PUSH_ALERT_TTL_SECONDS and 'collapseId' not in message,
+         "Expo alert messages carry a TTL (Expo has no collapse key)"),
+    ])
+
+
+def test_test_pushes_not_capped():
+    """An admin's test push neither counts against nor is held back by the heat alert cap"""
+    print("🧪 Testing that test pushes leave the cap alone...")
+    reset_push_state()
+    seed_devices('Elko', 120)
+    server, standin = start_standin()
+    try:
+        with too_hot.app.app_context():
+            too_hot.send_push_notification('Elko', 105, 93, kind='test')
+            tested = standin.stats()['messages']
+            too_hot.send_push_notification('Elko', 105, 93, kind='test')
+            retested = standin.stats()['messages'] - tested
+            stamped = too_hot.Device.query.filter(too_hot.Device.location_key == 'elko',
+                                                  too_hot.Device.last_alert_sent_at != None).count()
+            alert('Elko')
+            alerted = standin.stats()['messages'] - tested - retested
+            options = too_hot.push_campaign_options('test', 'Elko')
+    finally:
+        stop_standin(server)
+    check([
+        (tested == 120 and retested == 120, "repeated test pushes are not capped"),
+        (alerted == 120, f"heat alert right after a test reaches every device ({alerted} sent)"),
+        (stamped == 0, "test pushes don't stamp last_alert_sent_at"),
+        (options[0] and options[1] == too_hot.PUSH_ALERT_TTL_SECONDS and not options[2],
+         "test pushes keep the alert collapse id and TTL"),
+    ])
+
+
+def stamped_devices(location):
+    with too_hot.app.app_context():
+        return too_hot.Device.query.filter(too_hot.Device.location_key == too_hot.normalize_location_key(location),
+                                           too_hot.Device.last_alert_sent_at != None).count()
+
+
+def run_due_retries():
+    make_retries_due()
+    too_hot.dispatch_push_retries()
+
+
+def test_failed_sends_release_claims():
+    """Only accepted alerts count against the cap: failed sends release their claims, and a retry
+    that gets through stamps the device again unless a newer alert already reached it"""
+    print("🧪 Testing claims on failed and retried sends...")
+    reset_push_state()
+    seed_devices('Ely', 150)
+    seed_devices('Wells', 100)
+    with app_settings(EXPO_PUSH_MAX_RETRIES=0, DEVICE_PAGE_SIZE=100):
+        server, _ = start_standin(error_rate=1.0)
+        try:
+            alert('Ely')
+            alert('Wells')
+        finally:
+            stop_standin(server)
+        released = stamped_devices('Ely') + stamped_devices('Wells')
+        server, standin = start_standin()
+        try:
+            alert('Wells')  # A newer alert gets through before the retry runs
+            newer = standin.stats()['messages']
+            run_due_retries()
+            retried = standin.stats()['messages'] - newer
+            alert('Ely')
+            after_retry = standin.stats()['messages'] - newer - retried
+        finally:
+            stop_standin(server)
+    check([
+        (released == 0, "failed sends leave no frequency-cap stamps"),
+        (newer == 100, "the next alert is not capped by the failed one"),
+        (retried == 150, f"retry skips devices a newer alert reached ({retried} re-sent)"),
+        (stamped_devices('Ely') == 150, "devices reached by the retry are stamped"),
+        (after_retry == 0, "an alert right after the retry is capped"),
+    ])
+
+
+def test_today_and_tomorrow_alerts():
+    """When today and tomorrow both cross the threshold, one check pushes both alerts to every device,
+    and tomorrow's does not replace today's on APNs/FCM"""
+    print("🧪 Testing today's and tomorrow's alerts in one check...")
+    reset_push_state()
+    seed_devices('Mesa', 80)
+    with too_hot.app.app_context():
+        for model in (too_hot.ForecastCache, too_hot.LocationCheckState, too_hot.EmailOutbox, too_hot.Subscriber):
+            model.query.delete()
+        too_hot.db.session.add(too_hot.Subscriber(email='mesa@example.com', location='Mesa', subscribed_at='test'))
+        too_hot.db.session.commit()
+    today = datetime.now(timezone('America/Phoenix')).date()
+    server, standin = start_standin()
+    try:
+        # Highs of 100 today and 101 tomorrow against a historical 80
+        with weatherapi_standin(today, 'Mesa', 'America/Phoenix'), app_settings(EARLY_ALERTS_ENABLED=True):
+            result = too_hot.app.test_client().get('/api/check-temperatures?force=true').get_json()
+    finally:
+        stop_standin(server)
+    with too_hot.app.app_context():
+        campaigns = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id).all()
+    today_options = too_hot.push_campaign_options('alert', 'Mesa')
+    tomorrow_options = too_hot.push_campaign_options('early_alert', 'Mesa')
+    check([
+        (result['notifications_sent'] == 2, "today's and tomorrow's alerts both raised"),
+        ([(c.kind, c.total) for c in campaigns] == [('alert', 80), ('early_alert', 80)],
+         f"both pushes fanned out to every device ({[(c.kind, c.total) for c in campaigns]})"),
+        (standin.stats()['messages'] == 160, f"tomorrow's push not capped by today's ({standin.stats()['messages']} sent)"),
+        (tomorrow_options[0] and tomorrow_options[0] != today_options[0], "tomorrow's alert has its own collapse id"),
+        (too_hot.push_lane('early_alert') == 'alert', "tomorrow's alert rides the alert lane"),
+    ])
+
+
+def main():
+    return run_suite("⏱️ Push Frequency Cap Test Suite", [
+        test_repeat_alerts_capped, test_overlapping_fan_outs, test_test_pushes_not_capped,
+        test_failed_sends_release_claims, test_today_and_tomorrow_alerts
+    ])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Test script for push priority lanes
+Starts a large manual broadcast (bulk lane) against the local Expo stand-in, fires a heat alert
+(alert lane) while it is running and checks that the alert goes ahead, that each lane stays
+within its concurrency budget, and that the bulk lane leaves part of the shared Expo budget alone.
+"""
+
+import sys
+import threading
+import time
+
+from testing_support import (check, reset_push_state, run_suite, seed_devices, start_standin, stop_standin,
+                             too_hot)
+
+BULK_DEVICES = 4000
+ALERT_DEVICES = 1200
+
+
+def test_alert_ahead_of_bulk():
+    """An alert started during a bulk broadcast finishes first and lanes stay within budget"""
+    print("🧪 Testing alert lane priority over a bulk broadcast...")
+    reset_push_state()
+    seed_devices('Laredo', BULK_DEVICES - ALERT_DEVICES)
+    seed_devices('El Paso', ALERT_DEVICES)
+    server, standin = start_standin(latency_ms=100)
+    scheduler = too_hot.push_lanes['expo']
+    peaks = {'alert': 0, 'bulk': 0, 'total': 0}
+    finished = {}
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            lanes = scheduler.status()['lanes']
+            for lane in ('alert', 'bulk'):
+                peaks[lane] = max(peaks[lane], lanes[lane]['active'])
+            peaks['total'] = max(peaks['total'], lanes['alert']['active'] + lanes['bulk']['active'])
+            time.sleep(0.002)
+
+    def broadcast():
+        response = too_hot.app.test_client().post('/api/send-push-notification', json={'title': 'Test', 'body': 'Broadcast'})
+        finished['bulk'] = (time.time(), response.get_json())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        bulk = threading.Thread(target=broadcast)
+        bulk.start()
+        time.sleep(0.5)  # Let the broadcast get going
+        started = time.time()
+        with too_hot.app.app_context():
+            too_hot.send_push_notification('El Paso', 109, 97)
+        finished['alert'] = time.time()
+        bulk.join()
+    finally:
+        sampling.set()
+        stop_standin(server)
+    alert_seconds = finished['alert'] - started
+    # 12 alert batches at 100ms with up to 6 in flight is ~0.2s; allow for the bulk requests already in flight
+    check([
+        (finished['bulk'][1]['successful_sends'] == BULK_DEVICES, "bulk broadcast delivered to every device"),
+        (finished['alert'] < finished['bulk'][0], "alert finished while the broadcast was still running"),
+        (alert_seconds < 1.5, f"alert not held behind the broadcast ({alert_seconds:.2f}s)"),
+        (peaks['bulk'] <= too_hot.PUSH_BULK_CONCURRENCY, f"bulk lane within its budget (peak {peaks['bulk']})"),
+        (peaks['total'] <= too_hot.EXPO_PUSH_CONCURRENCY, f"total in flight within EXPO_PUSH_CONCURRENCY (peak {peaks['total']})"),
+        (standin.stats()['messages'] == BULK_DEVICES + ALERT_DEVICES, "no duplicate sends"),
+    ])
+
+
+def test_bulk_quota_reserve():
+    """The bulk lane stops short of the last PUSH_BULK_QUOTA_RESERVE of the shared budget"""
+    print("🧪 Testing the alert reserve on the shared Expo budget...")
+    saved = too_hot.PROVIDER_QUOTAS['expo']
+    too_hot.PROVIDER_QUOTAS['expo'] = {'per_minute': 0, 'per_day': 8}
+    try:
+        with too_hot.app.app_context():
+            too_hot.ProviderQuota.query.filter_by(provider='expo').delete()
+            too_hot.db.session.commit()
+            bulk = [too_hot.acquire_provider_quota('expo', reserve=too_hot.PUSH_BULK_QUOTA_RESERVE, max_wait=0)
+                    for _ in range(8)]
+            alert = [too_hot.acquire_provider_quota('expo', max_wait=0) for _ in range(3)]
+    finally:
+        too_hot.PROVIDER_QUOTAS['expo'] = saved
+    check([
+        (bulk.count(True) == 6, "bulk lane granted 6 of 8 calls"),
+        (alert == [True, True, False], "alerts can still use the reserved 2"),
+    ])
+
+
+def main():
+    return run_suite("🚦 Push Priority Lanes Test Suite", [test_alert_ahead_of_bulk, test_bulk_quota_reserve])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
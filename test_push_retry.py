@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test script for the push retry queue and dead-letter store
+Sends alerts while the local Expo stand-in is down, then checks that the failed devices are
+queued, re-sent once the service is back, dead-lettered after PUSH_RETRY_MAX_ATTEMPTS and
+can be requeued from the admin endpoint.
+"""
+
+import base64
+import sys
+
+from testing_support import (app_settings, check, make_retries_due, reset_push_state, run_suite, seed_devices,
+                             start_standin, stop_standin, too_hot)
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(b'admin:evergreen').decode()}
+
+
+def retry_settings():
+    # Fail fast while the stand-in is down instead of sitting through per-request backoff
+    return app_settings(PUSH_RETRY_MAX_ATTEMPTS=2, EXPO_PUSH_MAX_RETRIES=0)
+
+
+def latest_campaign():
+    with too_hot.app.app_context():
+        campaign = too_hot.NotificationCampaign.query.order_by(too_hot.NotificationCampaign.id.desc()).first()
+        return campaign.as_dict()
+
+
+def test_outage_then_recovery():
+    """Devices missed during an outage are re-sent once Expo is back; deactivated ones are dropped"""
+    print("🧪 Testing retry after an Expo outage...")
+    reset_push_state()
+    seed_devices('Tucson', 250)
+    with retry_settings():
+        with too_hot.app.app_context():
+            too_hot.send_push_notification('Tucson', 110, 99)  # Stand-in not running yet
+            queued = too_hot.PushRetry.query.count()
+            # A token pruned in the meantime is not retried
+            too_hot.Device.query.filter(too_hot.Device.push_token.in_(
+                [f'ExponentPushToken[tucson{i}]' for i in range(10)])).update({too_hot.Device.is_active: False})
+            too_hot.db.session.commit()
+        failed_campaign = latest_campaign()
+        make_retries_due()
+        server, standin = start_standin()
+        try:
+            processed = too_hot.dispatch_push_retries()
+        finally:
+            stop_standin(server)
+    campaign = latest_campaign()
+    with too_hot.app.app_context():
+        left = too_hot.PushRetry.query.count()
+    check([
+        (queued == 1 and failed_campaign['failed'] == 250, "failed batches queued for retry"),
+        (processed == 1 and standin.stats()['messages'] == 240, "retry re-sent to the still-active devices"),
+        (left == 0, "retry row removed once every device was reached"),
+        (campaign['successful'] == 240 and campaign['failed'] == 10, "campaign counters moved to successful"),
+    ])
+
+
+def test_dead_letter_and_requeue():
+    """After PUSH_RETRY_MAX_ATTEMPTS the devices are dead-lettered; requeueing delivers them"""
+    print("🧪 Testing dead-lettering and requeue...")
+    reset_push_state()
+    seed_devices('Yuma', 120)
+    with retry_settings():
+        with too_hot.app.app_context():
+            too_hot.send_push_notification('Yuma', 115, 101)
+        attempts = []
+        for _ in range(too_hot.PUSH_RETRY_MAX_ATTEMPTS):
+            make_retries_due()
+            too_hot.dispatch_push_retries()
+            with too_hot.app.app_context():
+                attempts.append((too_hot.PushRetry.query.count(), too_hot.PushDeadLetter.query.count()))
+        client = too_hot.app.test_client()
+        status = client.get('/admin/push-retries', headers=AUTH).get_json()
+        dead_letter_id = status['recent_dead_letters'][0]['id'] if status['recent_dead_letters'] else 0
+        requeue = client.post(f'/admin/push-dead-letters/{dead_letter_id}/requeue', headers=AUTH)
+        server, standin = start_standin()
+        try:
+            too_hot.dispatch_push_retries()
+        finally:
+            stop_standin(server)
+    campaign = latest_campaign()
+    check([
+        (attempts == [(1, 0), (0, 1)], "rescheduled once, then dead-lettered"),
+        (status['dead_letters'] == 1 and status['recent_dead_letters'][0]['devices'] == 120,
+         "dead letter listed on /admin/push-retries"),
+        (requeue.status_code == 200 and requeue.get_json()['queued_devices'] == 120, "dead letter requeued"),
+        (standin.stats()['messages'] == 120, "requeued devices delivered"),
+        (campaign['successful'] == 120 and campaign['failed'] == 0, "campaign counters updated"),
+    ])
+
+
+def main():
+    return run_suite("🔁 Push Retry Test Suite", [test_outage_then_recovery, test_dead_letter_and_requeue])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Test script for email unsubscribe links
+Checks that opening an unsubscribe link only shows a confirmation form, that the form and RFC 8058
+one-click POSTs unsubscribe, that tokens expire, that alert emails carry List-Unsubscribe headers,
+and that no tokens are issued or accepted while SECRET_KEY is the default.
+"""
+
+import sys
+
+from testing_support import check, run_suite, too_hot
+
+
+def reset_subscribers(emails):
+    with too_hot.app.app_context():
+        too_hot.EmailOutbox.query.delete()
+        too_hot.Subscriber.query.delete()
+        for email in emails:
+            too_hot.db.session.add(too_hot.Subscriber(email=email, location='Boston', subscribed_at='test'))
+        too_hot.db.session.commit()
+
+
+def subscribed(email):
+    with too_hot.app.app_context():
+        return too_hot.Subscriber.query.filter_by(email=email).first() is not None
+
+
+def link_path(email):
+    with too_hot.app.app_context():
+        return too_hot.make_unsubscribe_url(email)[len(too_hot.PUBLIC_BASE_URL):]
+
+
+def test_confirm_then_post():
+    """GET shows a form and changes nothing; the form POST and a one-click POST unsubscribe"""
+    print("🧪 Testing confirmation page and one-click POST...")
+    reset_subscribers(['reader@example.com', 'oneclick@example.com'])
+    client = too_hot.app.test_client()
+    page = client.get(link_path('reader@example.com'))
+    still_subscribed = subscribed('reader@example.com')
+    confirmed = client.post(link_path('reader@example.com'))
+    one_click = client.post(link_path('oneclick@example.com'), data={'List-Unsubscribe': 'One-Click'})
+    check([
+        (page.status_code == 200 and b'<form method="post">' in page.data, "GET renders a confirmation form"),
+        (still_subscribed, "GET alone (a link prefetcher) does not unsubscribe"),
+        (confirmed.status_code == 200 and not subscribed('reader@example.com'), "form POST unsubscribes"),
+        (one_click.status_code == 200 and not subscribed('oneclick@example.com'), "RFC 8058 one-click POST unsubscribes"),
+    ])
+
+
+def test_tokens_expire():
+    """Tokens older than UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS and forged tokens are refused"""
+    print("🧪 Testing token expiry...")
+    reset_subscribers(['old@example.com'])
+    path = link_path('old@example.com')
+    saved = too_hot.UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS
+    too_hot.UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS = -1  # Every token is already past its age
+    try:
+        expired = too_hot.app.test_client().post(path)
+    finally:
+        too_hot.UNSUBSCRIBE_TOKEN_MAX_AGE_DAYS = saved
+    forged = too_hot.app.test_client().post(path[:-4] + 'abcd')
+    check([
+        (expired.status_code == 400 and b'expired' in expired.data, "expired token refused"),
+        (forged.status_code == 400, "tampered token refused"),
+        (subscribed('old@example.com'), "subscriber kept"),
+    ])
+
+
+def test_alert_headers():
+    """Queued alert emails carry List-Unsubscribe and List-Unsubscribe-Post"""
+    print("🧪 Testing List-Unsubscribe headers...")
+    reset_subscribers(['hot@example.com'])
+    with too_hot.app.app_context():
+        too_hot.send_notification('hot@example.com', 'Boston', 101, 84)
+        row = too_hot.EmailOutbox.query.first()
+        message = too_hot.build_outbox_message(row).as_string()
+    check([
+        (row.unsubscribe_url and row.unsubscribe_url in row.html, "unsubscribe URL stored and linked in the body"),
+        (f'List-Unsubscribe: <{row.unsubscribe_url}>' in message, "List-Unsubscribe header set"),
+        ('List-Unsubscribe-Post: List-Unsubscribe=One-Click' in message, "List-Unsubscribe-Post header set"),
+    ])
+
+
+def test_default_secret_key():
+    """With the placeholder SECRET_KEY no tokens are issued or accepted"""
+    print("🧪 Testing the default SECRET_KEY guard...")
+    reset_subscribers(['dev@example.com'])
+    path = link_path('dev@example.com')  # Signed with the real test key
+    saved = too_hot.app.secret_key
+    too_hot.app.secret_key = too_hot.DEFAULT_SECRET_KEY
+    try:
+        with too_hot.app.app_context():
+            url = too_hot.make_unsubscribe_url('dev@example.com')
+            too_hot.send_notification('dev@example.com', 'Boston', 101, 84)
+            row = too_hot.EmailOutbox.query.first()
+            message = too_hot.build_outbox_message(row).as_string()
+        refused = too_hot.app.test_client().post(path)
+    finally:
+        too_hot.app.secret_key = saved
+    check([
+        (url is None, "no token issued"),
+        (refused.status_code == 400 and subscribed('dev@example.com'), "links refused"),
+        (row.unsubscribe_url is None and 'List-Unsubscribe' not in message, "alert sent without one-click header"),
+        (too_hot.PUBLIC_BASE_URL in row.html, "alert links to the site's unsubscribe form instead"),
+    ])
+
+
+def main():
+    return run_suite("📭 Unsubscribe Link Test Suite", [
+        test_confirm_then_post, test_tokens_expire, test_alert_headers, test_default_secret_key
+    ])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Shared scaffolding for the offline test scripts
+Sets one baseline environment before the app is imported, so the scripts can run one by one
+(python test_push_retry.py) or together in one pytest session (python -m pytest test_push_retry.py
+test_push_lanes.py ...). The app reads its configuration at import, which only happens once per
+process: per-test settings go through app_settings(), which changes the module and restores it.
+
+Also seeds synthetic Expo devices, runs the local Expo stand-in (expo_push_standin.py) and serves
+WeatherAPI forecast and history responses locally.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Scratch database and no background threads; the tests drive dispatchers and fetchers themselves
+SCRATCH_DIR = tempfile.mkdtemp(prefix='too_hot_test_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(SCRATCH_DIR, 'test.db')}"
+os.environ['EMAIL_DISPATCHER_ENABLED'] = 'false'
+os.environ['RECEIPT_FETCHER_MODE'] = 'off'
+os.environ['PUSH_RETRY_ENABLED'] = 'false'
+os.environ['EXPO_CALLS_PER_MINUTE'] = '0'
+os.environ['EXPO_CALLS_PER_DAY'] = '0'
+os.environ['EXPO_PUSH_RATE_PER_SECOND'] = '0'
+os.environ['WEATHERAPI_CALLS_PER_MINUTE'] = '0'
+os.environ['WEATHERAPI_CALLS_PER_DAY'] = '0'
+os.environ['SECRET_KEY'] = 'too-hot-test-secret'
+# Expo pushes only ever go to the local stand-in, whether or not it is running
+EXPO_STANDIN_PORT = int(os.environ.setdefault('EXPO_STANDIN_PORT', '18768'))
+WEATHERAPI_STANDIN_PORT = int(os.environ.get('WEATHERAPI_STANDIN_PORT', '18780'))
+os.environ['EXPO_PUSH_URL'] = f"http://127.0.0.1:{EXPO_STANDIN_PORT}/--/api/v2/push/send"
+
+import app as too_hot
+from expo_push_standin import start_expo_standin
+
+
+@contextmanager
+def app_settings(**settings):
+    """Set module-level app settings (read at call time) for the duration of a test, then restore them"""
+    saved = {name: getattr(too_hot, name) for name in settings}
+    for name, value in settings.items():
+        setattr(too_hot, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(too_hot, name, value)
+
+
+def check(checks):
+    """Print each (passed, label) check, then fail the test if any of them failed"""
+    for passed, label in checks:
+        print(f"{'✅' if passed else '❌'} {label}")
+    failed = [label for passed, label in checks if not passed]
+    assert not failed, f"{len(failed)} check(s) failed: {'; '.join(failed)}"
+
+
+def run_suite(title, tests):
+    """Run test functions as a script (main()): report each group and return the exit code"""
+    print(title)
+    print("=" * 50)
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            passed += 1
+        except AssertionError as e:
+            print(f"❌ {test.__name__}: {e}")
+    print("\n" + "=" * 50)
+    print(f"📊 {passed}/{len(tests)} test groups passed")
+    return 0 if passed == len(tests) else 1
+
+
+def reset_push_state():
+    """Delete devices, campaigns, push logs and retries left by earlier tests"""
+    too_hot.flush_push_logs()
+    with too_hot.app.app_context():
+        for model in (too_hot.PushNotificationLog, too_hot.PushRetry, too_hot.PushDeadLetter,
+                      too_hot.NotificationCampaign, too_hot.Device):
+            model.query.delete()
+        too_hot.db.session.commit()
+
+
+def seed_devices(location, count):
+    """Bulk insert `count` active Expo devices for a location"""
+    key = too_hot.normalize_location_key(location)
+    with too_hot.app.app_context():
+        too_hot.db.session.bulk_insert_mappings(too_hot.Device, [
+            {
+                'push_token': f"ExponentPushToken[{key}{i}]",
+                'platform': 'expo',
+                'device_type': 'ios',
+                'location': location,
+                'location_key': key,
+                'is_active': True
+            }
+            for i in range(count)
+        ])
+        too_hot.db.session.commit()
+
+
+def start_standin(port=EXPO_STANDIN_PORT, **options):
+    """Start the Expo stand-in on `port` and send the app's Expo pushes to it. Returns (server, state)."""
+    server, state = start_expo_standin(port=port, **options)
+    too_hot.EXPO_PUSH_URL = f"http://127.0.0.1:{port}/--/api/v2/push/send"
+    return server, state
+
+
+def stop_standin(server):
+    """Stop the stand-in and free its port for the next one"""
+    server.shutdown()
+    server.server_close()
+
+
+def make_retries_due():
+    """Pull every queued push retry forward so the next dispatcher pass picks it up"""
+    with too_hot.app.app_context():
+        too_hot.PushRetry.query.update({too_hot.PushRetry.next_attempt_at: datetime.utcnow() - timedelta(seconds=1)})
+        too_hot.db.session.commit()
+
+
+class WeatherAPIStandin(BaseHTTPRequestHandler):
+    """forecast.json with FORECAST_LOOKAHEAD_DAYS days (highs 100, 101, ...) starting at server.first_day,
+    last updated at server.updated_epoch (default now), and history.json answering every past date
+    with server.history_high_f"""
+
+    def do_GET(self):
+        if self.path.startswith('/history.json'):
+            body = {'forecast': {'forecastday': [{'day': {'maxtemp_f': self.server.history_high_f}}]}}
+        else:
+            self.server.calls += 1
+            first = self.server.first_day
+            body = {
+                'location': {'name': self.server.location, 'tz_id': self.server.tz_id},
+                'current': {'last_updated_epoch': self.server.updated_epoch or int(datetime.utcnow().timestamp())},
+                'forecast': {'forecastday': [
+                    {'date': (first + timedelta(days=i)).strftime('%Y-%m-%d'), 'day': {'maxtemp_f': 100 + i}}
+                    for i in range(too_hot.FORECAST_LOOKAHEAD_DAYS)
+                ]}
+            }
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def weatherapi_standin(first_day, location, tz_id, history_high_f=80):
+    """Serve WeatherAPI locally and point the app's WEATHER_BASE_URL (and a dummy key) at it"""
+    server = ThreadingHTTPServer(('127.0.0.1', WEATHERAPI_STANDIN_PORT), WeatherAPIStandin)
+    server.calls = 0
+    server.first_day = first_day
+    server.location = location
+    server.tz_id = tz_id
+    server.history_high_f = history_high_f
+    server.updated_epoch = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with app_settings(WEATHER_BASE_URL=f"http://127.0.0.1:{server.server_port}",
+                          WEATHER_API_KEY=too_hot.WEATHER_API_KEY or 'test-key'):
+            yield server
+    finally:
+        server.shutdown()
+        server.server_close()